@@ -0,0 +1,71 @@
+import argparse
+import logging
+import time
+import tracemalloc
+
+from rdflib import Graph, RDF, Namespace
+
+import utils.experiments
+from utils.compact_store import get_compact_graph
+from benchmarks.samples import load_scaled_samples
+
+AMOR_EXP = Namespace("http://www.gsi.upm.es/ontologies/amor/experiments/ns#")
+
+def build_memory_graph(triples: list, prefixes: list) -> Graph:
+    graph = Graph(bind_namespaces="none")
+    for prefix, namespace in prefixes:
+        graph.bind(prefix, namespace)
+    for triple in triples:
+        graph.add(triple)
+    return graph
+
+def measure_build(function, *args) -> tuple:
+    '''
+    Returns the graph built by function, the time it took (seconds) and the memory it keeps allocated (bytes).
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    graph = function(*args)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return graph, elapsed, size
+
+def measure_queries(graph: Graph, experiments: list, repeat: int) -> tuple:
+    '''
+    Returns the best time (seconds) of 'repeat' runs of the experiment list query
+    and of the CONSTRUCT query of every experiment.
+    '''
+    list_times, construct_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        utils.experiments.get_experiment_list(graph)
+        list_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for experiment in experiments:
+            namespace, experiment_id = str(experiment).rsplit("#", 1)
+            utils.experiments.get_single_experiment_graph(graph, namespace + "#", experiment_id)
+        construct_times.append(time.perf_counter() - start)
+    return min(list_times), min(construct_times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the compact store against the default rdflib store (run from the server folder)")
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 10, 100, 1000],
+                        help="Number of copies of the tutorial TTL samples in each graph (default: 1 10 100 1000)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per query, the best one is reported (default: 3)")
+    parser.add_argument("--experiments", type=int, default=20, help="Experiments retrieved with the CONSTRUCT query (default: 20)")
+    args = parser.parse_args()
+    # The experiment queries log every call
+    logging.disable(logging.INFO)
+
+    print(f"{'store':>8} {'triples':>10} {'build (s)':>10} {'memory (MB)':>12} {'list (s)':>9} {'construct (s)':>14}")
+    for copies in args.copies:
+        source = load_scaled_samples(copies)
+        triples, prefixes = list(source), list(source.namespaces())
+        experiments = sorted(source.subjects(RDF.type, AMOR_EXP.Experiment))[:args.experiments]
+        memory_graph, memory_time, memory_size = measure_build(build_memory_graph, triples, prefixes)
+        compact_graph, compact_time, compact_size = measure_build(get_compact_graph, memory_graph)
+        for name, graph, build_time, size in (("memory", memory_graph, memory_time, memory_size),
+                                               ("compact", compact_graph, compact_time, compact_size)):
+            list_time, construct_time = measure_queries(graph, experiments, args.repeat)
+            print(f"{name:>8} {len(graph):>10} {build_time:>10.3f} {size / 2**20:>12.1f} {list_time:>9.3f} {construct_time:>14.3f}")
@@ -0,0 +1,142 @@
+import argparse
+import logging
+import time
+
+from rdflib import Graph, RDF
+
+import utils.experiments
+from utils.experiments import AMOR_EXP
+from benchmarks.samples import load_scaled_samples
+
+# Previous queries: built with the experiment URI on every call, so rdflib parsed and translated them every time
+PREFIXES = """
+    PREFIX segb: <http://www.gsi.upm.es/ontologies/segb/ns#>
+    PREFIX amor-exp: <http://www.gsi.upm.es/ontologies/amor/experiments/ns#>
+    PREFIX oro: <http://kb.openrobots.org#>
+"""
+INTERPOLATED_QUERIES = {
+    "get_experiment": PREFIXES + """
+    SELECT ?predicate ?object
+    WHERE {{
+        <{experiment_uri}> a amor-exp:Experiment .
+        <{experiment_uri}> ?predicate ?object .
+    }}
+    """,
+    "get_logged_activities": PREFIXES + """
+    DESCRIBE ?activity
+    WHERE {{
+        ?activity a segb:LoggedActivity .
+        ?activity amor-exp:isRelatedWithExperiment <{experiment_uri}> .
+    }}
+    """,
+    "get_logged_messages": PREFIXES + """
+    DESCRIBE ?message
+    WHERE {{
+        ?activity a segb:LoggedActivity ;
+            amor-exp:isRelatedWithExperiment <{experiment_uri}> ;
+            oro:hasMessage ?message .
+    }}
+    """,
+    "get_single_experiment_graph": PREFIXES + """
+    CONSTRUCT {{
+        <{experiment_uri}> ?experiment_predicate ?experiment_object .
+        ?activity_uri ?activity_predicate ?activity_object .
+        ?msg_uri ?message_predicate ?message_object .
+    }}
+    WHERE {{
+        <{experiment_uri}> a amor-exp:Experiment .
+        {{
+            <{experiment_uri}> ?experiment_predicate ?experiment_object .
+        }}
+        UNION
+        {{
+            ?activity_uri amor-exp:isRelatedWithExperiment <{experiment_uri}> .
+            ?activity_uri ?activity_predicate ?activity_object .
+        }}
+        UNION
+        {{
+            ?activity amor-exp:isRelatedWithExperiment <{experiment_uri}> ;
+                oro:hasMessage ?msg_uri .
+            ?msg_uri ?message_predicate ?message_object .
+        }}
+    }}
+    """,
+}
+
+# Previous experiment graph query, with consecutive OPTIONALs instead of UNION (compared apart, both interpolated)
+OPTIONAL_SINGLE_EXPERIMENT_GRAPH_QUERY = PREFIXES + """
+    CONSTRUCT {{
+        <{experiment_uri}> ?experiment_predicate ?experiment_object .
+        ?activity_uri ?activity_predicate ?activity_object .
+        ?msg_uri ?message_predicate ?message_object .
+    }}
+    WHERE {{
+        <{experiment_uri}> a amor-exp:Experiment .
+        <{experiment_uri}> ?experiment_predicate ?experiment_object .
+        OPTIONAL {{
+            ?activity_uri amor-exp:isRelatedWithExperiment <{experiment_uri}> .
+            ?activity_uri ?activity_predicate ?activity_object .
+        }}
+        OPTIONAL {{
+            ?activity amor-exp:isRelatedWithExperiment <{experiment_uri}> ;
+                oro:hasMessage ?msg_uri .
+            ?msg_uri ?message_predicate ?message_object .
+        }}
+    }}
+    """
+
+def measure(function, experiments: list, repeat: int) -> float:
+    '''
+    Returns the best mean latency (milliseconds) of 'repeat' runs of function over all the experiments.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for experiment in experiments:
+            function(experiment)
+        times.append((time.perf_counter() - start) / len(experiments))
+    return min(times) * 1000
+
+def run_interpolated(graph: Graph, query: str):
+    def run(experiment):
+        # The results are consumed as the endpoints do
+        list(graph.query(query.format(experiment_uri=experiment)))
+    return run
+
+def run_prepared(graph: Graph, name: str):
+    function = getattr(utils.experiments, name)
+    def run(experiment):
+        namespace, experiment_id = str(experiment).rsplit("#", 1)
+        result = function(graph, namespace + "#", experiment_id)
+        list(result[1] if isinstance(result, tuple) else result)
+    return run
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the experiment queries of utils.experiments (run from the server folder)")
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 10, 100],
+                        help="Number of copies of the tutorial TTL samples in each graph (default: 1 10 100)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per query, the best one is reported (default: 3)")
+    parser.add_argument("--experiments", type=int, default=5, help="Experiments queried in every run (default: 5)")
+    args = parser.parse_args()
+    # The experiment queries log every call
+    logging.disable(logging.INFO)
+
+    # Every row compares the same query text built and parsed on every call (interpolated) and prepared once;
+    # the last row compares the OPTIONAL and UNION versions of the experiment graph query, both interpolated
+    print(f"{'triples':>10} {'query':>38} {'before (ms)':>12} {'after (ms)':>11} {'speedup':>8}")
+    for copies in args.copies:
+        graph = load_scaled_samples(copies)
+        experiments = sorted(graph.subjects(RDF.type, AMOR_EXP.Experiment))[:args.experiments]
+        rows = [
+            (f"{name} (prepared)", run_interpolated(graph, query), run_prepared(graph, name))
+            for name, query in INTERPOLATED_QUERIES.items()
+        ]
+        rows.append((
+            "get_single_experiment_graph (UNION)",
+            run_interpolated(graph, OPTIONAL_SINGLE_EXPERIMENT_GRAPH_QUERY),
+            run_interpolated(graph, INTERPOLATED_QUERIES["get_single_experiment_graph"])
+        ))
+        for label, before, after in rows:
+            before_time = measure(before, experiments, args.repeat)
+            after_time = measure(after, experiments, args.repeat)
+            print(f"{len(graph):>10} {label:>38} {before_time:>12.2f} {after_time:>11.2f} {before_time / after_time:>7.1f}x")
@@ -0,0 +1,66 @@
+import argparse
+import json
+import time
+import tracemalloc
+
+from rdflib import Graph
+
+import utils.semantic
+from benchmarks.samples import load_scaled_samples
+
+def convert_graph_to_json_ld_with_serializer(graph: Graph) -> dict:
+    '''
+    Previous conversion: rdflib's JSON-LD serializer followed by json.loads.
+    '''
+    prefixes = {prefix: str(uri) for prefix, uri in graph.namespaces()}
+    json_ld_data = json.loads(graph.serialize(format="json-ld", context=prefixes, encoding="utf-8"))
+    context = json_ld_data.get("@context", {})
+    if "@graph" not in json_ld_data:
+        json_ld_data.pop("@context")
+        data = json_ld_data if isinstance(json_ld_data, list) else [json_ld_data]
+        json_ld_data = {"@context": context, "@graph": data}
+    return json_ld_data
+
+def sort_json_ld_values(json_ld_data: dict) -> dict:
+    '''
+    Sorts the nodes and the values of every property (only their order differs between both conversions).
+    '''
+    def sort_values(value):
+        if isinstance(value, list):
+            return sorted((sort_values(item) for item in value), key=json.dumps)
+        if isinstance(value, dict):
+            return {key: sort_values(item) if key != "@list" else [sort_values(cell) for cell in item] for key, item in value.items()}
+        return value
+    return {"@context": json_ld_data["@context"], "@graph": sort_values(json_ld_data["@graph"])}
+
+def measure(function, graph: Graph, repeat: int) -> tuple:
+    '''
+    Returns the best time (seconds) of 'repeat' runs and the peak memory (bytes) allocated by one run.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(graph)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function(graph)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the conversion of graphs to JSON-LD (run from the server folder)")
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 10, 100, 1000],
+                        help="Number of copies of the tutorial TTL samples in each graph (default: 1 10 100 1000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per conversion, the best one is reported (default: 5)")
+    args = parser.parse_args()
+
+    print(f"{'triples':>10} {'serializer (s)':>15} {'direct (s)':>11} {'speedup':>8} {'serializer peak (MB)':>21} {'direct peak (MB)':>17} {'equivalent':>11}")
+    for copies in args.copies:
+        graph = load_scaled_samples(copies)
+        serializer_time, serializer_peak = measure(convert_graph_to_json_ld_with_serializer, graph, args.repeat)
+        direct_time, direct_peak = measure(utils.semantic.convert_graph_to_json_ld, graph, args.repeat)
+        # Both conversions give the same nodes and values, but not always in the same order
+        equivalent = sort_json_ld_values(convert_graph_to_json_ld_with_serializer(graph)) == sort_json_ld_values(utils.semantic.convert_graph_to_json_ld(graph))
+        print(f"{len(graph):>10} {serializer_time:>15.3f} {direct_time:>11.3f} {serializer_time / direct_time:>7.1f}x "
+              f"{serializer_peak / 2**20:>21.1f} {direct_peak / 2**20:>17.1f} {str(equivalent):>11}")
@@ -0,0 +1,27 @@
+from rdflib import Graph, URIRef
+import glob
+import os
+
+# TTL samples of the tutorial, used as a realistic base for the benchmarks
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "tutorial", "ttl")
+
+def load_scaled_samples(copies: int) -> Graph:
+    '''
+    Loads the tutorial TTL samples and repeats them 'copies' times.
+    Every copy renames the resources described in the samples (the subjects), so the copies
+    do not collapse into the same triples, while properties and classes are shared as in a real graph.
+    '''
+    samples = Graph()
+    for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, "*.ttl"))):
+        samples.parse(path, format="turtle")
+    resources = {subject for subject in samples.subjects() if isinstance(subject, URIRef)}
+
+    graph = Graph()
+    for prefix, namespace in samples.namespaces():
+        graph.bind(prefix, namespace)
+    for copy in range(copies):
+        def rename(term):
+            return URIRef(f"{term}_{copy}") if term in resources else term
+        for subject, predicate, obj in samples:
+            graph.add((rename(subject), predicate, rename(obj)))
+    return graph
@@ -0,0 +1,41 @@
+import argparse
+import os
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance tasks for the SEGB MongoDB graph")
+    parser.add_argument("command", choices=["migrate", "index", "compact", "checkpoint"],
+                        help="migrate: move the legacy single Graph document to one document per triple. "
+                             "index: rebuild the experiment index from the stored graph. "
+                             "compact: merge the repeated nodes and triples of the graph document. "
+                             "checkpoint: store a checkpoint of the current graph for point-in-time reconstruction")
+    parser.add_argument("--db", default=os.getenv("DATABASE_SERVICE", "segb-mongodb"),
+                        help="MongoDB service host (default: DATABASE_SERVICE env var or segb-mongodb)")
+    args = parser.parse_args()
+
+    # The model reads the storage layout at import time
+    if args.command == "migrate":
+        os.environ["GRAPH_STORAGE"] = "triples"
+
+    from utils.MongoDB.model import connect_to_db, migrate_legacy_graph, rebuild_experiment_index, compact_graph, create_checkpoint
+
+    connect_to_db(args.db)
+
+    if args.command == "migrate":
+        migrated = migrate_legacy_graph()
+        print(f"Migrated {migrated} triples to the triple collection.")
+        print("Set GRAPH_STORAGE=triples in the server environment to use the new layout.")
+    elif args.command == "index":
+        experiments = rebuild_experiment_index()
+        print(f"Experiment index rebuilt: {experiments} experiments.")
+    elif args.command == "compact":
+        nodes_before, nodes_after = compact_graph()
+        print(f"Graph compacted: {nodes_before} nodes before, {nodes_after} nodes after.")
+    elif args.command == "checkpoint":
+        checkpoint = create_checkpoint()
+        if checkpoint:
+            print(f"Checkpoint stored: {checkpoint.triples} triples up to {checkpoint.taken_at.isoformat()}.")
+        else:
+            print("No checkpoint stored: there is no graph, or it was modified or cleared meanwhile.")
+
+    sys.exit(0)
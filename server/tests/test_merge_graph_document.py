@@ -0,0 +1,39 @@
+import json
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import mongoengine
+from rdflib import Graph, URIRef
+
+# The MongoDB server imports its modules from its own folder
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utils", "MongoDB"))
+import model
+
+
+@pytest.fixture(autouse=True)
+def database():
+    mongoengine.connect("graph", host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+    yield
+    mongoengine.disconnect()
+
+
+def stored_graph() -> Graph:
+    graph_data = model.Graph._get_collection().find_one({"_id": "0"})["graph_data"]
+    return Graph().parse(data=json.dumps(graph_data), format="json-ld")
+
+
+def test_prefix_bound_to_another_iri_keeps_the_iris():
+    first = Graph().parse(data="@prefix ex: <http://one.org/> . ex:a ex:p ex:b .", format="turtle")
+    second = Graph().parse(data="@prefix ex: <http://two.org/> . ex:c ex:p ex:d .", format="turtle")
+    model.merge_graph_document(context={"ex": "http://one.org/"}, graph=first)
+    model.merge_graph_document(context={"ex": "http://two.org/"}, graph=second)
+
+    graph = stored_graph()
+    assert (URIRef("http://one.org/a"), URIRef("http://one.org/p"), URIRef("http://one.org/b")) in graph
+    assert (URIRef("http://two.org/c"), URIRef("http://two.org/p"), URIRef("http://two.org/d")) in graph
+    assert len(graph) == 2
+    context = model.Graph._get_collection().find_one({"_id": "0"})["graph_data"]["@context"]
+    assert context["ex"] == "http://one.org/"
@@ -0,0 +1,52 @@
+import model
+from utils.executor import make_async, iterate_blocking
+
+import logging
+
+logger = logging.getLogger("segb.server.async_model")
+
+logger.info("Loading module async_model...")
+
+# mongoengine/pymongo and rdflib are blocking libraries, so the functions of the model
+# are exposed here as coroutines that run in the bounded executor, out of the event loop.
+
+connect_to_db = model.connect_to_db
+
+# ------------ INSERT FUNCTIONS ------------ #
+
+save_graph = make_async(model.save_graph)
+log_ttl_content = make_async(model.log_ttl_content)
+log_ttl_batch = make_async(model.log_ttl_batch)
+
+# ------------ INGEST QUEUE FUNCTIONS ------------ #
+
+enqueue_ttl_content = make_async(model.enqueue_ttl_content)
+process_ingest_queue = make_async(model.process_ingest_queue)
+
+# ------------ READ FUNCTIONS ------------ #
+
+get_graph_from_db = make_async(model.get_graph_from_db)
+get_graph_version = make_async(model.get_graph_version)
+get_turtle_snapshot = make_async(model.get_turtle_snapshot)
+get_experiment_uris = make_async(model.get_experiment_uris)
+get_experiment_graph_from_db = make_async(model.get_experiment_graph_from_db)
+get_experiment_stats = make_async(model.get_experiment_stats)
+get_experiment_subjects = make_async(model.get_experiment_subjects)
+get_experiments_subjects = make_async(model.get_experiments_subjects)
+get_subjects_n3_triples = make_async(model.get_subjects_n3_triples)
+get_logs_list = make_async(model.get_logs_list)
+LOG_FIELDS = model.LOG_FIELDS
+get_log_info = make_async(model.get_log_info)
+
+def iterate_subjects_nt(subjects: list):
+    # Every chunk is read and serialized in the executor as the response is streamed
+    return iterate_blocking(model.iterate_subjects_nt(subjects))
+
+# ------------ POINT-IN-TIME FUNCTIONS ------------ #
+
+get_graph_as_of = make_async(model.get_graph_as_of)
+create_checkpoint_if_due = make_async(model.create_checkpoint_if_due)
+
+# ------------ DELETE FUNCTIONS ------------ #
+
+clear_graph = make_async(model.clear_graph)
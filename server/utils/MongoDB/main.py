@@ -1,14 +1,19 @@
 import uvicorn
-from fastapi import Body, Depends, FastAPI, HTTPException, status, Response, Request
-from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query, status, Response, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Annotated
+from starlette.datastructures import UploadFile
+from typing import Annotated, Literal
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime
 import json
+import asyncio
 
 import utils.semantic
 import utils.experiments
 from utils.credentials import User, validate_token, Role
-from model import connect_to_db, save_json_ld, get_raw_graph_from_db, log_ttl_content, clear_graph, get_logs_list, get_log_info
+from utils.executor import run_blocking, get_parser_pool
+from async_model import connect_to_db, save_graph, get_graph_from_db, get_graph_version, get_turtle_snapshot, get_experiment_uris, get_experiment_graph_from_db, get_experiment_stats, get_experiment_subjects, get_experiments_subjects, iterate_subjects_nt, get_subjects_n3_triples, log_ttl_content, log_ttl_batch, clear_graph, get_logs_list, get_log_info, get_graph_as_of, create_checkpoint_if_due, enqueue_ttl_content, process_ingest_queue, LOG_FIELDS
 
 import logging
 import os
@@ -53,14 +58,63 @@ except Exception as e:
 
 version = os.getenv("VERSION", '') or "stable"
 
+# 'sync' integrates every /log request into the graph before answering
+# 'queue' only validates the TTL, stores it in the ingest queue and answers 202; a background worker ingests it
+LOG_INGEST_MODE = os.getenv("LOG_INGEST_MODE", "sync").lower()
+logger.info(f"Log ingest mode: {LOG_INGEST_MODE}")
+# Maximum number of queued TTL documents ingested with a single graph write
+INGEST_QUEUE_BATCH_SIZE = int(os.getenv("INGEST_QUEUE_BATCH_SIZE", "500"))
+# Seconds the worker waits before checking the ingest queue again when it is empty
+INGEST_QUEUE_POLL_INTERVAL = float(os.getenv("INGEST_QUEUE_POLL_INTERVAL", "1"))
+# Experiments whose triples are read and serialized together by the bulk export
+EXPERIMENT_EXPORT_BATCH_SIZE = int(os.getenv("EXPERIMENT_EXPORT_BATCH_SIZE", "50"))
+
+async def ingest_queue_worker(stop: asyncio.Event, poll: bool = True):
+    '''
+    Drains the ingest queue in batches until 'stop' is set (the batch in progress is finished first).
+    Without 'poll' it returns as soon as the queue is empty.
+    '''
+    logger.info("Ingest queue worker started")
+    while not stop.is_set():
+        try:
+            processed = await process_ingest_queue(INGEST_QUEUE_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Error ingesting queued logs: {e}")
+            processed = 0
+        if processed < INGEST_QUEUE_BATCH_SIZE:
+            if not poll:
+                break
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), timeout=INGEST_QUEUE_POLL_INTERVAL)
+    logger.info("Ingest queue worker stopped")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    stop_worker = asyncio.Event()
+    # In 'sync' mode the documents queued before switching modes are only ingested once, at startup
+    worker = asyncio.create_task(ingest_queue_worker(stop_worker, poll=LOG_INGEST_MODE == "queue"))
+    yield
+    stop_worker.set()
+    with suppress(asyncio.CancelledError):
+        await worker
+
 app = FastAPI(
     title=api_info["title"],
     description=api_description,
     version=version,
     contact=api_info["contact"],
     license_info=api_info["license"],
+    lifespan=lifespan,
 )
 
+# Line separating the TTL documents of a /log/batch request sent as a single text/turtle body
+LOG_BATCH_SEPARATOR = os.getenv("LOG_BATCH_SEPARATOR", "#--- END OF DOCUMENT ---")
+LOG_BATCH_MAX_DOCUMENTS = int(os.getenv("LOG_BATCH_MAX_DOCUMENTS", "1000"))
+
+# Limits of the queries sent to /query (seconds, and rows or triples of the result)
+SPARQL_QUERY_TIMEOUT = float(os.getenv("SPARQL_QUERY_TIMEOUT", "30"))
+SPARQL_MAX_RESULTS = int(os.getenv("SPARQL_MAX_RESULTS", "10000"))
+
 db_service = os.getenv("DATABASE_SERVICE", "segb-mongodb")
 connect_to_db(db_service)
 
@@ -76,8 +130,16 @@ async def default_route(request: Request):
     logger.info("Health check request received from IP: %s", request.client.host)
     return Response(content=f"I’ve seen things you people wouldn’t believe... But I’m fine. The SEGB is running smoother than a freshly refactored function. It is running version {version} flawlessly...", status_code=status.HTTP_200_OK, media_type="text/plain; chartset=utf-8")
 
-@app.post('/log')
-async def save_log(user: Annotated[User, Depends(validate_token)], request: Request, recieved_data: Annotated[str, Body(media_type="text/turtle")]):
+# The body is read as text whatever its media type (FastAPI would decode JSON-LD bodies as JSON)
+RDF_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {media_type: {"schema": {"type": "string"}} for media_type in utils.semantic.RDF_MEDIA_TYPES}
+    }
+}
+
+@app.post('/log', openapi_extra=RDF_REQUEST_BODY)
+async def save_log(user: Annotated[User, Depends(validate_token)], request: Request, background_tasks: BackgroundTasks):
     logger.info(f"Received post for log from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
     if not (Role.LOGGER.value in user.roles or Role.ADMIN.value in user.roles):
         logger.info(f"User {user.name} (username: {user.username} - roles: {user.roles}) does not have permission to perform this action")
@@ -87,23 +149,42 @@ async def save_log(user: Annotated[User, Depends(validate_token)], request: Requ
         )
     try:
         origin_ip = request.client.host
-        logger.info(f"Received log data from {origin_ip}")
-        json_ld_data = None
+        rdf_format = utils.semantic.get_rdf_format(request.headers.get("content-type"))
+        logger.info(f"Received log data from {origin_ip} (format: {rdf_format})")
+        recieved_data = (await request.body()).decode("utf-8")
+        if not recieved_data.strip():
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Not received data or invalid data"
+            )
         try:
-            graph = utils.semantic.get_graph_from_ttl(recieved_data)
-            logger.debug(f"Graph loaded from received Turtle data")
-            json_ld_data = utils.semantic.convert_graph_to_json_ld(graph=graph)
-            logger.debug(f"Graph converted to JSON-LD format")
+            graph = await run_blocking(utils.semantic.get_graph_from_data, recieved_data, rdf_format)
+            logger.debug(f"Graph loaded from received data")
         except Exception as e:
-            logger.error(f"Error converting Turtle data to JSON-LD: {e}")
+            logger.error(f"Error parsing {rdf_format} data: {e}")
             raise HTTPException(
                 status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=f"Invalid TTL data format. Error including Turtle data in the graph: Error details -> {str(e)}"
+                detail=f"Invalid {rdf_format} data format. Error including the data in the graph: Error details -> {str(e)}"
                 )
-        save_json_ld(json_ld_data=json_ld_data)
+        if LOG_INGEST_MODE == "queue":
+            log_id = await enqueue_ttl_content(ttl=recieved_data, ip_addr=origin_ip, user_details=str(user), username=user.username, content_format=rdf_format)
+            logger.info(f"Log data queued for ingestion (log ID: {log_id})")
+            return JSONResponse(
+                content={"message": "Log accepted for ingestion", "log_id": log_id},
+                headers={"Location": f"/log?log_id={log_id}"},
+                status_code=status.HTTP_202_ACCEPTED
+            )
+        graph_sequence = await save_graph(graph)
         logger.info("Log data integrated into the global graph")
-        log_ttl_content(ttl=recieved_data, ip_addr=origin_ip, user_details=str(user))
+        logged = await log_ttl_content(ttl=recieved_data, ip_addr=origin_ip, user_details=str(user), username=user.username, content_format=rdf_format, graph_sequence=graph_sequence)
+        if not logged:
+            logger.error("Log integrated into the global graph but not registered in history")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Internal Server Error: The log was integrated into the graph, but it could not be registered in the history"
+            )
         logger.debug(f"Log registered in history")
+        background_tasks.add_task(create_checkpoint_if_due)
         return JSONResponse(content={"message": "Log saved successfully"}, status_code=status.HTTP_201_CREATED)
     except HTTPException as e:
         logger.error(f"HTTPException: {e.detail}")
@@ -116,6 +197,90 @@ async def save_log(user: Annotated[User, Depends(validate_token)], request: Requ
             detail=f"Internal Server Error: Error saving log data. Error details -> {str(e)}"
             )
 
+async def read_batch_documents(request: Request) -> list:
+    '''
+    Get the TTL documents of a batch request.
+    They can be sent as the parts of a multipart/form-data body,
+    or as a single text body where documents are separated by a LOG_BATCH_SEPARATOR line.
+    '''
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        documents = []
+        for _, value in form.multi_items():
+            if isinstance(value, UploadFile):
+                value = (await value.read()).decode("utf-8")
+            documents.append(value)
+    else:
+        body = (await request.body()).decode("utf-8")
+        documents = []
+        current_document = []
+        for line in body.splitlines():
+            if line.strip() == LOG_BATCH_SEPARATOR:
+                documents.append("\n".join(current_document))
+                current_document = []
+            else:
+                current_document.append(line)
+        documents.append("\n".join(current_document))
+    return [document for document in documents if document.strip()]
+
+@app.post('/log/batch')
+async def save_log_batch(user: Annotated[User, Depends(validate_token)], request: Request, background_tasks: BackgroundTasks):
+    logger.info(f"Received post for log batch from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
+    if not (Role.LOGGER.value in user.roles or Role.ADMIN.value in user.roles):
+        logger.info(f"User {user.name} (username: {user.username} - roles: {user.roles}) does not have permission to perform this action")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not have permission to perform this action"
+        )
+    try:
+        origin_ip = request.client.host
+        documents = await read_batch_documents(request)
+        logger.info(f"Received batch of {len(documents)} TTL documents from {origin_ip}")
+        if not documents:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Not received data or invalid data"
+            )
+        if len(documents) > LOG_BATCH_MAX_DOCUMENTS:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Too many documents in the batch (maximum: {LOG_BATCH_MAX_DOCUMENTS})"
+            )
+        try:
+            graph = await run_blocking(utils.semantic.get_graph_from_ttl_documents, documents)
+        except ValueError as e:
+            logger.error(f"Error parsing Turtle data of the batch: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Invalid TTL data format. Nothing has been saved. Error details -> {str(e)}"
+                )
+        logger.debug(f"Batch loaded into a graph with {len(graph)} triples")
+        graph_sequence = await save_graph(graph)
+        logger.info("Batch data integrated into the global graph")
+        log_ids = await log_ttl_batch(ttls=documents, ip_addr=origin_ip, user_details=str(user), username=user.username, graph_sequence=graph_sequence)
+        if not log_ids:
+            logger.error("Batch integrated into the global graph but not registered in history")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Internal Server Error: The batch was integrated into the graph, but it could not be registered in the history"
+            )
+        logger.debug(f"Batch registered in history")
+        background_tasks.add_task(create_checkpoint_if_due)
+        return JSONResponse(
+            content={"message": "Batch saved successfully", "documents": len(documents), "log_ids": log_ids},
+            status_code=status.HTTP_201_CREATED
+        )
+    except HTTPException as e:
+        logger.error(f"HTTPException: {e.detail}")
+        raise e
+    except Exception as e:
+        logger.error("Error saving log batch")
+        logger.debug(f"Error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal Server Error: Error saving log batch. Error details -> {str(e)}"
+            )
+
 @app.get('/log')
 async def get_log(user: Annotated[User, Depends(validate_token)], request: Request, log_id: str = None):
     logger.info(f"Received request for log with ID: {log_id} from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
@@ -133,7 +298,7 @@ async def get_log(user: Annotated[User, Depends(validate_token)], request: Reque
             )
     else:
         try:
-            log_data = get_log_info(log_id)
+            log_data = await get_log_info(log_id)
             
             if not log_data:
                 logger.info(f"Log info not found for ID: {log_id}")
@@ -154,15 +319,47 @@ async def get_log(user: Annotated[User, Depends(validate_token)], request: Reque
     return JSONResponse(content=log_data, status_code=status.HTTP_200_OK)
 
 @app.get('/history')
-async def get_history(user: Annotated[User, Depends(validate_token)], request: Request):
+async def get_history(
+    user: Annotated[User, Depends(validate_token)],
+    request: Request,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    cursor: str = None,
+    action_type: Annotated[str | None, Query(pattern="^(insertion|deletion)$")] = None,
+    username: Annotated[str | None, Query(alias="user")] = None,
+    start: datetime = None,
+    end: datetime = None,
+    fields: str = None
+):
     logger.info(f"Received request for history from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
     if not (Role.AUDITOR.value in user.roles or Role.ADMIN.value in user.roles):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="User does not have permission to perform this action"
         )
+    selected_fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    unknown_fields = [field for field in selected_fields or [] if field not in LOG_FIELDS]
+    if unknown_fields:
+        logger.info(f"Unknown log fields requested: {unknown_fields}")
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown log fields: {', '.join(unknown_fields)} (available: {', '.join(LOG_FIELDS)})"
+        )
     try:
-        history = get_logs_list()
+        try:
+            history, next_cursor = await get_logs_list(
+                limit=limit,
+                cursor=cursor,
+                action_type=action_type,
+                username=username,
+                start=start,
+                end=end,
+                fields=selected_fields
+            )
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid parameters: {str(e)}"
+            )
         logger.debug(f"History retrieved successfully")
         if not history:
             logger.info("No history found")
@@ -170,6 +367,10 @@ async def get_history(user: Annotated[User, Depends(validate_token)], request: R
         else:
             logger.info("History found")
             response = JSONResponse(content=history, status_code=status.HTTP_200_OK)
+            if next_cursor:
+                # The next page is requested with the same parameters and this cursor
+                response.headers["X-Next-Cursor"] = next_cursor
+                response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
         logger.debug(f"Response status code: {response.status_code}")
         return response
     except HTTPException as e:
@@ -183,85 +384,150 @@ async def get_history(user: Annotated[User, Depends(validate_token)], request: R
         )
 
 @app.get('/query')
-async def get_query(user: Annotated[User, Depends(validate_token)]):
-    logger.info(f"Received request for query from user {user.name} (username: {user.username} - roles: {user.roles})")
-    if Role.ADMIN.value not in user.roles:
+async def get_query(user: Annotated[User, Depends(validate_token)], request: Request, query: str, limit: Annotated[int, Query(ge=1)] = None):
+    logger.info(f"Received request for query from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
+    if not (Role.AUDITOR.value in user.roles or Role.ADMIN.value in user.roles):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="User does not have permission to perform this action"
         )
-    raise HTTPException(
-        status_code=status.HTTP_501_NOT_IMPLEMENTED,
-        detail="Not implemented yet"
-    )
+    max_results = min(limit or SPARQL_MAX_RESULTS, SPARQL_MAX_RESULTS)
+    try:
+        # The query runs on the cached graph, which is only parsed again when the stored graph changes
+        graph = await get_graph_from_db()
+        # execute_sparql_query stops the evaluation itself at the time limit; wait_for makes sure the answer is not delayed
+        media_type, content, truncated = await asyncio.wait_for(
+            run_blocking(utils.semantic.execute_sparql_query, graph, query, max_results, SPARQL_QUERY_TIMEOUT),
+            timeout=SPARQL_QUERY_TIMEOUT
+        )
+        logger.info(f"Query executed successfully{' (results truncated)' if truncated else ''}")
+        return Response(
+            content=content,
+            media_type=media_type,
+            headers={"X-Results-Truncated": str(truncated).lower()},
+            status_code=status.HTTP_200_OK
+        )
+    except ValueError as e:
+        logger.error(f"Invalid SPARQL query: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except TimeoutError:
+        logger.error(f"SPARQL query exceeded the time limit of {SPARQL_QUERY_TIMEOUT} seconds")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Query exceeded the time limit of {SPARQL_QUERY_TIMEOUT} seconds"
+        )
+    except HTTPException as e:
+        logger.error(f"HTTPException: {e.detail}")
+        raise e
+    except Exception as e:
+        logger.error(f"Error executing SPARQL query: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal Server Error: Error executing SPARQL query. Error details -> {str(e)}"
+        )
+
+def etag_matches(request: Request, etags: list) -> bool:
     '''
-    TODO: check how modifications to the graph are done (or not done),
-    because it is loaded "locally" in memory and not loaded again in the database
-    
-    I have to think about this, because the graph is not modified in the database,
-    but it is modified in memory.
-    The graph is loaded from the database and then modified in memory.
-    The graph is not saved back to the database.
+    Checks the If-None-Match header of the request against the given ETags.
     '''
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    received_etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+    return "*" in received_etags or any(etag in received_etags for etag in etags)
 
-    # if request.is_json:
-    #     logger.debug(f"Request body: {request.get_json()}")
-    #     args = request.get_json()
-    # else:
-    #     logger.debug(f"Request arguments: {request.args}")
-    #     args = request.args.to_dict()
-    # sparql_query = args.get('query')
-    # if not sparql_query:
-    #     return Response("Missing query parameter", status=400)
-    
-    # try:
-    #     # Retrieve the graph data as in get_graph
-    #     json_ld_data = get_raw_graph_from_db()
-    #     graph = utils.semantic.get_graph_from_json(json_ld_data)
-        
-    #     # Execute the SPARQL query using the semantic utils module on the retrieved graph
-    #     query_result = utils.semantic.execute_sparql_query(graph, sparql_query)
-    #     # TODO: not so simple to parse "any" query result, but we could return the raw result
-    #     result = query_result.serialize()
-    #     return Response(result, status=200)
-    # except Exception as e:
-    #     return Response(f"Error executing SPARQL query: {str(e)}", status=500)
+def accepts_encoding(request: Request, encoding: str) -> bool:
+    '''
+    Checks whether the Accept-Encoding header of the request accepts the given content coding
+    (named or through '*') with a non-zero quality value.
+    '''
+    qualities = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, *parameters = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities.get(encoding, qualities.get("*", 0.0)) > 0
 
 @app.get('/graph')
-async def get_graph(user: Annotated[User, Depends(validate_token)], request: Request):
+async def get_graph(user: Annotated[User, Depends(validate_token)], request: Request, as_of: datetime = None):
     logger.info(f"Received request for graph from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
     if not (Role.AUDITOR.value in user.roles or Role.ADMIN.value in user.roles):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="User does not have permission to perform this action"
         )
-    json_ld_data = None
-    turtle_data = None
     try:
-        json_ld_data = get_raw_graph_from_db()
-        if not json_ld_data:
+        if as_of is not None:
+            return await get_graph_as_of_response(as_of)
+        version = await get_graph_version()
+        if version is not None and etag_matches(request, [f'"{version}"', f'"{version}-gzip"']):
+            logger.info("Graph not modified since the last download")
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": f'"{version}"'})
+        snapshot = await get_turtle_snapshot()
+        if snapshot is None or snapshot.triples == 0:
             raise HTTPException(
                 status_code=status.HTTP_204_NO_CONTENT,
                 detail="Empty graph"
             )
         else:
-            graph = utils.semantic.get_graph_from_json(json_ld_data)
-            turtle_data = utils.semantic.convert_graph_to_turtle(graph)
+            headers = {
+                "Content-Disposition": "attachment; filename=graph.ttl",
+                "ETag": f'"{snapshot.version}"',
+                "Vary": "Accept-Encoding"
+            }
+            content = snapshot.turtle
+            if accepts_encoding(request, "gzip"):
+                content = await run_blocking(lambda: snapshot.gzipped)
+                headers["Content-Encoding"] = "gzip"
+                headers["ETag"] = f'"{snapshot.version}-gzip"'
             logger.info("Graph retrieved successfully")
-            response = PlainTextResponse(content=turtle_data)
-            response.headers["Content-Type"] = "text/turtle; charset=utf-8"
-            response.headers["Content-Disposition"] = "attachment; filename=graph.ttl"
-            response.status_code = status.HTTP_200_OK
-            return response
+            return Response(
+                content=content,
+                media_type="text/turtle; charset=utf-8",
+                headers=headers,
+                status_code=status.HTTP_200_OK
+            )
     except HTTPException as e:
         logger.error(f"HTTPException: {e.detail}")
         raise e
-    except:
+    except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Internal Server Error: Error retrieving graph. Error details -> {str(e)}"
         )
 
+async def get_graph_as_of_response(as_of: datetime) -> Response:
+    '''
+    Builds the response with the graph as it was at the given date (rebuilt from the history).
+    '''
+    logger.info(f"Rebuilding graph as of {as_of.isoformat()}")
+    graph = await get_graph_as_of(as_of)
+    if len(graph) == 0:
+        raise HTTPException(
+            status_code=status.HTTP_204_NO_CONTENT,
+            detail="Empty graph"
+        )
+    turtle_data = await run_blocking(utils.semantic.convert_graph_to_turtle, graph)
+    logger.info(f"Graph as of {as_of.isoformat()} retrieved successfully ({len(graph)} triples)")
+    return Response(
+        content=turtle_data,
+        media_type="text/turtle; charset=utf-8",
+        headers={"Content-Disposition": "attachment; filename=graph.ttl"},
+        status_code=status.HTTP_200_OK
+    )
+
 @app.delete('/graph')
 async def delete_graph(user: Annotated[User, Depends(validate_token)], request: Request):
     logger.info(f"Received request to delete graph from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
@@ -271,12 +537,12 @@ async def delete_graph(user: Annotated[User, Depends(validate_token)], request:
             detail="User does not have permission to perform this action"
         )
     origin_ip = request.client.host
-    json_ld_data = get_raw_graph_from_db()
-    if not json_ld_data:
+    graph = await get_graph_from_db()
+    if len(graph) == 0:
         logger.info("Empty graph, nothing to delete")
         return PlainTextResponse(content="Empty graph, nothing to delete", status_code=status.HTTP_204_NO_CONTENT)
     try:
-        deleted = clear_graph(ip_addr=origin_ip, user_details=str(user))
+        deleted = await clear_graph(ip_addr=origin_ip, user_details=str(user), username=user.username)
         if not deleted:
             logger.error(f"Failed to delete the graph")
             raise Exception("Failed to delete the graph")
@@ -289,28 +555,23 @@ async def delete_graph(user: Annotated[User, Depends(validate_token)], request:
         logger.info("Graph deleted successfully")
         return PlainTextResponse(content="Graph deleted successfully")
 
-def generate_response_with_all_experiments_in_json():
+async def generate_response_with_all_experiments_in_json():
     '''
     Get the list of experiments from the graph.
     The response is a JSON file with the experiment URIs.
-    The JSON file is generated using a SPARQL query.
+    The list is read from the experiment index maintained on every insertion.
     '''
     logger.info(f"Received request to get the list of experiments")
     try:
-        json_ld_data = get_raw_graph_from_db()
-        graph = utils.semantic.get_graph_from_json(json_ld_data)
-        result = utils.experiments.get_experiment_list(graph)
-        logger.debug(f"Experiment list as JSON: {result}")
-        # Check if the bindings in the result are empty
-        result_json = json.loads(result.decode('utf-8'))
-        if len(result_json['results']['bindings']) == 0:
+        uris_list = await get_experiment_uris()
+        logger.debug(f"Experiment list: {uris_list}")
+        if len(uris_list) == 0:
             logger.info("No experiments found")
             return PlainTextResponse(
                 content="No experiments found",
                 status_code=status.HTTP_204_NO_CONTENT)
         else:
-            logger.info(f"Graph retrieved successfully. Returning the experiment list as JSON.")
-            uris_list = [binding["experiment_uri"]["value"] for binding in result_json["results"]["bindings"]]
+            logger.info(f"Experiment list retrieved successfully. Returning the experiment list as JSON.")
             return JSONResponse(
                 content=uris_list,
                 media_type="application/json",
@@ -328,7 +589,8 @@ def generate_response_with_all_experiments_in_json():
         )
 
 @app.get('/experiments')
-async def get_experiments(user: Annotated[User, Depends(validate_token)], request: Request, uri: str = None, namespace: str = None, experiment_id: str = None):
+async def get_experiments(user: Annotated[User, Depends(validate_token)], request: Request, uri: str = None, namespace: str = None, experiment_id: str = None,
+                          format: Literal["turtle", "nt"] = "turtle", stream: bool = False):
     logger.info(f"Received request to get a specific experiment from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
     if not (Role.AUDITOR.value in user.roles or Role.ADMIN.value in user.roles):
         raise HTTPException(
@@ -355,7 +617,7 @@ async def get_experiments(user: Annotated[User, Depends(validate_token)], reques
         if not namespace and not experiment_id:
             logger.info("No URI, namespace or experiment_id provided")
             logger.info("Returning the list of experiments")
-            return generate_response_with_all_experiments_in_json()
+            return await generate_response_with_all_experiments_in_json()
         logger.info(f"Requested the following experiment -> {namespace}{experiment_id}")
         if not namespace or not experiment_id:
             logger.info("Missing parameters: namespace or experiment_id")
@@ -363,11 +625,31 @@ async def get_experiments(user: Annotated[User, Depends(validate_token)], reques
                 status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                 detail="Missing parameters: namespace or experiment_id"
             )
+    if stream and format != "nt":
+        logger.info("Streaming requested without format=nt")
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Streaming is only available in N-Triples format (format=nt)"
+        )
     try:
-        json_ld_data = get_raw_graph_from_db()
-        graph = utils.semantic.get_graph_from_json(json_ld_data)
-        result_graph = utils.experiments.get_single_experiment_graph(graph, namespace, experiment_id)
-        if len(result_graph) == 0:
+        if stream:
+            # The triples are serialized in chunks as they are read, the experiment graph is never built
+            subjects = await get_experiment_subjects(f"{namespace}{experiment_id}")
+            if subjects is None:
+                logger.info(f"Experiment not found: {namespace}{experiment_id}")
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Experiment not found: {namespace}{experiment_id}"
+                )
+            logger.info("Streaming experiment as N-Triples")
+            return StreamingResponse(
+                iterate_subjects_nt(subjects),
+                media_type="application/n-triples",
+                headers={"Content-Disposition": "attachment; filename=graph.nt"},
+                status_code=status.HTTP_200_OK
+            )
+        result_graph = await get_experiment_graph_from_db(f"{namespace}{experiment_id}")
+        if result_graph is None or len(result_graph) == 0:
             logger.info(f"Experiment not found: {namespace}{experiment_id}")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -375,10 +657,10 @@ async def get_experiments(user: Annotated[User, Depends(validate_token)], reques
             )
         logger.info("Experiment retrieved successfully")    
         response = PlainTextResponse(
-            content=result_graph.serialize(format="turtle", encoding="utf-8"),
+            content=await run_blocking(result_graph.serialize, format=format, encoding="utf-8"),
             headers={
-            "Content-Disposition": "attachment; filename=graph.ttl",
-            "Content-Type": "text/turtle; charset=utf-8"
+            "Content-Disposition": f"attachment; filename=graph.{'nt' if format == 'nt' else 'ttl'}",
+            "Content-Type": f"{'application/n-triples' if format == 'nt' else 'text/turtle'}; charset=utf-8"
             },
             status_code=status.HTTP_200_OK
         )
@@ -393,5 +675,114 @@ async def get_experiments(user: Annotated[User, Depends(validate_token)], reques
             detail=f"Internal Server Error: Error retrieving experiment. Error details -> {str(e)}"
         )
 
+@app.get('/experiments/stats')
+async def get_experiments_stats(user: Annotated[User, Depends(validate_token)], request: Request, uri: str = None):
+    logger.info(f"Received request to get experiment statistics from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
+    if not (Role.AUDITOR.value in user.roles or Role.ADMIN.value in user.roles):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not have permission to perform this action"
+        )
+    try:
+        # The statistics are kept up to date on every insertion, the graph is not queried
+        stats = await get_experiment_stats(uri)
+        if uri and len(stats) == 0:
+            logger.info(f"Experiment not found: {uri}")
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Experiment not found: {uri}"
+            )
+        if len(stats) == 0:
+            logger.info("No experiments found")
+            return PlainTextResponse(content="No experiments found", status_code=status.HTTP_204_NO_CONTENT)
+        for experiment_stats in stats:
+            for field in ("started_at", "ended_at"):
+                if experiment_stats[field] is not None:
+                    experiment_stats[field] = experiment_stats[field].isoformat()
+        logger.info(f"Statistics of {len(stats)} experiments retrieved successfully")
+        return JSONResponse(
+            content=stats[0] if uri else stats,
+            media_type="application/json",
+            status_code=status.HTTP_200_OK
+        )
+    except HTTPException as e:
+        logger.error(f"HTTPException: {e.detail}")
+        raise e
+    except Exception as e:
+        logger.error(f"Error retrieving experiment statistics: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal Server Error: Error retrieving experiment statistics. Error details -> {str(e)}"
+        )
+
+async def generate_experiments_nquads(experiments_subjects: dict):
+    '''
+    Yields the N-Quads of every experiment in its own named graph (the experiment URI).
+    The triples of each batch of experiments are read at once and serialized in the parser processes
+    when they are enabled (one experiment per task), otherwise in the executor.
+    '''
+    loop = asyncio.get_running_loop()
+    pool = get_parser_pool()
+    experiment_uris = list(experiments_subjects)
+    for start in range(0, len(experiment_uris), EXPERIMENT_EXPORT_BATCH_SIZE):
+        batch = experiment_uris[start:start + EXPERIMENT_EXPORT_BATCH_SIZE]
+        subjects = sorted({subject for experiment_uri in batch for subject in experiments_subjects[experiment_uri]})
+        subjects_triples = await get_subjects_n3_triples(subjects)
+        tasks = []
+        for experiment_uri in batch:
+            triples = [triple for subject in experiments_subjects[experiment_uri] for triple in subjects_triples.get(subject, [])]
+            if pool is None:
+                tasks.append(run_blocking(utils.semantic.convert_n3_triples_to_nquads, triples, experiment_uri))
+            else:
+                tasks.append(loop.run_in_executor(pool, utils.semantic.convert_n3_triples_to_nquads, triples, experiment_uri))
+        for task in tasks:
+            yield await task
+        logger.debug(f"Exported {start + len(batch)} of {len(experiment_uris)} experiments")
+
+@app.get('/experiments/export')
+async def export_experiments(user: Annotated[User, Depends(validate_token)], request: Request, uri: Annotated[list[str], Query()]):
+    logger.info(f"Received request to export experiments from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
+    if not (Role.AUDITOR.value in user.roles or Role.ADMIN.value in user.roles):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not have permission to perform this action"
+        )
+    try:
+        if "all" in uri:
+            logger.info("Exporting all the experiments")
+            experiments_subjects = await get_experiments_subjects()
+        else:
+            experiment_uris = list(dict.fromkeys(uri))
+            logger.info(f"Exporting {len(experiment_uris)} experiments")
+            experiments_subjects = await get_experiments_subjects(experiment_uris)
+            missing = [experiment_uri for experiment_uri in experiment_uris if experiment_uri not in experiments_subjects]
+            if missing:
+                logger.info(f"Experiments not found: {missing}")
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Experiments not found: {', '.join(missing)}"
+                )
+            # Keep the requested order
+            experiments_subjects = {experiment_uri: experiments_subjects[experiment_uri] for experiment_uri in experiment_uris}
+        if len(experiments_subjects) == 0:
+            logger.info("No experiments found")
+            return PlainTextResponse(content="No experiments found", status_code=status.HTTP_204_NO_CONTENT)
+        logger.info(f"Streaming {len(experiments_subjects)} experiments as N-Quads")
+        return StreamingResponse(
+            generate_experiments_nquads(experiments_subjects),
+            media_type="application/n-quads",
+            headers={"Content-Disposition": "attachment; filename=experiments.nq"},
+            status_code=status.HTTP_200_OK
+        )
+    except HTTPException as e:
+        logger.error(f"HTTPException: {e.detail}")
+        raise e
+    except Exception as e:
+        logger.error(f"Error exporting experiments: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal Server Error: Error exporting experiments. Error details -> {str(e)}"
+        )
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=5000, proxy_headers=True, log_config='./log_conf.yaml')
\ No newline at end of file
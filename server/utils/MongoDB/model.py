@@ -1,8 +1,18 @@
-from mongoengine import Document, DynamicField, DateTimeField, StringField, ValidationError, connect, get_db, ReferenceField, ObjectIdField
-from datetime import datetime
+from mongoengine import Document, DynamicField, DateTimeField, StringField, ValidationError, connect, get_db, ReferenceField, ObjectIdField, ListField, BinaryField, FileField, IntField, DictField, BooleanField, Q
+from datetime import datetime, timedelta
 import utils.semantic
+import utils.experiments
+from utils.graph_cache import GraphCache, SnapshotCache, TurtleSnapshot
+from utils.compact_store import get_compact_graph
 import hashlib
+import base64
+import zlib
 from bson import ObjectId
+from threading import Lock
+from pymongo import ReturnDocument, UpdateOne
+from rdflib.util import from_n3
+from itertools import islice
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 import logging
 import os
@@ -11,26 +21,173 @@ logger = logging.getLogger("segb.server.model")
 
 logger.info("Loading module model...")
 
+# 'document' keeps the whole graph as JSON-LD in a single Graph document (legacy layout)
+# 'triples' stores one document per triple and keeps only the prefixes in the Graph document
+GRAPH_STORAGE = os.getenv("GRAPH_STORAGE", "document").lower()
+logger.info(f"Graph storage layout: {GRAPH_STORAGE}")
+
+# Parsed graphs with more triples than this are not kept in memory (0 disables the cache)
+GRAPH_CACHE_MAX_TRIPLES = int(os.getenv("GRAPH_CACHE_MAX_TRIPLES", "1000000"))
+graph_cache = GraphCache(max_triples=GRAPH_CACHE_MAX_TRIPLES)
+# Keep the cached graph in the read-optimized compact store instead of the default rdflib store
+GRAPH_CACHE_COMPACT = os.getenv("GRAPH_CACHE_COMPACT", "true").lower() == "true"
+# Turtle serializations bigger than this (in bytes) are not kept in memory (0 disables the cache)
+GRAPH_SNAPSHOT_MAX_BYTES = int(os.getenv("GRAPH_SNAPSHOT_MAX_BYTES", str(256 * 1024 * 1024)))
+snapshot_cache = SnapshotCache(max_bytes=GRAPH_SNAPSHOT_MAX_BYTES)
+# Concurrent requests missing the caches wait for a single parse/serialization instead of repeating it
+graph_load_lock = Lock()
+snapshot_build_lock = Lock()
+
+# Triples serialized together when an experiment is streamed as N-Triples
+EXPERIMENT_STREAM_CHUNK_TRIPLES = int(os.getenv("EXPERIMENT_STREAM_CHUNK_TRIPLES", "1000"))
+
+# zlib level used to compress the TTL stored in the history (Insertion and Deletion documents)
+HISTORY_COMPRESSION_LEVEL = int(os.getenv("HISTORY_COMPRESSION_LEVEL", "6"))
+# Compressed deletion dumps bigger than this (in bytes) are stored in GridFS chunks
+DELETION_GRIDFS_THRESHOLD = int(os.getenv("DELETION_GRIDFS_THRESHOLD", str(4 * 1024 * 1024)))
+# A checkpoint of the graph is stored every this many insertions (0 disables the checkpoints)
+GRAPH_CHECKPOINT_INTERVAL = int(os.getenv("GRAPH_CHECKPOINT_INTERVAL", "1000"))
+checkpoint_lock = Lock()
+# Times a checkpoint reads the graph again when it changed while it was being read
+GRAPH_CHECKPOINT_ATTEMPTS = 3
+# Writes of triples started this many seconds ago and not finished are considered abandoned by the checkpoints
+GRAPH_WRITE_TIMEOUT = int(os.getenv("GRAPH_WRITE_TIMEOUT", "300"))
+# Collection where the legacy graph is migrated before it replaces the Triple collection, and triples written at once
+MIGRATION_COLLECTION = "triple_migration"
+MIGRATION_CHUNK_TRIPLES = 10000
+# Queued logs claimed by a worker that did not finish them in this many seconds are claimed again
+INGEST_QUEUE_CLAIM_TIMEOUT = int(os.getenv("INGEST_QUEUE_CLAIM_TIMEOUT", "300"))
+
 # ------------ DOCUMENTS DEFINITION ------------ #
 
 class Graph(Document):
     _id = StringField(primary_key=True)
     updated_at = DateTimeField()
+    # Changes on every write (unique, unlike updated_at, even after clearing the graph)
+    version = ObjectIdField()
+    sequence = IntField() # number of writes since the graph was created (incremented with every write)
+    pending_writes = DictField() # start date of the writes of triples in progress, by write ID
     graph_data = DynamicField (required=True)
+    migration = StringField() # set while the legacy graph is moved to the Triple collection
 
     def clean(self):
         if not isinstance(self.graph_data, dict):
             raise ValidationError("'graph' field must be a document in JSON format")
         
+class Triple(Document):
+    _id = StringField(primary_key=True) # hash of the N3 serialization of the triple
+    subject = StringField(required=True)
+    predicate = StringField(required=True)
+    object = StringField(required=True)
+    meta = {
+        'indexes': ['subject', 'predicate', 'object']
+    }
+
+class ExperimentIndex(Document):
+    _id = StringField(primary_key=True) # URI of an amor-exp:Experiment
+    indexed_at = DateTimeField()
+
+class ActivityIndex(Document):
+    _id = StringField(primary_key=True) # N3 of the activity
+    experiments = ListField(StringField()) # amor-exp:isRelatedWithExperiment (URIs)
+    messages = ListField(StringField()) # oro:hasMessage (N3)
+    agents = ListField(StringField()) # segb:wasPerformedBy (N3)
+    started_at = DateTimeField() # earliest prov:startedAtTime
+    ended_at = DateTimeField() # latest prov:endedAtTime
+    logged = BooleanField() # typed as segb:LoggedActivity
+    meta = {
+        'indexes': ['experiments']
+    }
+
+class ExperimentStats(Document):
+    _id = StringField(primary_key=True) # URI of the experiment
+    activities = IntField(default=0) # segb:LoggedActivity related with the experiment
+    messages = IntField(default=0) # oro:hasMessage links of its activities
+    agents = ListField(StringField()) # segb:wasPerformedBy of its activities (N3)
+    started_at = DateTimeField() # earliest prov:startedAtTime of its activities
+    ended_at = DateTimeField() # latest prov:endedAtTime of its activities
+
+def compress_text(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8"), HISTORY_COMPRESSION_LEVEL)
+
+def decompress_text(data: bytes) -> str:
+    return zlib.decompress(data).decode("utf-8")
+
+class DeletedGraphWriter:
+    '''
+        File-like object that compresses the TTL of a deleted graph while it is serialized.
+        The compressed data is kept in memory until it is bigger than DELETION_GRIDFS_THRESHOLD,
+        and is written to the GridFS file of the deletion from then on.
+    '''
+    def __init__(self, deletion: "Deletion"):
+        self.deletion = deletion
+        self.compressor = zlib.compressobj(HISTORY_COMPRESSION_LEVEL)
+        self.buffer = bytearray()
+        self.in_gridfs = False
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self._store(self.compressor.compress(data))
+        return len(data)
+
+    def _store(self, compressed_data: bytes):
+        self.size += len(compressed_data)
+        if self.in_gridfs:
+            self.deletion.ttl_deleted_graph_file.write(compressed_data)
+            return
+        self.buffer += compressed_data
+        if len(self.buffer) > DELETION_GRIDFS_THRESHOLD:
+            logger.debug("Storing deleted graph in GridFS")
+            self.deletion.ttl_deleted_graph_file.new_file(content_type="application/zlib")
+            self.deletion.ttl_deleted_graph_file.write(bytes(self.buffer))
+            self.buffer = bytearray()
+            self.in_gridfs = True
+
+    def close(self):
+        self._store(self.compressor.flush())
+        if self.in_gridfs:
+            self.deletion.ttl_deleted_graph_file.close()
+        else:
+            self.deletion.ttl_deleted_graph_compressed = bytes(self.buffer)
+        logger.debug(f"Deleted graph compressed to {self.size} bytes")
+
+    def discard(self):
+        if self.in_gridfs:
+            self.deletion.ttl_deleted_graph_file.delete()
+
 class Insertion (Document):
     _id = ObjectIdField(primary_key=True)
     log = ReferenceField('Log', required=True)
-    ttl_content = StringField(required=True)
+    ttl_content = StringField() # uncompressed TTL (insertions stored before compression was introduced)
+    ttl_compressed = BinaryField()
+    content_format = StringField(default='turtle', choices=list(utils.semantic.RDF_MEDIA_TYPES.values())) # rdflib format of the content
+
+    def clean(self):
+        if self.ttl_content is None and self.ttl_compressed is None:
+            raise ValidationError("Either 'ttl_content' or 'ttl_compressed' is required")
+
+    def get_ttl_content(self) -> str:
+        if self.ttl_compressed is not None:
+            return decompress_text(self.ttl_compressed)
+        return self.ttl_content
     
 class Deletion (Document):
     _id = ObjectIdField(primary_key=True)
     log = ReferenceField('Log', required=True)
-    ttl_deleted_graph = StringField(required=True) 
+    ttl_deleted_graph = StringField() # uncompressed TTL (deletions stored before compression was introduced)
+    ttl_deleted_graph_compressed = BinaryField()
+    ttl_deleted_graph_file = FileField(collection_name='deletion_fs') # compressed TTL, for big graphs
+
+    def clean(self):
+        if self.ttl_deleted_graph is None and self.ttl_deleted_graph_compressed is None and not self.ttl_deleted_graph_file:
+            raise ValidationError("The deleted graph is required")
+
+    def get_ttl_deleted_graph(self) -> str:
+        if self.ttl_deleted_graph_file:
+            return decompress_text(self.ttl_deleted_graph_file.read())
+        if self.ttl_deleted_graph_compressed is not None:
+            return decompress_text(self.ttl_deleted_graph_compressed)
+        return self.ttl_deleted_graph
     
 class Log (Document):
     _id = ObjectIdField(primary_key=True)
@@ -40,6 +197,50 @@ class Log (Document):
     action_type = StringField(required=True, choices=['insertion', 'deletion'])
     action = ObjectIdField (required=True)
     user_details = StringField () # decoded token data (username, roles, etc.)
+    username = StringField ()
+    graph_sequence = IntField () # sequence of the graph write that stored its triples (insertions)
+    meta = {
+        # Serve the paginated history (newest first) and its filters
+        'indexes': [
+            ('-uploaded_at', '-_id'),
+            ('action_type', '-uploaded_at', '-_id'),
+            ('username', '-uploaded_at', '-_id'),
+        ]
+    }
+
+class GraphCheckpoint (Document):
+    _id = ObjectIdField(primary_key=True)
+    taken_at = DateTimeField(required=True) # date the graph was read
+    graph_sequence = IntField() # sequence of the last graph write included in the checkpoint
+    last_log = ObjectIdField() # last log included (checkpoints taken before the graph sequence was introduced)
+    triples = IntField()
+    ttl_graph_file = FileField(collection_name='checkpoint_fs', required=True) # compressed TTL
+    meta = {
+        'indexes': [
+            ('-taken_at', '-_id'),
+        ]
+    }
+
+class QueuedLog (Document):
+    _id = ObjectIdField(primary_key=True) # ID of the log that will register it in the history
+    received_at = DateTimeField(required=True)
+    origin_ip = StringField (required=True)
+    user_details = StringField ()
+    username = StringField ()
+    ttl_compressed = BinaryField(required=True)
+    content_format = StringField(default='turtle', choices=list(utils.semantic.RDF_MEDIA_TYPES.values()))
+    claimed_at = DateTimeField() # set while a worker is ingesting it
+    write_id = StringField() # graph write that ingests it ('document' layout), it was applied once no longer pending
+    graph_sequence = IntField() # sequence of that write, if it was applied but could not be logged
+    error = StringField() # set if it could not be ingested (it is kept for inspection)
+    meta = {
+        'collection': 'ingest_queue',
+        'indexes': [
+            ('error', 'claimed_at', '_id'),
+        ]
+    }
+
+LOG_FIELDS = ["_id", "uploaded_at", "origin_ip", "action_type", "action", "user_details", "username"]
 
 
 def serialize_log(log) -> dict:
@@ -50,8 +251,34 @@ def serialize_log(log) -> dict:
         "action_type": log.action_type,
         "action": str(log.action) if log.action else None,
         "user_details": log.user_details if log.user_details else None,
+        "username": log.username if log.username else None,
     }
 
+def encode_history_cursor(log) -> str:
+    return base64.urlsafe_b64encode(f"{log.uploaded_at.isoformat()}|{log._id}".encode("utf-8")).decode("ascii")
+
+def decode_history_cursor(cursor: str) -> tuple:
+    uploaded_at, log_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+    return datetime.fromisoformat(uploaded_at), ObjectId(log_id)
+
+
+def triple_id(subject: str, predicate: str, obj: str) -> str:
+    return hashlib.sha1(f"{subject} {predicate} {obj}".encode("utf-8")).hexdigest()
+
+def insert_many_ignoring_duplicates(collection, documents: list) -> int:
+    '''
+        Inserts the documents, skipping the ones whose _id is already stored.
+        Returns the number of skipped documents.
+    '''
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+        if errors:
+            raise
+        return len(e.details.get("writeErrors", []))
+    return 0
+
 
 def connect_to_db(db_service: str) -> None:
     logger.info("Connecting to the database...")
@@ -61,29 +288,190 @@ def connect_to_db(db_service: str) -> None:
     
 # ------------ INSERT FUNCTIONS ------------ #
     
-def save_json_ld(json_ld_data:dict) -> None:
+def save_json_ld(graph, write_id: str = None) -> tuple:
     logger.debug(f"Saving JSON-LD data to the database")
-    graph = Graph.objects(_id='0').first()
-    logger.debug(f"Graph found")
-    if graph:
-        json_ld_data = utils.semantic.update_prefixes(graph.graph_data, json_ld_data)
-        json_ld_data = utils.semantic.update_graph(graph.graph_data, json_ld_data)
-        logger.debug(f"Graph ready to be saved")
-        graph.update(
-            set__graph_data=json_ld_data,
-            set__updated_at=datetime.now()
-        )
-        logger.debug(f"Graph updated")
-    else:
-        graph = Graph (
-           _id = '0',
-           updated_at = datetime.now(),
-           graph_data = json_ld_data
-        )
-    graph.save()
+    versions = merge_graph_document(
+        context={prefix: str(uri) for prefix, uri in graph.namespaces()},
+        graph=graph,
+        write_id=write_id
+    )
     logger.debug(f"Graph saved")
+    return versions
+
+def save_triples(graph) -> tuple:
+    logger.debug(f"Saving triples to the database")
+    triples = [
+        {"_id": triple_id(s, p, o), "subject": s, "predicate": p, "object": o}
+        for s, p, o in utils.semantic.convert_graph_to_n3_triples(graph)
+    ]
+    # The triples are stored before the graph version changes: checkpoints do not read the graph meanwhile
+    write_id = str(ObjectId())
+    Graph._get_collection().update_one({"_id": "0"}, {"$set": {f"pending_writes.{write_id}": datetime.now()}}, upsert=True)
+    try:
+        if triples:
+            # Triples already stored share the same _id and are skipped
+            skipped = insert_many_ignoring_duplicates(Triple._get_collection(), triples)
+            if skipped:
+                logger.debug(f"{skipped} triples already stored")
+    except Exception:
+        Graph._get_collection().update_one({"_id": "0"}, {"$unset": {f"pending_writes.{write_id}": ""}})
+        raise
+    prefixes = {prefix: str(uri) for prefix, uri in graph.namespaces()}
+    versions = merge_graph_document(context=prefixes, write_id=write_id)
+    logger.debug(f"Triples saved")
+    return versions
+
+def start_graph_write() -> str:
+    '''
+        Marks a write of the graph as pending and returns its ID, it is finished by the write itself (see save_graph).
+        A write ID that is no longer pending was applied, so a write can be recorded before it is done and not repeated.
+    '''
+    write_id = str(ObjectId())
+    Graph._get_collection().update_one({"_id": "0"}, {"$set": {f"pending_writes.{write_id}": datetime.now()}}, upsert=True)
+    return write_id
+
+def get_pending_graph_writes() -> set:
+    graph = Graph._get_collection().find_one({"_id": "0"}, {"pending_writes": 1}) or {}
+    return set(graph.get("pending_writes") or {})
 
-def log_ttl_content(ttl:str, ip_addr:str, user_details: str) -> None:
+def save_graph(graph, write_id: str = None) -> int:
+    '''
+        Adds the triples of the graph to the stored graph.
+        In the 'document' layout, the pending write 'write_id' (see start_graph_write) is finished with the same update.
+        Returns the sequence of the graph write that contains them (to be recorded in their logs).
+    '''
+    if GRAPH_STORAGE == "triples":
+        # Triples already stored are skipped by their _id
+        previous_version, version, sequence = save_triples(graph)
+    else:
+        current_graph = graph_cache.get(get_graph_version())
+        if current_graph is not None:
+            # Skip the triples already stored (only possible while the cached graph is up to date)
+            graph = utils.semantic.get_new_triples(graph, current_graph)
+            logger.debug(f"{len(graph)} new triples to be saved")
+            if len(graph) == 0:
+                logger.debug(f"All triples already stored, nothing to save")
+                if write_id:
+                    Graph._get_collection().update_one({"_id": "0"}, {"$unset": {f"pending_writes.{write_id}": ""}})
+                return (get_graph_state() or {}).get("sequence")
+        previous_version, version, sequence = save_json_ld(graph=graph, write_id=write_id)
+    graph_cache.update(previous_version, version, graph)
+    index_experiments(graph)
+    return sequence
+
+def index_experiments(graph) -> None:
+    '''
+        Adds the experiments, activities and messages of the new triples to the experiment index
+        and updates the statistics of the experiments they belong to.
+    '''
+    experiments, activities = utils.experiments.get_experiment_index_entries(graph)
+    if experiments:
+        ExperimentIndex._get_collection().bulk_write([
+            UpdateOne({"_id": experiment}, {"$setOnInsert": {"indexed_at": datetime.now()}}, upsert=True)
+            for experiment in experiments
+        ], ordered=False)
+    if not activities:
+        logger.debug(f"Experiment index updated: {len(experiments)} experiments, no activities")
+        return
+    stats_updates = []
+    for activity, links in activities.items():
+        update = {"$addToSet": {
+            "experiments": {"$each": sorted(links["experiments"])},
+            "messages": {"$each": sorted(links["messages"])},
+            "agents": {"$each": sorted(links["agents"])}
+        }}
+        if links["logged"]:
+            update["$set"] = {"logged": True}
+        if links["started_at"] is not None:
+            update["$min"] = {"started_at": links["started_at"]}
+        if links["ended_at"] is not None:
+            update["$max"] = {"ended_at": links["ended_at"]}
+        # The entry before this update is returned by the same atomic operation, so every link is counted
+        # by exactly one insertion even if several processes index the same activity concurrently
+        indexed_activity = ActivityIndex._get_collection().find_one_and_update(
+            {"_id": activity}, update, upsert=True, return_document=ReturnDocument.BEFORE
+        ) or {}
+        stats_updates.extend(get_experiment_stats_updates(indexed_activity, links))
+    if stats_updates:
+        ExperimentStats._get_collection().bulk_write(stats_updates, ordered=False)
+    logger.debug(f"Experiment index updated: {len(experiments)} experiments, {len(activities)} activities")
+
+def get_experiment_stats_updates(indexed_activity: dict, links: dict) -> list:
+    '''
+        Returns the updates of the statistics of the experiments of an activity for the new index entry (links),
+        given its entry before it was updated (indexed_activity), so only what the update added is counted.
+        Only segb:LoggedActivity activities are counted: an experiment gets all the messages, agents and times
+        of an activity when it is first related with it as a logged activity, and only the new ones afterwards.
+    '''
+    was_logged = indexed_activity.get("logged", False)
+    if not (was_logged or links["logged"]):
+        return []
+    indexed_experiments = set(indexed_activity.get("experiments", []))
+    indexed_messages = set(indexed_activity.get("messages", []))
+    all_messages = links["messages"] | indexed_messages
+    all_agents = sorted(links["agents"].union(indexed_activity.get("agents", [])))
+    times = {"$min": {"started_at": links["started_at"]}, "$max": {"ended_at": links["ended_at"]}}
+    all_times = {
+        "$min": {"started_at": min(filter(None, (links["started_at"], indexed_activity.get("started_at"))), default=None)},
+        "$max": {"ended_at": max(filter(None, (links["ended_at"], indexed_activity.get("ended_at"))), default=None)}
+    }
+    updates = []
+    for experiment in links["experiments"] | indexed_experiments:
+        if was_logged and experiment in indexed_experiments:
+            update = {"$inc": {"messages": len(all_messages - indexed_messages)}, "$addToSet": {"agents": {"$each": sorted(links["agents"])}}}
+            update.update({operator: value for operator, value in times.items() if None not in value.values()})
+        else:
+            update = {"$inc": {"activities": 1, "messages": len(all_messages)}, "$addToSet": {"agents": {"$each": all_agents}}}
+            update.update({operator: value for operator, value in all_times.items() if None not in value.values()})
+        updates.append(UpdateOne({"_id": experiment}, update, upsert=True))
+    return updates
+
+def merge_graph_document(context: dict, graph = None, write_id: str = None) -> tuple:
+    '''
+        Appends the triples of the graph as '@graph' nodes and adds the prefixes not yet present in the '@context'
+        of the Graph document (existing prefixes are kept), creating it if needed.
+        The nodes are compacted with the stored context read in the same attempt, so a prefix bound by the new
+        document to another IRI than the stored one is not used (its IRIs are written in full).
+        The nodes are appended with $push, so an insert costs the same whatever the size of the stored graph
+        (nodes repeated or sharing an '@id' with stored ones are merged later by compact_graph).
+        The context is only written when there are new prefixes, and only if it did not change since it was
+        read (otherwise it is read again), so concurrent inserts cannot overwrite each other.
+        The pending write 'write_id' (see save_triples) is finished with the same update.
+        Returns the versions of the graph before and after the update and the sequence of the update.
+    '''
+    collection = Graph._get_collection()
+    while True:
+        stored_graph = collection.find_one({"_id": "0"}, {"graph_data.@context": 1})
+        stored_context = (stored_graph or {}).get("graph_data", {}).get("@context")
+        version = ObjectId()
+        query = {"_id": "0"}
+        update = {"$set": {"updated_at": datetime.now(), "version": version}, "$inc": {"sequence": 1}}
+        if write_id:
+            update["$unset"] = {f"pending_writes.{write_id}": ""}
+        new_prefixes = {prefix: uri for prefix, uri in context.items() if prefix not in (stored_context or {})}
+        if graph is not None and len(graph):
+            nodes = utils.semantic.convert_graph_to_json_ld(graph, {**new_prefixes, **(stored_context or {})})["@graph"]
+            logger.debug(f"Graph converted to JSON-LD format")
+            update["$push"] = {"graph_data.@graph": {"$each": nodes}}
+        if new_prefixes or stored_context is None:
+            query["graph_data.@context"] = stored_context if stored_context is not None else {"$exists": False}
+            update["$set"]["graph_data.@context"] = {**(stored_context or {}), **new_prefixes}
+        try:
+            # If the context changed meanwhile the query does not match, and the upsert fails on the existing _id
+            previous_graph = collection.find_one_and_update(
+                query,
+                update,
+                projection={"version": 1, "sequence": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            logger.debug("Graph context modified by another insert, retrying...")
+            continue
+        previous_graph = previous_graph or {}
+        return previous_graph.get("version"), version, (previous_graph.get("sequence") or 0) + 1
+
+def log_ttl_content(ttl:str, ip_addr:str, user_details: str, username: str = None, content_format: str = "turtle", graph_sequence: int = None) -> bool:
     
     """
         Atomic Transaction 
@@ -107,14 +495,17 @@ def log_ttl_content(ttl:str, ip_addr:str, user_details: str) -> None:
             origin_ip = ip_addr,
             action_type = 'insertion',
             action = insertion_id,
-            user_details = user_details
+            user_details = user_details,
+            username = username,
+            graph_sequence = graph_sequence
         )
         log.save()        
         logger.debug(f"Log saved")
         insertion = Insertion (
         _id = insertion_id,
         log = log,
-        ttl_content = ttl
+        ttl_compressed = compress_text(ttl),
+        content_format = content_format
      )
         insertion.save()
         logger.debug(f"Insertion saved")
@@ -133,6 +524,232 @@ def log_ttl_content(ttl:str, ip_addr:str, user_details: str) -> None:
     
     
     
+def transactions_supported() -> bool:
+    # Multi-document transactions are only available on replica sets and sharded clusters
+    return get_db().client.topology_description.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+
+def log_ttl_batch(ttls: list, ip_addr: str, user_details: str, username: str = None, graph_sequence: int = None) -> list:
+    
+    """
+        Registers a Log/Insertion pair for every TTL document (see log_ttl_entries).
+        Returns the IDs of the logs (empty list if they could not be saved).
+    """
+    logger.debug(f"Logging batch of {len(ttls)} TTL documents")
+    logger.debug(f"Origin IP: {ip_addr}")
+    return log_ttl_entries([
+        {"ttl": ttl, "ip_addr": ip_addr, "user_details": user_details, "username": username, "graph_sequence": graph_sequence}
+        for ttl in ttls
+    ])
+
+def log_ttl_entries(entries: list) -> list:
+    
+    """
+        Atomic Transaction (when supported by the deployment)
+        Registers a Log/Insertion pair for every entry with a single insert_many per collection.
+        Every entry is a dict with 'ttl' (text or already compressed in 'ttl_compressed'), 'ip_addr',
+        'user_details', 'username' and optionally the 'content_format' (Turtle by default), the 'graph_sequence'
+        of the graph write that stored it and the 'log_id' to use.
+        Returns the IDs of the logs (empty list if they could not be saved).
+    """
+    uploaded_at = datetime.now()
+    logs = []
+    insertions = []
+    try:
+        for entry in entries:
+            log = Log (
+                _id = entry.get("log_id") or ObjectId(),
+                uploaded_at = uploaded_at,
+                origin_ip = entry["ip_addr"],
+                action_type = 'insertion',
+                action = ObjectId(),
+                user_details = entry.get("user_details"),
+                username = entry.get("username"),
+                graph_sequence = entry.get("graph_sequence")
+            )
+            log.validate()
+            logs.append(log.to_mongo())
+            insertion = Insertion (
+                _id = log.action,
+                log = log,
+                ttl_compressed = entry.get("ttl_compressed") or compress_text(entry["ttl"]),
+                content_format = entry.get("content_format") or "turtle"
+            )
+            insertion.validate()
+            insertions.append(insertion.to_mongo())
+    except ValidationError as ex:
+        logger.error(f"Error logging TTL batch: {ex}")
+        return []
+    
+    if not transactions_supported():
+        logger.debug(f"Transactions not supported by the database, logging batch without transaction")
+        # Without a transaction a previous attempt may have stored some of the documents, so they are skipped
+        try:
+            if insert_many_ignoring_duplicates(Log._get_collection(), logs):
+                # Logs stored by a previous attempt keep their insertion ID
+                stored_actions = {
+                    log["_id"]: log["action"]
+                    for log in Log._get_collection().find({"_id": {"$in": [log["_id"] for log in logs]}}, {"action": 1})
+                }
+                for insertion in insertions:
+                    insertion["_id"] = stored_actions[insertion["log"]]
+            insert_many_ignoring_duplicates(Insertion._get_collection(), insertions)
+            return [str(log["_id"]) for log in logs]
+        except Exception as ex:
+            logger.error(f"Error logging TTL batch: {ex}")
+            return []
+    
+    db = get_db()
+    session = db.client.start_session()
+    session.start_transaction()
+    logger.debug(f"Session started")
+    try:
+        Log._get_collection().insert_many(logs, session=session)
+        logger.debug(f"Logs saved")
+        Insertion._get_collection().insert_many(insertions, session=session)
+        logger.debug(f"Insertions saved")
+        session.commit_transaction()
+        return [str(log["_id"]) for log in logs]
+    
+    except Exception as ex:
+        logger.error(f"Error logging TTL batch: {ex}")
+        session.abort_transaction()
+        return []
+    finally:
+        session.end_session()
+        logger.debug(f"Session ended")
+
+# ------------ INGEST QUEUE FUNCTIONS ------------ #
+
+def enqueue_ttl_content(ttl: str, ip_addr: str, user_details: str, username: str = None, content_format: str = "turtle") -> str:
+    '''
+        Stores an already validated TTL document in the ingest queue.
+        Returns the ID of the log that will register it once it is ingested.
+    '''
+    queued_log = QueuedLog(
+        _id = ObjectId(),
+        received_at = datetime.now(),
+        origin_ip = ip_addr,
+        user_details = user_details,
+        username = username,
+        ttl_compressed = compress_text(ttl),
+        content_format = content_format
+    )
+    queued_log.save(force_insert=True)
+    logger.debug(f"TTL content queued with log ID: {queued_log._id}")
+    return str(queued_log._id)
+
+def claim_queued_logs(limit: int) -> list:
+    '''
+        Marks up to 'limit' queued logs (oldest first) as claimed by this worker and returns them.
+        Logs claimed more than INGEST_QUEUE_CLAIM_TIMEOUT seconds ago are considered abandoned.
+    '''
+    collection = QueuedLog._get_collection()
+    claimed = []
+    while len(claimed) < limit:
+        now = datetime.now()
+        queued_log = collection.find_one_and_update(
+            {
+                "error": None,
+                "$or": [
+                    {"claimed_at": None},
+                    {"claimed_at": {"$lt": now - timedelta(seconds=INGEST_QUEUE_CLAIM_TIMEOUT)}}
+                ]
+            },
+            {"$set": {"claimed_at": now}},
+            sort=[("_id", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if queued_log is None:
+            break
+        claimed.append(queued_log)
+    return claimed
+
+def process_ingest_queue(limit: int) -> int:
+    '''
+        Ingests up to 'limit' queued TTL documents into the graph with a single write,
+        registers them in the history with their pre-allocated log IDs and removes them from the queue.
+        Returns the number of processed documents.
+    '''
+    queued_logs = claim_queued_logs(limit)
+    if not queued_logs:
+        return 0
+    # Documents whose graph write was applied in an earlier attempt are only registered in the history
+    pending_writes = get_pending_graph_writes()
+    applied_logs = [
+        queued_log for queued_log in queued_logs
+        if queued_log.get("write_id") and queued_log["write_id"] not in pending_writes
+    ]
+    queued_logs = [queued_log for queued_log in queued_logs if queued_log not in applied_logs]
+    if queued_logs:
+        logger.debug(f"Ingesting {len(queued_logs)} queued TTL documents")
+        ttls = [
+            (decompress_text(queued_log["ttl_compressed"]), queued_log.get("content_format") or "turtle")
+            for queued_log in queued_logs
+        ]
+        try:
+            graph = utils.semantic.get_graph_from_documents(ttls)
+        except ValueError:
+            # They were validated when queued, so this should not happen: keep the invalid ones apart
+            valid_logs, valid_ttls = [], []
+            for queued_log, ttl in zip(queued_logs, ttls):
+                try:
+                    utils.semantic.get_graph_from_data(*ttl)
+                    valid_logs.append(queued_log)
+                    valid_ttls.append(ttl)
+                except Exception as e:
+                    logger.error(f"Queued log {queued_log['_id']} could not be ingested: {e}")
+                    QueuedLog._get_collection().update_one({"_id": queued_log["_id"]}, {"$set": {"error": str(e)}})
+            queued_logs, ttls = valid_logs, valid_ttls
+            graph = utils.semantic.get_graph_from_documents(ttls) if queued_logs else None
+    if queued_logs:
+        write_id = None
+        if GRAPH_STORAGE != "triples":
+            # Recorded before the write (which finishes it), since appending the nodes again would duplicate them;
+            # in the 'triples' layout the triples already stored are skipped by their _id
+            write_id = start_graph_write()
+            QueuedLog._get_collection().update_many(
+                {"_id": {"$in": [queued_log["_id"] for queued_log in queued_logs]}},
+                {"$set": {"write_id": write_id}}
+            )
+        graph_sequence = save_graph(graph, write_id=write_id)
+        # Writes of earlier attempts that failed before they were applied
+        abandoned_writes = {queued_log["write_id"] for queued_log in queued_logs if queued_log.get("write_id")}
+        if abandoned_writes:
+            Graph._get_collection().update_one({"_id": "0"}, {"$unset": {f"pending_writes.{abandoned_write}": "" for abandoned_write in abandoned_writes}})
+        for queued_log in queued_logs:
+            queued_log["graph_sequence"] = graph_sequence
+    if applied_logs:
+        logger.debug(f"{len(applied_logs)} queued TTL documents were already ingested")
+        # A later sequence than the one of the write only replays the document again on a checkpoint containing it
+        current_sequence = (get_graph_state() or {}).get("sequence")
+        for queued_log in applied_logs:
+            queued_log["graph_sequence"] = queued_log.get("graph_sequence") or current_sequence
+    queued_logs += applied_logs
+    if not queued_logs:
+        return 0
+    log_ids = log_ttl_entries([
+        {
+            "log_id": queued_log["_id"],
+            "ttl_compressed": queued_log["ttl_compressed"],
+            "content_format": queued_log.get("content_format"),
+            "ip_addr": queued_log["origin_ip"],
+            "user_details": queued_log.get("user_details"),
+            "username": queued_log.get("username"),
+            "graph_sequence": queued_log["graph_sequence"]
+        }
+        for queued_log in queued_logs
+    ])
+    if not log_ids:
+        # The claim expires and they are registered again, without repeating the graph write
+        for queued_log in queued_logs:
+            QueuedLog._get_collection().update_one({"_id": queued_log["_id"]}, {"$set": {"graph_sequence": queued_log["graph_sequence"]}})
+        logger.error(f"Queued logs could not be registered in the history, they will be retried")
+        return 0
+    QueuedLog._get_collection().delete_many({"_id": {"$in": [queued_log["_id"] for queued_log in queued_logs]}})
+    logger.info(f"Ingested {len(queued_logs)} queued TTL documents")
+    create_checkpoint_if_due()
+    return len(queued_logs)
+
 # ------------ READ FUNCTIONS ------------ #
 
 
@@ -153,14 +770,221 @@ def get_raw_graph_from_db() -> DynamicField:
 
 
 
-def get_logs_list() -> list:
+def get_graph_version() -> ObjectId:
+    graph = Graph._get_collection().find_one({"_id": "0"}, {"version": 1})
+    if not graph:
+        return None
+    if not graph.get("version"):
+        # Graph documents written before versioning was introduced
+        Graph._get_collection().update_one({"_id": "0", "version": None}, {"$set": {"version": ObjectId()}})
+        graph = Graph._get_collection().find_one({"_id": "0"}, {"version": 1})
+    return graph["version"]
+
+def get_graph_state() -> dict:
+    '''
+        Returns the version and sequence of the stored graph and whether a write of triples is in progress,
+        or None if there is no graph.
+    '''
+    graph = Graph._get_collection().find_one({"_id": "0"}, {"version": 1, "sequence": 1, "pending_writes": 1})
+    if not graph:
+        return None
+    abandoned_before = datetime.now() - timedelta(seconds=GRAPH_WRITE_TIMEOUT)
+    return {
+        "version": graph.get("version"),
+        "sequence": graph.get("sequence") or 0,
+        "writing": any(started_at > abandoned_before for started_at in (graph.get("pending_writes") or {}).values())
+    }
+
+def get_graph_from_db(version: ObjectId = None):
+    '''
+        Returns the stored graph as an rdflib Graph, whatever the storage layout.
+        The parsed graph is cached until the stored graph changes, so it must not be modified.
+    '''
+    version = version or get_graph_version()
+    if version is None:
+        return utils.semantic.get_graph_from_json(None)
+    graph = graph_cache.get(version)
+    if graph is None:
+        with graph_load_lock:
+            graph = graph_cache.get(version)
+            if graph is None:
+                graph = load_graph_from_db()
+                if GRAPH_CACHE_COMPACT and len(graph) <= GRAPH_CACHE_MAX_TRIPLES:
+                    graph = get_compact_graph(graph)
+                graph_cache.put(version, graph)
+    return graph
+
+def get_turtle_snapshot() -> TurtleSnapshot:
+    '''
+        Returns the Turtle serialization of the stored graph, or None if there is no graph.
+        It is serialized only once per graph version.
+    '''
+    version = get_graph_version()
+    if version is None:
+        return None
+    snapshot = snapshot_cache.get(version)
+    if snapshot is None:
+        with snapshot_build_lock:
+            snapshot = snapshot_cache.get(version)
+            if snapshot is None:
+                graph = get_graph_from_db(version)
+                turtle_data = utils.semantic.convert_graph_to_turtle(graph)
+                snapshot = TurtleSnapshot(version=version, turtle=turtle_data.encode("utf-8"), triples=len(graph))
+                snapshot_cache.put(snapshot)
+    return snapshot
+
+def load_graph_from_db():
+    if GRAPH_STORAGE == "triples":
+        logger.debug(f"Getting triples from DB")
+        graph_data = get_raw_graph_from_db() or {}
+        triples = Triple._get_collection().find({}, {"_id": 0, "subject": 1, "predicate": 1, "object": 1})
+        return utils.semantic.get_graph_from_n3_triples(
+            ((triple["subject"], triple["predicate"], triple["object"]) for triple in triples),
+            graph_data.get("@context", {})
+        )
+    return utils.semantic.get_graph_from_json(get_raw_graph_from_db())
+
+
+def get_experiment_uris() -> list:
+    return [experiment["_id"] for experiment in ExperimentIndex._get_collection().find({}, {"_id": 1}).sort("_id", 1)]
+
+def get_experiment_subjects(experiment_uri: str) -> list:
+    '''
+        Returns the N3 of the experiment, its activities and their messages from the experiment index,
+        or None if the experiment is not indexed.
+    '''
+    if not ExperimentIndex._get_collection().find_one({"_id": experiment_uri}, {"_id": 1}):
+        return None
+    subjects = {f"<{experiment_uri}>"}
+    for activity in ActivityIndex._get_collection().find({"experiments": experiment_uri}, {"messages": 1}):
+        subjects.add(activity["_id"])
+        subjects.update(activity.get("messages", []))
+    return sorted(subjects)
+
+def get_experiments_subjects(experiment_uris: list = None) -> dict:
+    '''
+        Returns the subjects of every indexed experiment (as get_experiment_subjects), keyed by experiment URI,
+        reading the experiment index only twice. All the experiments are returned if experiment_uris is None.
+        Experiments that are not indexed are left out.
+    '''
+    query = {} if experiment_uris is None else {"_id": {"$in": experiment_uris}}
+    subjects = {experiment["_id"]: {f"<{experiment['_id']}>"} for experiment in ExperimentIndex._get_collection().find(query, {"_id": 1}).sort("_id", 1)}
+    activity_query = {} if experiment_uris is None else {"experiments": {"$in": list(subjects)}}
+    for activity in ActivityIndex._get_collection().find(activity_query, {"experiments": 1, "messages": 1}):
+        for experiment_uri in activity.get("experiments", []):
+            if experiment_uri in subjects:
+                subjects[experiment_uri].add(activity["_id"])
+                subjects[experiment_uri].update(activity.get("messages", []))
+    return {experiment_uri: sorted(experiment_subjects) for experiment_uri, experiment_subjects in subjects.items()}
+
+def get_subjects_n3_triples(subjects: list) -> dict:
+    '''
+        Returns the triples (N3) of the given subjects (N3), keyed by subject.
+        They are read with a single query in the 'triples' layout, otherwise from the cached graph.
+    '''
+    subjects_triples = {}
+    if GRAPH_STORAGE == "triples":
+        for triple in Triple._get_collection().find({"subject": {"$in": subjects}}, {"_id": 0, "subject": 1, "predicate": 1, "object": 1}):
+            subjects_triples.setdefault(triple["subject"], []).append((triple["subject"], triple["predicate"], triple["object"]))
+        return subjects_triples
+    graph = get_graph_from_db()
+    for subject in subjects:
+        triples = [(s.n3(), p.n3(), o.n3()) for s, p, o in graph.triples((from_n3(subject), None, None))]
+        if triples:
+            subjects_triples[subject] = triples
+    return subjects_triples
+
+def get_experiment_stats(experiment_uri: str = None) -> list:
+    '''
+        Returns the statistics of an indexed experiment (empty list if it is not indexed),
+        or of every experiment if experiment_uri is None, read from the summary kept on every insertion.
+    '''
+    query = {} if experiment_uri is None else {"_id": experiment_uri}
+    experiments = [experiment["_id"] for experiment in ExperimentIndex._get_collection().find(query, {"_id": 1}).sort("_id", 1)]
+    stats = {experiment_stats["_id"]: experiment_stats for experiment_stats in ExperimentStats._get_collection().find({"_id": {"$in": experiments}})}
+    return [
+        {
+            "experiment": experiment,
+            "activities": stats.get(experiment, {}).get("activities", 0),
+            "messages": stats.get(experiment, {}).get("messages", 0),
+            "agents": len(stats.get(experiment, {}).get("agents", [])),
+            "started_at": stats.get(experiment, {}).get("started_at"),
+            "ended_at": stats.get(experiment, {}).get("ended_at")
+        }
+        for experiment in experiments
+    ]
+
+def iterate_subjects_nt(subjects: list):
+    '''
+        Yields the triples of the given subjects (N3) as N-Triples, EXPERIMENT_STREAM_CHUNK_TRIPLES triples at a time,
+        as they are read (from a database cursor in the 'triples' layout, otherwise from the cached graph).
+    '''
+    if GRAPH_STORAGE == "triples":
+        cursor = Triple._get_collection().find(
+            {"subject": {"$in": subjects}}, {"_id": 0, "subject": 1, "predicate": 1, "object": 1}
+        ).batch_size(EXPERIMENT_STREAM_CHUNK_TRIPLES)
+        triples = ((from_n3(triple["subject"]), from_n3(triple["predicate"]), from_n3(triple["object"])) for triple in cursor)
+    else:
+        graph = get_graph_from_db()
+        triples = (triple for subject in subjects for triple in graph.triples((from_n3(subject), None, None)))
+    while chunk := list(islice(triples, EXPERIMENT_STREAM_CHUNK_TRIPLES)):
+        yield utils.semantic.convert_triples_to_nt(chunk)
+
+def get_experiment_graph_from_db(experiment_uri: str):
+    '''
+        Returns a graph with the triples of the experiment, its activities and their messages,
+        or None if the experiment is not indexed.
+    '''
+    subjects = get_experiment_subjects(experiment_uri)
+    if subjects is None:
+        return None
+    if GRAPH_STORAGE == "triples":
+        triples = Triple._get_collection().find({"subject": {"$in": subjects}}, {"_id": 0, "subject": 1, "predicate": 1, "object": 1})
+        experiment_graph = utils.semantic.get_graph_from_n3_triples(
+            (triple["subject"], triple["predicate"], triple["object"]) for triple in triples
+        )
+        return utils.experiments.get_subjects_graph(experiment_graph, [from_n3(subject) for subject in subjects])
+    return utils.experiments.get_subjects_graph(get_graph_from_db(), [from_n3(subject) for subject in subjects])
+
+def get_logs_list(limit: int = 100, cursor: str = None, action_type: str = None, username: str = None,
+                  start: datetime = None, end: datetime = None, fields: list = None) -> tuple:
+    '''
+        Returns a page of logs (newest first) and the cursor of the next page (None if it is the last one).
+        Pages are selected by (uploaded_at, _id) so each one costs the same regardless of the history size.
+        Raises ValueError if the cursor is not valid.
+    '''
     logger.debug(f"Getting logs from DB")
-    logs = Log.objects()
-    serialized_logs = []
-    if logs:
-        logger.debug(f"Logs found: {len(logs)}")
-        serialized_logs = [serialize_log(log) for log in logs]
-    return serialized_logs
+    query = {}
+    if action_type:
+        query["action_type"] = action_type
+    if username:
+        query["username"] = username
+    if start or end:
+        query["uploaded_at"] = {}
+        if start:
+            query["uploaded_at"]["$gte"] = start
+        if end:
+            query["uploaded_at"]["$lte"] = end
+    if cursor:
+        try:
+            uploaded_at, log_id = decode_history_cursor(cursor)
+        except Exception:
+            raise ValueError("Invalid cursor")
+        query["$or"] = [
+            {"uploaded_at": {"$lt": uploaded_at}},
+            {"uploaded_at": uploaded_at, "_id": {"$lt": log_id}}
+        ]
+    logs = Log.objects(__raw__=query).order_by('-uploaded_at', '-_id').limit(limit + 1)
+    fields = [field for field in LOG_FIELDS if field in fields] if fields else LOG_FIELDS
+    # uploaded_at and _id are always needed to build the cursor
+    logs = list(logs.only(*set(fields) | {"_id", "uploaded_at"}))
+    logger.debug(f"Logs found: {len(logs)}")
+    next_cursor = encode_history_cursor(logs[limit - 1]) if len(logs) > limit else None
+    serialized_logs = [
+        {key: value for key, value in serialize_log(log).items() if key in fields}
+        for log in logs[:limit]
+    ]
+    return serialized_logs, next_cursor
 
 def get_log_info(log_id: str) -> dict:
     logger.debug(f"Getting log info for ID: {log_id}")
@@ -179,13 +1003,14 @@ def get_log_info(log_id: str) -> dict:
         action = Insertion.objects(_id=log.action).first()
         if action:
             action_data = {
-                "ttl_content": action.ttl_content
+                "ttl_content": action.get_ttl_content(),
+                "content_format": action.content_format or "turtle"
             }
     elif log.action_type == 'deletion':
         action = Deletion.objects(_id=log.action).first()
         if action:
             action_data = {
-                "ttl_deleted_graph": action.ttl_deleted_graph
+                "ttl_deleted_graph": action.get_ttl_deleted_graph()
             }
     return {
         "log": serialize_log(log),
@@ -193,9 +1018,132 @@ def get_log_info(log_id: str) -> dict:
     }
 
 
+# ------------ POINT-IN-TIME FUNCTIONS ------------ #
+
+def load_graph_with_sequence() -> tuple:
+    '''
+        Loads the stored graph together with the sequence of the last write it contains.
+        Returns None if there is no graph or it was written while it was loaded.
+    '''
+    if GRAPH_STORAGE == "triples":
+        # The triples are read with several queries: no write may start or finish meanwhile
+        state = get_graph_state()
+        if state is None or state["writing"]:
+            return None
+        graph = load_graph_from_db()
+        if get_graph_state() != state:
+            return None
+        return graph, state["sequence"]
+    # The whole graph and its sequence are read with a single query
+    graph_document = Graph._get_collection().find_one({"_id": "0"}, {"graph_data": 1, "sequence": 1})
+    if not graph_document:
+        return None
+    return utils.semantic.get_graph_from_json(graph_document.get("graph_data")), graph_document.get("sequence") or 0
+
+def create_checkpoint() -> GraphCheckpoint:
+    '''
+        Stores the current graph as a compressed TTL checkpoint, with the sequence of the last graph write it contains
+        (the insertions logged with a later sequence are replayed on top of it).
+        Returns the checkpoint, or None if there is no graph, it kept changing while it was read
+        or it was cleared meanwhile.
+    '''
+    last_deletion = Log.objects(action_type='deletion').order_by('-uploaded_at', '-_id').only('_id').first()
+    for attempt in range(GRAPH_CHECKPOINT_ATTEMPTS):
+        taken_at = datetime.now()
+        graph_with_sequence = load_graph_with_sequence()
+        if graph_with_sequence is not None:
+            break
+        if get_graph_state() is None:
+            logger.debug("No graph found to checkpoint")
+            return None
+        logger.debug("Graph modified while reading it for the checkpoint, retrying...")
+    else:
+        logger.info("Graph modified while reading it for the checkpoint, skipping it")
+        return None
+    graph, graph_sequence = graph_with_sequence
+    compressed_turtle_data = compress_text(utils.semantic.convert_graph_to_turtle(graph))
+    if Log.objects(action_type='deletion').order_by('-uploaded_at', '-_id').only('_id').first() != last_deletion:
+        logger.debug("Graph cleared while taking the checkpoint, skipping it")
+        return None
+    checkpoint = GraphCheckpoint(
+        _id = ObjectId(),
+        taken_at = taken_at,
+        graph_sequence = graph_sequence,
+        triples = len(graph)
+    )
+    checkpoint.ttl_graph_file.put(compressed_turtle_data, content_type="application/zlib")
+    checkpoint.save()
+    logger.info(f"Graph checkpoint stored -> {len(graph)} triples, {len(compressed_turtle_data)} compressed bytes")
+    return checkpoint
+
+def create_checkpoint_if_due() -> None:
+    '''
+        Stores a checkpoint when GRAPH_CHECKPOINT_INTERVAL insertions have been logged since the last one.
+    '''
+    if GRAPH_CHECKPOINT_INTERVAL <= 0:
+        return
+    # Checkpoints requested while another one is being taken are not needed
+    if not checkpoint_lock.acquire(blocking=False):
+        return
+    try:
+        last_checkpoint = GraphCheckpoint.objects().order_by('-taken_at', '-_id').only('taken_at').first()
+        insertions = Log.objects(action_type='insertion')
+        if last_checkpoint:
+            insertions = insertions.filter(uploaded_at__gt=last_checkpoint.taken_at)
+        if insertions.limit(GRAPH_CHECKPOINT_INTERVAL).count(with_limit_and_skip=True) >= GRAPH_CHECKPOINT_INTERVAL:
+            create_checkpoint()
+    except Exception as e:
+        logger.error(f"Error storing graph checkpoint: {e}")
+    finally:
+        checkpoint_lock.release()
+
+def get_graph_as_of(as_of: datetime):
+    '''
+        Rebuilds the graph as it was at the given date.
+        Starts from the nearest checkpoint taken before that date (and after the last clear of the graph)
+        and replays only the insertions logged before the date whose graph write is not in the checkpoint.
+    '''
+    logger.debug(f"Rebuilding graph as of {as_of}")
+    last_deletion = Log.objects(action_type='deletion', uploaded_at__lte=as_of).order_by('-uploaded_at', '-_id').only('uploaded_at').first()
+    checkpoints = GraphCheckpoint.objects(taken_at__lte=as_of)
+    if last_deletion:
+        checkpoints = checkpoints.filter(taken_at__gte=last_deletion.uploaded_at)
+    checkpoint = checkpoints.order_by('-taken_at', '-_id').first()
+
+    insertion_logs = Log.objects(action_type='insertion', uploaded_at__lte=as_of)
+    if last_deletion:
+        insertion_logs = insertion_logs.filter(uploaded_at__gt=last_deletion.uploaded_at)
+    if checkpoint:
+        logger.debug(f"Using checkpoint {checkpoint._id} ({checkpoint.triples} triples)")
+        if checkpoint.graph_sequence is None:
+            insertion_logs = insertion_logs.filter(uploaded_at__gt=checkpoint.taken_at)
+        else:
+            # The sequence restarts when the graph is cleared, so it is only compared after the last clear.
+            # Logs stored before the graph sequence was introduced are compared by date
+            insertion_logs = insertion_logs.filter(
+                Q(graph_sequence__gt=checkpoint.graph_sequence) |
+                Q(graph_sequence=None, uploaded_at__gt=checkpoint.taken_at)
+            )
+    insertion_ids = [log.action for log in insertion_logs.order_by('uploaded_at', '_id').only('action')]
+    logger.debug(f"Replaying {len(insertion_ids)} insertions")
+
+    def get_documents():
+        if checkpoint:
+            yield decompress_text(checkpoint.ttl_graph_file.read()), "turtle"
+        for start in range(0, len(insertion_ids), 500):
+            chunk = insertion_ids[start:start + 500]
+            insertions = {insertion._id: insertion for insertion in Insertion.objects(_id__in=chunk)}
+            for insertion_id in chunk:
+                if insertion_id in insertions:
+                    insertion = insertions[insertion_id]
+                    yield insertion.get_ttl_content(), insertion.content_format or "turtle"
+
+    return utils.semantic.get_graph_from_documents(get_documents())
+
+
 # ------------ DELETE FUNCTIONS ------------ #
 
-def clear_graph(ip_addr:str, user_details: str) -> bool:
+def clear_graph(ip_addr:str, user_details: str, username: str = None) -> bool:
     
     """
         Atomic Transaction 
@@ -203,18 +1151,26 @@ def clear_graph(ip_addr:str, user_details: str) -> bool:
     logger.debug(f"Clearing graph")
     log_id = ObjectId()
     deletion_id = ObjectId()
+    
+    graph = get_graph_from_db()
+    if len(graph) == 0:
+        logger.debug(f"No current graph found to clear")
+        return False
+    deletion = Deletion(_id = deletion_id)
+    # The TTL is compressed while it is serialized, so the whole dump is never held in memory
+    deleted_graph_writer = DeletedGraphWriter(deletion)
+    try:
+        utils.semantic.write_graph_as_turtle(graph, deleted_graph_writer)
+        deleted_graph_writer.close()
+    except Exception as e:
+        logger.error(f"Error serializing the graph to clear: {e}")
+        deleted_graph_writer.discard()
+        return False
         
     db = get_db()
     session = db.client.start_session()
     session.start_transaction()
     
-    current_graph = get_raw_graph_from_db()
-    if not current_graph:
-        logger.debug(f"No current graph found to clear")
-        return False
-    graph = utils.semantic.get_graph_from_json(current_graph)
-    turtle_data = utils.semantic.convert_graph_to_turtle(graph)
-    
     try:
         
         log = Log (
@@ -223,21 +1179,25 @@ def clear_graph(ip_addr:str, user_details: str) -> bool:
             origin_ip = ip_addr,
             action_type = 'deletion',
             action = deletion_id,
-            user_details = user_details
+            user_details = user_details,
+            username = username
         )
         log.save()        
         
-        deletion = Deletion (
-            _id = deletion_id,
-            log = log,
-            ttl_deleted_graph = turtle_data
-        )
+        deletion.log = log
         deletion.save()
         
-        graph = Graph.objects(_id='0').first()
-        graph.delete()
+        graph_document = Graph.objects(_id='0').first()
+        if graph_document:
+            graph_document.delete()
+        Triple.objects().delete()
+        ExperimentIndex.objects().delete()
+        ActivityIndex.objects().delete()
+        ExperimentStats.objects().delete()
             
         session.commit_transaction()
+        graph_cache.invalidate()
+        snapshot_cache.invalidate()
         logger.debug(f"Graph deleted")
         logger.debug(f"Deletion ID: {deletion_id}")
         logger.debug(f"Log ID: {log_id}")
@@ -249,6 +1209,104 @@ def clear_graph(ip_addr:str, user_details: str) -> bool:
     except Exception as e:
         logger.error(f"Error clearing graph: {e}")
         session.abort_transaction()
+        deleted_graph_writer.discard()
         return False
     finally:
-        session.end_session()
\ No newline at end of file
+        session.end_session()
+
+
+# ------------ MAINTENANCE FUNCTIONS ------------ #
+
+def migrate_legacy_graph() -> int:
+    '''
+        Moves the '@graph' of the legacy single Graph document to the Triple collection,
+        keeping only the prefixes in the Graph document.
+        The triples are written to a staging collection that replaces the Triple collection with a single
+        (atomic) rename, and the Graph document records when the rename starts. An interrupted migration
+        is started again, or only finished if the rename was done, by running it again.
+        Returns the number of migrated triples.
+    '''
+    logger.info("Migrating legacy graph document to triple documents...")
+    db = get_db()
+    graph_document = Graph._get_collection().find_one({"_id": "0"}, {"migration": 1})
+    if graph_document and graph_document.get("migration") == "renaming" and MIGRATION_COLLECTION not in db.list_collection_names():
+        logger.info("Resuming migration: the triples were already moved")
+        return finish_legacy_graph_migration()
+    # Whatever an interrupted migration left in the staging collection is discarded
+    db.drop_collection(MIGRATION_COLLECTION)
+    graph_data = get_raw_graph_from_db()
+    if not graph_data or not graph_data.get("@graph"):
+        logger.info("No legacy graph found to migrate")
+        return 0
+    graph = utils.semantic.get_graph_from_json(graph_data)
+    staging = db[MIGRATION_COLLECTION]
+    # Triples already stored in the Triple collection are kept
+    existing_triples = Triple._get_collection().find({})
+    while chunk := list(islice(existing_triples, MIGRATION_CHUNK_TRIPLES)):
+        staging.insert_many(chunk)
+    n3_triples = ((s.n3(), p.n3(), o.n3()) for s, p, o in graph)
+    while chunk := list(islice(n3_triples, MIGRATION_CHUNK_TRIPLES)):
+        insert_many_ignoring_duplicates(staging, [
+            {"_id": triple_id(s, p, o), "subject": s, "predicate": p, "object": o} for s, p, o in chunk
+        ])
+    for field in ("subject", "predicate", "object"):
+        staging.create_index(field)
+    Graph._get_collection().update_one({"_id": "0"}, {"$set": {"migration": "renaming"}})
+    staging.rename(Triple._get_collection().name, dropTarget=True)
+    finish_legacy_graph_migration()
+    logger.info(f"Legacy graph migrated -> {len(graph)} triples")
+    return len(graph)
+
+def finish_legacy_graph_migration() -> int:
+    '''
+        Last step of the migration: keeps only the prefixes in the Graph document.
+        Returns the number of triples in the Triple collection.
+    '''
+    graph_data = get_raw_graph_from_db() or {}
+    Graph._get_collection().update_one(
+        {"_id": "0"},
+        {
+            "$set": {"graph_data": {"@context": graph_data.get("@context", {})}, "updated_at": datetime.now(), "version": ObjectId()},
+            "$unset": {"migration": ""}
+        }
+    )
+    return Triple._get_collection().count_documents({})
+
+def rebuild_experiment_index() -> int:
+    '''
+        Builds the experiment index again from the stored graph.
+        Returns the number of indexed experiments.
+    '''
+    logger.info("Rebuilding experiment index...")
+    ExperimentIndex.objects().delete()
+    ActivityIndex.objects().delete()
+    ExperimentStats.objects().delete()
+    index_experiments(get_graph_from_db())
+    experiments = ExperimentIndex.objects().count()
+    logger.info(f"Experiment index rebuilt -> {experiments} experiments")
+    return experiments
+
+def compact_graph() -> tuple:
+    '''
+        Merges the nodes of the Graph document with the same '@id' and removes repeated triples.
+        The stored triples do not change, so the graph version is kept (caches stay valid).
+        Returns the number of nodes before and after the compaction.
+    '''
+    logger.info("Compacting graph document...")
+    while True:
+        graph = Graph._get_collection().find_one({"_id": "0"}, {"graph_data": 1, "version": 1})
+        if not graph or not graph.get("graph_data", {}).get("@graph"):
+            logger.info("No graph found to compact")
+            return 0, 0
+        graph_data = graph["graph_data"]
+        compacted_graph_data = utils.semantic.compact_json_ld(graph_data)
+        # Only written if no insertion happened meanwhile, otherwise it is compacted again
+        result = Graph._get_collection().update_one(
+            {"_id": "0", "version": graph.get("version")},
+            {"$set": {"graph_data": compacted_graph_data, "updated_at": datetime.now()}}
+        )
+        if result.matched_count:
+            break
+        logger.debug("Graph modified during the compaction, retrying...")
+    logger.info(f"Graph compacted -> {len(graph_data['@graph'])} nodes before, {len(compacted_graph_data['@graph'])} nodes after")
+    return len(graph_data["@graph"]), len(compacted_graph_data["@graph"])
@@ -1,11 +1,11 @@
 from langchain_community.chat_models import ChatOllama
 from langchain.schema import SystemMessage, HumanMessage
 import requests
-from requests.auth import HTTPDigestAuth
+from utils.Virtuoso import virtuoso_client
+from utils.Virtuoso.prefix_utils import schema_index
 import os
 import time
 import re
-import json
 import logging
 
 logger = logging.getLogger("RAG")
@@ -28,17 +28,12 @@ llm = ChatOllama(
     
 )
 
-VIRTUOSO_SPARQL_ENDPOINT = os.getenv("VIRTUOSO_ENDPOINT", "http://amor-segb-virtuoso:8890/sparql-auth")
-# Use the correct hostname or IP for your Virtuoso server
-# VIRTUOSO_SPARQL_ENDPOINT = os.getenv("VIRTUOSO_ENDPOINT", "http://localhost:8890/sparql-auth")
+# The Virtuoso endpoint and credentials (VIRTUOSO_ENDPOINT, VIRTUOSO_USER, DBA_PASSWORD) are read by utils.Virtuoso.virtuoso_client
 
-VIRTUOSO_USER = os.getenv("VIRTUOSO_USER", "dba")
-VIRTUOSO_PASSWORD = os.getenv("DBA_PASSWORD", "viryourbear")
-
-def load_prefixes_and_patterns(path="/logs/for_RAG.json") -> str:
+def load_prefixes_and_patterns() -> str:
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        # Cumulative schema of the inserted documents, loaded once and kept up to date on every insertion
+        data = schema_index.get_rag_data()
 
         # Prefixes
         prefixes = data.get("prefixes", {})
@@ -86,11 +81,9 @@ def sparql_query(query: str) -> str:
         "query": query
     }
     try: 
-        response = requests.get(
-            VIRTUOSO_SPARQL_ENDPOINT,
+        response = virtuoso_client.get(
             params=params,
             headers=headers,
-            auth=HTTPDigestAuth(VIRTUOSO_USER, VIRTUOSO_PASSWORD),
             timeout=30 
         )
 
@@ -1,10 +1,11 @@
-from fastapi import FastAPI, HTTPException, status, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, status, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from utils.credentials import User, validate_token
-from utils.Virtuoso.model_V import insert_ttl, get_ttls, run_custom_query, delete_all_triples
-from rdflib import Graph
-from typing import Annotated
+from utils.Virtuoso.model_V import insert_ttl, get_events_pages, run_custom_query, delete_all_triples
+from utils.executor import run_blocking, iterate_blocking
+import utils.semantic
+from typing import Annotated, Literal
 import logging
 import os
 from fastapi.responses import PlainTextResponse
@@ -39,13 +40,38 @@ class Event(BaseModel):
     ttl_content: str
 
 
-@app.post("/event")
+# Besides the JSON body with the Turtle content, the event can be sent as the body in any supported RDF media type
+EVENT_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": Event.model_json_schema()},
+            **{media_type: {"schema": {"type": "string"}} for media_type in utils.semantic.RDF_MEDIA_TYPES}
+        }
+    }
+}
+
+async def read_event(request: Request) -> tuple:
+    '''
+    Returns the content of the event and its rdflib format, according to the Content-Type of the request.
+    '''
+    body = await request.body()
+    media_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if media_type == "application/json":
+        try:
+            return Event.model_validate_json(body).ttl_content, "turtle"
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Invalid event: {str(e)}")
+    return body.decode("utf-8"), utils.semantic.get_rdf_format(media_type)
+
+@app.post("/event", openapi_extra=EVENT_REQUEST_BODY)
 async def post_event_ttl(
-    data: Event,
+    request: Request,
     user: Annotated[User, Depends(validate_token)]
 ):
+    content, rdf_format = await read_event(request)
     try:
-        log_id = insert_ttl(data.ttl_content)
+        log_id = insert_ttl(content, rdf_format)
         return JSONResponse(content={"message": "Event stored successfully", "log_id": log_id}, status_code=201)
     except Exception as e:
         logger.exception("Exception while inserting event")
@@ -53,10 +79,17 @@ async def post_event_ttl(
 
 
 @app.get("/events", response_class=PlainTextResponse) 
-async def get_events(user: Annotated[User, Depends(validate_token)]):
+async def get_events(
+    user: Annotated[User, Depends(validate_token)],
+    format: Literal["turtle", "nt"] = "turtle"
+):
     try:
-        ttl_data = get_ttls()
-        return PlainTextResponse(content=ttl_data, media_type="text/turtle") # so that it returns in TTL format instead of serialized JSON
+        # The graph is streamed in pages as Virtuoso returns them, it is never loaded as a whole
+        pages = await run_blocking(get_events_pages, format)
+        return StreamingResponse(
+            iterate_blocking(pages),
+            media_type="application/n-triples" if format == "nt" else "text/turtle"
+        )
     except Exception as e:
         logger.exception("Failed fetching events")
         raise HTTPException(status_code=500, detail="Error fetching events")
@@ -77,23 +110,13 @@ async def get_query(
 @app.post("/ttl/delete_all")
 async def delete_all_ttls(user: Annotated[User, Depends(validate_token)]):
     try:
-        # Get all TTLs from Virtuoso
-        ttl_text = get_ttls()
-        if not ttl_text:
+        # Only the first page of the graph is needed to know whether it is empty (it is fetched by get_events_pages)
+        pages = await run_blocking(get_events_pages, "nt")
+        if next(pages, None) is None:
             return JSONResponse(content={"message": "No TTLs to delete"}, status_code=200)
 
-        # Convert TTL to RDF graph
-        g = Graph()
-        g.parse(data=ttl_text, format="turtle")
-
-        # Convert graph to TTL lines
-        ttl_lines = []
-        for s, p, o in g:
-            line = f"{s.n3()} {p.n3()} {o.n3()} ."
-            ttl_lines.append(line)
-
         # Delete graph
-        delete_all_triples()
+        await run_blocking(delete_all_triples)
 
         return JSONResponse(content={"message": "Graph cleared."}, status_code=200)
     
@@ -1,13 +1,15 @@
 import uuid
-from datetime import datetime
 import requests
 import os
 import logging
-from requests.auth import HTTPDigestAuth
 import re
+from itertools import chain
 from rdflib import Graph, Literal, Namespace, URIRef, BNode
 from rdflib.namespace import RDF
-from utils.Virtuoso.prefix_utils import extract_prefixes, save_prefixes, load_prefixes, clean_prefixes_with_numbers, save_prefixes_and_entities
+import utils.semantic
+from utils.Virtuoso import virtuoso_client
+from utils.Virtuoso.virtuoso_client import VIRTUOSO_SPARQL_ENDPOINT, VIRTUOSO_USER, VIRTUOSO_PASSWORD
+from utils.Virtuoso.prefix_utils import get_graph_prefixes, save_prefixes, load_prefixes, schema_index
 
 logger = logging.getLogger("mod_history_virt")
 os.makedirs('/logs', exist_ok=True)
@@ -17,10 +19,13 @@ file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelnam
 logger.addHandler(file_handler)
 logger.info("Starting model_V...")
 
-VIRTUOSO_SPARQL_ENDPOINT = os.getenv("VIRTUOSO_ENDPOINT", "http://amor-segb-virtuoso:8890/sparql-auth")
 VIRTUOSO_GRAPH_URI = os.getenv("VIRTUOSO_GRAPH_URI", "http://amor-segb/events")
-VIRTUOSO_USER = os.getenv("VIRTUOSO_USER", "dba")
-VIRTUOSO_PASSWORD = os.getenv("DBA_PASSWORD", "viryourbear")
+# Triples sent in each request when a document is inserted (triples linked by blank nodes are kept together)
+VIRTUOSO_INSERT_CHUNK_TRIPLES = int(os.getenv("VIRTUOSO_INSERT_CHUNK_TRIPLES", "50000"))
+# Triples fetched in each request when the events are exported
+VIRTUOSO_EXPORT_PAGE_TRIPLES = int(os.getenv("VIRTUOSO_EXPORT_PAGE_TRIPLES", "10000"))
+# ResultSetMaxRows in virtuoso.ini: Virtuoso truncates bigger results, so export pages never exceed it
+VIRTUOSO_RESULT_SET_MAX_ROWS = int(os.getenv("VIRTUOSO_RESULT_SET_MAX_ROWS", "10000"))
 
 
 
@@ -33,100 +38,161 @@ logger.info(f"Virtuoso password: {VIRTUOSO_PASSWORD}")
 
 
 # Insert log
-def insert_ttl(ttl_content: str) -> str:
+def insert_ttl(ttl_content: str, rdf_format: str = "turtle") -> str:
     log_id = str(uuid.uuid4())
 
     # TTL into N-Triples (to avoid inserting as a block)
-    g = Graph()
-
     try:
-        g.parse(data=ttl_content, format="turtle")
+        g = utils.semantic.get_graph_from_data(ttl_content, rdf_format, bind_namespaces="core")
     except Exception as e:
-        logger.error(f"Failed to parse TTL content: {e}")
-        raise Exception(f"Error parsing TTL content: {str(e)}")
-    
-    # extract prefixes
-    prefixes = extract_prefixes(ttl_content)
-    save_prefixes(prefixes) 
-    save_prefixes_and_entities(prefixes, ttl_content) 
+        logger.error(f"Failed to parse {rdf_format} content: {e}")
+        raise Exception(f"Error parsing {rdf_format} content: {str(e)}")
 
+    # extract prefixes (Turtle @prefix and JSON-LD @context declare them, N-Triples and N-Quads do not)
+    prefixes = get_graph_prefixes(g) if rdf_format in ("turtle", "json-ld") else {}
     for prefix, uri in load_prefixes().items():
         g.bind(prefix, Namespace(uri))
 
-    logger.info(f"Parsed TTL content in NT format: {g.serialize(format="nt")}")
-
-    # Insert with prefixes
-    sparql = f"""
-    INSERT DATA {{
-      GRAPH <{VIRTUOSO_GRAPH_URI}> {{
-        {g.serialize(format="nt")}
-      }}
-    }}
-    """
+    logger.info(f"Parsed {rdf_format} content: {len(g)} triples")
 
-    headers = {
-        "Content-Type": "application/sparql-update"
-    }
+    # Load with the Graph Store HTTP Protocol in bounded N-Triples chunks (no SPARQL text to build and parse)
+    inserted = 0
     try:
-        response = requests.post(
-            VIRTUOSO_SPARQL_ENDPOINT,
-            data=sparql.encode("utf-8"),
-            auth=HTTPDigestAuth(VIRTUOSO_USER, VIRTUOSO_PASSWORD),
-            headers=headers
-        )
-        response.raise_for_status()
+        for chunk in utils.semantic.split_triples(g, VIRTUOSO_INSERT_CHUNK_TRIPLES):
+            response = virtuoso_client.post_graph(
+                data=utils.semantic.convert_triples_to_nt(chunk).encode("utf-8"),
+                graph_uri=VIRTUOSO_GRAPH_URI
+            )
+            response.raise_for_status()
+            inserted += len(chunk)
+            logger.debug(f"Inserted {inserted} of {len(g)} triples")
         logger.info(f"TTL inserted successfully with log_id: {log_id}")
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to insert TTL: {e}")
+        logger.error(f"Failed to insert TTL after {inserted} of {len(g)} triples: {e}")
         logger.error(f"Virtuoso response: {response.text if 'response' in locals() else 'No response'}")
         raise Exception(f"Error inserting TTL into Virtuoso: {str(e)}")
 
+    # Only documents stored in Virtuoso are registered: their prefixes and their schema for the RAG prompt
+    save_prefixes(prefixes)
+    schema_index.update(g)
+
     return log_id
 
 
 
-def get_ttls() -> str:
+def get_events_prefix_header() -> str:
+    '''
+    Returns the Turtle @prefix declarations of the known prefixes.
+    '''
+    return "".join(f"@prefix {prefix}: <{uri}> .\n" for prefix, uri in load_prefixes().items()) + "\n"
+
+def get_term_from_binding(value: dict):
+    '''
+    Returns the rdflib term of a value of the SPARQL JSON results.
+    Virtuoso names blank nodes like 'nodeID://b10001', they are turned into valid blank node labels.
+    '''
+    if value["type"] == "uri":
+        return URIRef(value["value"])
+    if value["type"] in ("literal", "typed-literal"):
+        return Literal(value["value"], lang=value.get("xml:lang"), datatype=value.get("datatype"))
+    if value["type"] == "bnode":
+        return BNode(re.sub(r"\W", "_", value["value"]))
+    return Literal(value["value"])
+
+# Subjects of the events graph, by the variable their pages are sorted and filtered on: IRIs are compared
+# directly, so Virtuoso can read the quad index from the last subject exported; blank nodes cannot be written
+# in a query, so they are compared by their label (which is not indexed)
+EVENTS_SUBJECT_PATTERNS = [
+    ("?s", "?s ?p ?o . FILTER(isIRI(?s))", lambda key: URIRef(key).n3()),
+    ("?key", "?s ?p ?o . FILTER(isBlank(?s)) BIND(STR(?s) AS ?key)", lambda key: Literal(key).n3()),
+]
+
+def select_events_page(pattern: str, key_variable: str, condition: str, order: str, limit: int, offset: int = 0):
+    '''
+    Returns the triples of the events graph that match the pattern and the condition, as a list of
+    (value of key_variable, triple), and whether Virtuoso truncated the results (X-SPARQL-MaxRows header).
+    '''
     query = f"""
-    CONSTRUCT {{
-        ?s ?p ?o .
-    }}
+    SELECT ?s ?p ?o {key_variable if key_variable != "?s" else ""}
     FROM <{VIRTUOSO_GRAPH_URI}>
     WHERE {{
-        ?s ?p ?o .
+        {pattern}
+        FILTER({condition})
     }}
+    ORDER BY {order}
+    LIMIT {limit}
+    OFFSET {offset}
     """
-
-    response = requests.get(
-        VIRTUOSO_SPARQL_ENDPOINT,
-        params={"query": query, "format": "application/rdf+xml"},
-        auth=HTTPDigestAuth(VIRTUOSO_USER, VIRTUOSO_PASSWORD),
-        headers={"Accept": "application/rdf+xml"}
+    response = virtuoso_client.get(
+        params={"query": query, "format": "application/sparql-results+json"},
+        headers={"Accept": "application/sparql-results+json"}
     )
-
     if response.status_code != 200:
-        raise Exception(f"Error fetching TTLs: {response.text}")
-
-    g = Graph()
-    # logger.info(f"Previous TTL result: {g.serialize(format="turtle")}")    
-    g.parse(data=response.text, format="xml")
-
-    # Bind prefixes to the graph
-    for prefix, uri in load_prefixes().items():
-        logger.debug(f"Binding prefix: {prefix} to URI: {uri}")
-        g.bind(prefix, Namespace(uri))
-    logger.info(f"TTL result: {g.serialize(format="turtle")}")
-    # g.serialize(destination="/database/temp.ttl", format="turtle")
-    # logger.info("Serialized TTL to /database/temp.ttl")
-    rd = g.serialize(format="ttl")
-
-    clean = clean_prefixes_with_numbers(rd)
-
-    return clean   # Clean prefixes with numbers before returning
-    
-   
-
-
-
+        raise Exception(f"Error fetching events: {response.text}")
+    rows = [
+        (row[key_variable[1:]]["value"], (get_term_from_binding(row["s"]), get_term_from_binding(row["p"]), get_term_from_binding(row["o"])))
+        for row in response.json().get("results", {}).get("bindings", [])
+    ]
+    return rows, "X-SPARQL-MaxRows" in response.headers
+
+def iterate_events_nt():
+    '''
+    Yields the triples of the events graph as N-Triples, at most VIRTUOSO_EXPORT_PAGE_TRIPLES triples at a time.
+    Pages are sorted by subject and each one starts after the last subject of the previous one (keyset
+    pagination), so Virtuoso does not sort and skip the triples already exported on every page.
+    A full page may end in the middle of a subject: its triples are fetched again with the next page.
+    A subject with more triples than a page is exported on its own with LIMIT/OFFSET.
+    '''
+    page_size = min(VIRTUOSO_EXPORT_PAGE_TRIPLES, VIRTUOSO_RESULT_SET_MAX_ROWS)
+    exported = 0
+    for key_variable, pattern, to_sparql in EVENTS_SUBJECT_PATTERNS:
+        condition = "true"
+        while True:
+            rows, truncated = select_events_page(pattern, key_variable, condition, key_variable, page_size)
+            if not rows or (not truncated and len(rows) < page_size):
+                # A short page is the last one
+                if rows:
+                    yield utils.semantic.convert_triples_to_nt(triple for _, triple in rows)
+                    exported += len(rows)
+                break
+            last_key = rows[-1][0]
+            complete = [triple for key, triple in rows if key != last_key]
+            if complete:
+                yield utils.semantic.convert_triples_to_nt(complete)
+                exported += len(complete)
+                condition = f"{key_variable} > {to_sparql(rows[len(complete) - 1][0])}"
+            else:
+                for triples in iterate_subject_nt(pattern, key_variable, f"{key_variable} = {to_sparql(last_key)}", page_size):
+                    yield triples
+                    exported += triples.count("\n")
+                condition = f"{key_variable} > {to_sparql(last_key)}"
+            logger.debug(f"Fetched {exported} triples of the events graph")
+    logger.debug(f"Fetched {exported} triples of the events graph")
+
+def iterate_subject_nt(pattern: str, key_variable: str, condition: str, page_size: int):
+    '''
+    Yields the triples of a single subject of the events graph (the condition on key_variable)
+    as N-Triples, page_size triples at a time.
+    '''
+    offset = 0
+    while True:
+        rows, truncated = select_events_page(pattern, key_variable, condition, "?p ?o", page_size, offset)
+        if rows:
+            yield utils.semantic.convert_triples_to_nt(triple for _, triple in rows)
+        offset += len(rows)
+        if not rows or (not truncated and len(rows) < page_size):
+            return
+
+def get_events_pages(rdf_format: str = "turtle"):
+    '''
+    Returns an iterator over the events graph in pages, as N-Triples or as Turtle (the @prefix declarations
+    of the known prefixes first, then the triples, since N-Triples statements are valid Turtle).
+    The first page is fetched before returning, so a failing Virtuoso raises here and not halfway through the response.
+    '''
+    pages = iterate_events_nt()
+    first_page = next(pages, None)
+    header = [get_events_prefix_header()] if rdf_format == "turtle" else []
+    return chain(header, [first_page] if first_page is not None else [], pages)
 
 def run_custom_query(query: str) -> str:
     logger.info(f"Executing custom SPARQL query: {query}")
@@ -140,10 +206,8 @@ def run_custom_query(query: str) -> str:
     # if query is a CONSTRUCT, return ttl
     is_construct = bool(re.match(r"(?i)^\s*CONSTRUCT\b", query.strip()))
     headers = {"Accept": "text/turtle" if is_construct else "application/sparql-results+json"} # else is SELECT 
-    response = requests.get(
-        VIRTUOSO_SPARQL_ENDPOINT,
+    response = virtuoso_client.get(
         params={"query": query, "format": "text/turtle" if is_construct else "application/sparql-results+json"},
-        auth=HTTPDigestAuth(VIRTUOSO_USER, VIRTUOSO_PASSWORD),
         headers=headers
     )
 
@@ -171,16 +235,7 @@ def run_custom_query(query: str) -> str:
         g.add((result_node, RDF.type, EX.Result))
         for var in variables:
             if var in row:
-                value = row[var]
-                if value["type"] == "uri":
-                    obj = URIRef(value["value"])
-                elif value["type"] == "literal":
-                    obj = Literal(value["value"], lang=value.get("xml:lang"), datatype=value.get("datatype"))
-                elif value["type"] == "bnode":
-                    obj = BNode(value["value"])
-                else:
-                    obj = Literal(value["value"])
-                g.add((result_node, EX[var], obj))
+                g.add((result_node, EX[var], get_term_from_binding(row[var])))
 
     return g.serialize(format="turtle")
 
@@ -192,10 +247,8 @@ def delete_all_triples():
         "Content-Type": "application/sparql-update"
     }
     try:
-        response = requests.post(
-            VIRTUOSO_SPARQL_ENDPOINT,
+        response = virtuoso_client.post(
             data=sparql.encode("utf-8"),
-            auth=HTTPDigestAuth(VIRTUOSO_USER, VIRTUOSO_PASSWORD),
             headers=headers
         )
         response.raise_for_status()
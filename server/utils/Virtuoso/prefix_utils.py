@@ -1,7 +1,9 @@
 import os
 import json
 import logging
-import re
+import atexit
+import fcntl
+from threading import Lock, Event, Thread
 from rdflib import RDF, Graph, Literal
 
 # logging
@@ -24,142 +26,314 @@ logger.setLevel(getattr(logging, logging_level, logging.INFO))
 logger.addHandler(file_handler)
 
 
-PREFIX_FILE = os.getenv("PREFIX_FILE_PATH", "prefixes.json")
+PREFIX_FILE = os.getenv("PREFIX_FILE_PATH", "/logs/prefixes.json")
+# Seconds between background checks of the prefix and RAG schema files (new entries are written and external changes reloaded)
+PREFIX_FLUSH_INTERVAL = float(os.getenv("PREFIX_FLUSH_INTERVAL", "1"))
+# Schema of the inserted documents given to the RAG prompt
+RAG_SCHEMA_FILE = os.getenv("RAG_SCHEMA_FILE_PATH", "/logs/for_RAG.json")
 
 
-def clean_prefixes_with_numbers(ttl_string):
+class PrefixRegistry:
     """
-    Processes a TTL string and removes digits from prefix names,
-    keeping the URI of each prefix untouched.
-
-    Example:
-    @prefix ex1: <http://example.org/> .
-    becomes:
-    @prefix ex: <http://example.org/> .
+    Process-wide registry of the known prefixes, kept in memory so inserts do no file I/O for them.
+    A background thread writes the new prefixes to the JSON file (merged with its current content,
+    under a file lock, to a temporary file that then replaces it) and reloads the file when another
+    process changes it.
     """
-    # Regex to match prefix declarations with numbers in the name
-    prefix_pattern = re.compile(r'^@prefix\s+([a-zA-Z_]+[0-9]+):\s+<([^>]+)>\s+\.')
-
-    new_lines = []
-    replacements = {}
-
-    for line in ttl_string.splitlines():
-        match = prefix_pattern.match(line)
-        if match:
-            original_prefix = match.group(1)
-            uri = match.group(2)
-            new_prefix = re.sub(r'\d+', '', original_prefix)
-            # Store the replacement mapping
-            replacements[original_prefix] = new_prefix
-            new_line = f"@prefix {new_prefix}: <{uri}> ."
-            new_lines.append(new_line)
-        else:
-            new_lines.append(line)
-
-    # Reconstruct the modified TTL with updated prefixes
-    modified_ttl = "\n".join(new_lines)
-
-    # Replace all uses of the old prefix in the body of the TTL
-    for old, new in replacements.items():
-        modified_ttl = re.sub(rf'\b{old}:', f'{new}:', modified_ttl)
-
-    return modified_ttl
-
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._prefixes = {}
+        self._pending = {}
+        self._signature = None
+        self._wakeup = Event()
+        self._thread = None
+        self.reload()
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _read_file(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def reload(self):
+        """Reads the file again if it changed since it was last read or written."""
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        try:
+            stored = self._read_file()
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read prefixes from {self.path}: {e}")
+            return
+        with self._lock:
+            # Prefixes not written yet take precedence over the file
+            stored.update(self._pending)
+            self._prefixes = stored
+            self._signature = signature
+        logger.info(f"Prefixes loaded from {self.path}: {len(stored)} prefixes")
+
+    def flush(self):
+        """Writes the prefixes added since the last flush, merged with the current content of the file."""
+        with self._lock:
+            pending = dict(self._pending)
+        if not pending:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(os.path.join(directory, f".{os.path.basename(self.path)}.lock"), "w") as lock_file:
+                # Other processes merge their prefixes into the same file
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                stored = self._read_file()
+                stored.update(pending)
+                with open(temporary_path, "w", encoding="utf-8") as f:
+                    json.dump(stored, f, indent=2, ensure_ascii=False)
+                os.replace(temporary_path, self.path)
+                signature = self._file_signature()
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to write prefixes to {self.path}: {e}")
+            return
+        with self._lock:
+            for prefix, uri in pending.items():
+                if self._pending.get(prefix) == uri:
+                    del self._pending[prefix]
+            stored.update(self._pending)
+            self._prefixes = stored
+            self._signature = signature
+        logger.info(f"Saved prefixes: {pending}")
+        logger.debug(f"Total stored prefixes: {stored}")
+
+    def update(self, new_prefixes: dict):
+        """Adds or replaces prefixes in memory, they are written to the file in the background."""
+        with self._lock:
+            changed = {prefix: uri for prefix, uri in new_prefixes.items() if self._prefixes.get(prefix) != uri}
+            if not changed:
+                return
+            self._prefixes.update(changed)
+            self._pending.update(changed)
+            self._start()
+        self._wakeup.set()
+
+    def get(self) -> dict:
+        with self._lock:
+            self._start()
+            return dict(self._prefixes)
+
+    def _start(self):
+        # Called with the lock held: the background thread is started on first use
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="prefix-registry", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                self.reload()
+            except Exception as e:
+                logger.error(f"Error synchronizing prefixes with {self.path}: {e}")
+
+
+prefix_registry = PrefixRegistry(PREFIX_FILE, PREFIX_FLUSH_INTERVAL)
 
 
 def save_prefixes(new_prefixes: dict):
-    """Save new prefixes to the JSON file, merging with existing ones."""
-    existing = {}
-    if os.path.exists(PREFIX_FILE):
-        with open(PREFIX_FILE, "r", encoding="utf-8") as f:
-            existing = json.load(f)
-
-    # Update existing prefixes with new ones
-    existing.update(new_prefixes)
-
-    with open(PREFIX_FILE, "w", encoding="utf-8") as f:
-        json.dump(existing, f, indent=2, ensure_ascii=False)
-
- 
-    logger.info(f"Saved prefixes: {new_prefixes}")
-    logger.info(f"Total stored prefixes: {existing}")
+    """Save new prefixes in the registry, merging with existing ones (the JSON file is written in the background)."""
+    prefix_registry.update(new_prefixes)
 
 def load_prefixes() -> dict:
-    """Load prefixes from the JSON file."""
-    if not os.path.exists(PREFIX_FILE):
-        return {}
-    with open(PREFIX_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-# saving prefixes
-def extract_prefixes(ttl_text: str) -> dict:
-    prefix_pattern = r"@prefix\s+([a-zA-Z0-9\-_]+):\s+<([^>]+)>"
-    matches = re.findall(prefix_pattern, ttl_text)
-    prefix_dict = {match[0]: match[1] for match in matches}
+    """Load prefixes from the registry (the JSON file is only read again when it changes)."""
+    return prefix_registry.get()
+
+def get_graph_prefixes(graph: Graph) -> dict:
+    """
+    Prefixes declared by the parsed document (Turtle @prefix, JSON-LD @context) and the core ones (rdf, rdfs, owl, xsd, xml).
+    The graph must be parsed with bind_namespaces="core": rdflib's other default prefixes are not declared by the
+    document, and a document redefining one of them would get it renamed (e.g. 'schema1').
+    """
+    prefix_dict = {prefix: str(uri) for prefix, uri in graph.namespaces()}
     logger.info(f"Extracted prefixes: {prefix_dict}")
     return prefix_dict
 
 
-def extract_classes(ttl_text: str) -> list:
-    """Extracts classes from TTL content by finding objects of 'a' (rdf:type) statements."""
-    class_pattern = re.compile(r'\s+a\s+([\w\-]+:[\w\-]+)\s*[,;.]')
-    return sorted(set(class_pattern.findall(ttl_text)))
-
-def extract_properties(ttl_text: str) -> list:
-    """Extracts properties (predicates) from TTL content."""
-    property_pattern = re.compile(r'^\s*([\w\-]+:[\w\-]+)\s+', re.MULTILINE)
-    return sorted(set(property_pattern.findall(ttl_text)))
-
-def save_prefixes_and_entities(prefixes: dict, ttl_text: str, output_path="/logs/for_RAG.json"):
-    """Save prefixes, classes, properties, and abstract patterns into one JSON file for prompt usage."""
-    classes = extract_classes(ttl_text)
-    properties = extract_properties(ttl_text)
-
-    g = Graph()
-    patterns = {}
-
-    try:
-        g.parse(data=ttl_text, format="turtle")
-    except Exception as e:
-        logger.error(f"Failed to parse TTL for extracting patterns: {e}")
-    else:
-        # Step 1: Map each subject to its rdf:type
+class SchemaIndex:
+    """
+    Cumulative schema of every inserted document, used in the RAG prompt: classes, properties, the properties
+    of the instances of every class and the datatypes of every property (kept as full IRIs).
+    It is updated in memory from the graph parsed on insertion. As in PrefixRegistry, a background thread writes
+    the file when the schema grew (compact JSON with the known prefixes, merged with its current content under
+    a file lock and replaced atomically) and reads it again when another process changes it.
+    """
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self.classes = set()
+        self.properties = set()
+        self.patterns = {}
+        self._changed = False
+        self._signature = None
+        self._wakeup = Event()
+        self._thread = None
+        self.reload()
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _read_file(self) -> tuple:
+        if not os.path.exists(self.path):
+            return set(), set(), {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        prefixes = data.get("prefixes", {})
+        def expand(name):
+            # Files written before the schema was cumulative use prefixed names
+            prefix, _, local_name = name.partition(":")
+            return prefixes[prefix] + local_name if prefix in prefixes else name
+        classes = {expand(cls) for cls in data.get("classes", [])}
+        properties = {expand(prop) for prop in data.get("properties", [])}
+        patterns = {expand(key): {expand(value) for value in values} for key, values in data.get("patterns", {}).items()}
+        return classes, properties, patterns
+
+    def _merge(self, classes: set, properties: set, patterns: dict):
+        # Called with the lock held
+        self.classes |= classes
+        self.properties |= properties
+        for key, values in patterns.items():
+            self.patterns.setdefault(key, set()).update(values)
+
+    def reload(self):
+        """Merges the file into the schema in memory if it changed since it was last read or written."""
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        try:
+            stored = self._read_file()
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read the RAG schema from {self.path}: {e}")
+            return
+        with self._lock:
+            self._merge(*stored)
+            self._signature = signature
+        logger.info(f"RAG schema loaded from {self.path}: {len(self.classes)} classes, {len(self.properties)} properties")
+
+    def update(self, graph: Graph) -> bool:
+        """Adds the schema of a parsed graph. Returns True if the schema grew (the file is written in the background)."""
         subject_classes = {}
-        for s, _, o in g.triples((None, RDF.type, None)):
-            subject_classes.setdefault(s, set()).add(o)
-
-        # Step 2: For each triple, add predicate to the subject's class pattern
-        for s, p, o in g:
+        for s, _, o in graph.triples((None, RDF.type, None)):
+            subject_classes.setdefault(s, set()).add(str(o))
+        classes = set().union(*subject_classes.values())
+        properties, patterns = set(), {}
+        for s, p, o in graph:
+            properties.add(str(p))
             if p == RDF.type:
-                continue  # Skip rdf:type itself here
-            for cls in subject_classes.get(s, []):
-                patterns.setdefault(str(cls), set()).add(str(p))
-
-            # Also capture predicate -> datatype mapping if literal with datatype
+                continue
+            for cls in subject_classes.get(s, ()):
+                patterns.setdefault(cls, set()).add(str(p))
             if isinstance(o, Literal) and o.datatype:
                 patterns.setdefault(str(p), set()).add(str(o.datatype))
-
-    # Convertir URIs a prefijos
-    def to_prefixed(uri):
-        for prefix, ns in g.namespaces():
-            if uri.startswith(str(ns)):
-                return f"{prefix}:{uri[len(str(ns)):]}"
-        return uri
-
-    patterns_prefixed = {
-        to_prefixed(k): sorted([to_prefixed(v) for v in vs])
-        for k, vs in patterns.items()
-    }
-
-    data = {
-        "prefixes": prefixes,
-        "classes": sorted(classes),
-        "properties": sorted(properties),
-        "patterns": patterns_prefixed
-    }
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-    logger.info(f"Saved RAG data (prefixes + classes + properties + patterns) to {output_path}")
-
+        with self._lock:
+            changed = not (classes <= self.classes and properties <= self.properties
+                           and all(values <= self.patterns.get(key, set()) for key, values in patterns.items()))
+            if not changed:
+                return False
+            self._merge(classes, properties, patterns)
+            self._changed = True
+            self._start()
+        self._wakeup.set()
+        return True
+
+    def flush(self):
+        """Writes the schema if it grew since the last flush, merged with the current content of the file."""
+        with self._lock:
+            if not self._changed:
+                return
+            self._changed = False
+            classes, properties = set(self.classes), set(self.properties)
+            patterns = {key: set(values) for key, values in self.patterns.items()}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(os.path.join(directory, f".{os.path.basename(self.path)}.lock"), "w") as lock_file:
+                # Other processes merge their schema into the same file
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                stored_classes, stored_properties, stored_patterns = self._read_file()
+                classes |= stored_classes
+                properties |= stored_properties
+                for key, values in stored_patterns.items():
+                    patterns.setdefault(key, set()).update(values)
+                data = {
+                    "prefixes": load_prefixes(),
+                    "classes": sorted(classes),
+                    "properties": sorted(properties),
+                    "patterns": {key: sorted(values) for key, values in sorted(patterns.items())}
+                }
+                with open(temporary_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, separators=(",", ":"), ensure_ascii=False)
+                os.replace(temporary_path, self.path)
+                signature = self._file_signature()
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to write the RAG schema to {self.path}: {e}")
+            with self._lock:
+                self._changed = True
+            return
+        with self._lock:
+            self._merge(classes, properties, patterns)
+            self._signature = signature
+        logger.info(f"Saved RAG schema ({len(classes)} classes, {len(properties)} properties) to {self.path}")
+
+    def _start(self):
+        # Called with the lock held: the background thread is started on first use
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="rag-schema-index", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                self.reload()
+            except Exception as e:
+                logger.error(f"Error synchronizing the RAG schema with {self.path}: {e}")
+
+    def get_rag_data(self) -> dict:
+        """Returns the prefixes, classes, properties and patterns with the IRIs shortened with the known prefixes."""
+        with self._lock:
+            self._start()
+        prefixes = load_prefixes()
+        # The longest namespace is the most specific one
+        namespaces = sorted(((uri, prefix) for prefix, uri in prefixes.items()), key=lambda item: len(item[0]), reverse=True)
+        def to_prefixed(uri):
+            for namespace, prefix in namespaces:
+                if uri.startswith(namespace):
+                    return f"{prefix}:{uri[len(namespace):]}"
+            return uri
+        with self._lock:
+            return {
+                "prefixes": prefixes,
+                "classes": sorted(to_prefixed(cls) for cls in self.classes),
+                "properties": sorted(to_prefixed(prop) for prop in self.properties),
+                "patterns": {to_prefixed(key): sorted(to_prefixed(value) for value in values) for key, values in sorted(self.patterns.items())}
+            }
+
+
+schema_index = SchemaIndex(RAG_SCHEMA_FILE, PREFIX_FLUSH_INTERVAL)
@@ -0,0 +1,67 @@
+import os
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+
+# Child of the model_V logger, so it is written to the same file
+logger = logging.getLogger("mod_history_virt.client")
+
+VIRTUOSO_SPARQL_ENDPOINT = os.getenv("VIRTUOSO_ENDPOINT", "http://amor-segb-virtuoso:8890/sparql-auth")
+# SPARQL 1.1 Graph Store HTTP Protocol endpoint (used to load RDF documents into a graph)
+VIRTUOSO_GRAPH_STORE_ENDPOINT = os.getenv("VIRTUOSO_GRAPH_STORE_ENDPOINT", "http://amor-segb-virtuoso:8890/sparql-graph-crud-auth")
+VIRTUOSO_USER = os.getenv("VIRTUOSO_USER", "dba")
+VIRTUOSO_PASSWORD = os.getenv("DBA_PASSWORD", "viryourbear")
+
+# Keep-alive connections to Virtuoso kept open for reuse (requests beyond this open short-lived connections)
+VIRTUOSO_POOL_SIZE = int(os.getenv("VIRTUOSO_POOL_SIZE", "20"))
+# Seconds to connect to Virtuoso and to wait for its response (the read timeout also bounds slow queries)
+VIRTUOSO_CONNECT_TIMEOUT = float(os.getenv("VIRTUOSO_CONNECT_TIMEOUT", "5"))
+VIRTUOSO_READ_TIMEOUT = float(os.getenv("VIRTUOSO_READ_TIMEOUT", "120"))
+
+# A single session for every call to Virtuoso: the connections are reused instead of opening one per call,
+# and the digest auth keeps the last nonce (per thread), so only the first call of each thread
+# (or one with an expired nonce) pays the 401 challenge round trip.
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=VIRTUOSO_POOL_SIZE))
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=VIRTUOSO_POOL_SIZE))
+session.auth = HTTPDigestAuth(VIRTUOSO_USER, VIRTUOSO_PASSWORD)
+
+logger.info(f"Virtuoso client ready: {VIRTUOSO_SPARQL_ENDPOINT} (pool size: {VIRTUOSO_POOL_SIZE})")
+
+def get(params: dict = None, headers: dict = None, timeout: float = None, **kwargs) -> requests.Response:
+    '''
+    GET request to the Virtuoso SPARQL endpoint through the shared session.
+    '''
+    return session.get(
+        VIRTUOSO_SPARQL_ENDPOINT,
+        params=params,
+        headers=headers,
+        timeout=(VIRTUOSO_CONNECT_TIMEOUT, timeout or VIRTUOSO_READ_TIMEOUT),
+        **kwargs
+    )
+
+def post(data=None, headers: dict = None, timeout: float = None, **kwargs) -> requests.Response:
+    '''
+    POST request to the Virtuoso SPARQL endpoint through the shared session.
+    '''
+    return session.post(
+        VIRTUOSO_SPARQL_ENDPOINT,
+        data=data,
+        headers=headers,
+        timeout=(VIRTUOSO_CONNECT_TIMEOUT, timeout or VIRTUOSO_READ_TIMEOUT),
+        **kwargs
+    )
+
+def post_graph(data: bytes, graph_uri: str, content_type: str = "application/n-triples", timeout: float = None) -> requests.Response:
+    '''
+    Adds the triples of an RDF document to a graph with the Graph Store HTTP Protocol
+    (POST merges them with the triples already in the graph), through the shared session.
+    '''
+    return session.post(
+        VIRTUOSO_GRAPH_STORE_ENDPOINT,
+        params={"graph-uri": graph_uri},
+        data=data,
+        headers={"Content-Type": content_type},
+        timeout=(VIRTUOSO_CONNECT_TIMEOUT, timeout or VIRTUOSO_READ_TIMEOUT)
+    )
@@ -0,0 +1,235 @@
+from rdflib import Graph
+from rdflib.store import Store
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+
+import logging
+import os
+
+logger = logging.getLogger("segb.server.utils.compact_store")
+
+logger.info("Loading module utils.compact_store...")
+
+# Triples added after the indexes were built are kept apart until there are this many (or 1/8 of the store)
+COMPACT_STORE_PENDING_TRIPLES = int(os.getenv("COMPACT_STORE_PENDING_TRIPLES", "50000"))
+
+# -------- READ-OPTIMIZED IN-MEMORY TRIPLE STORE ----------- #
+
+class CompactIndex:
+    '''
+    Immutable SPO/POS/OSP indexes of a set of triples encoded as integer term IDs.
+    The triples are kept sorted by (subject, predicate, object) in three typed arrays, the POS and OSP
+    permutations are arrays of positions in them, and every permutation has the offsets where each
+    term ID starts (so the triples of a subject, predicate or object are found without searching).
+    '''
+    def __init__(self, triples: list, terms_count: int):
+        triples.sort()
+        self.subjects = array('I', (triple[0] for triple in triples))
+        self.predicates = array('I', (triple[1] for triple in triples))
+        self.objects = array('I', (triple[2] for triple in triples))
+        positions = range(len(triples))
+        self.pos = array('I', sorted(positions, key=lambda i: (triples[i][1], triples[i][2], triples[i][0])))
+        self.osp = array('I', sorted(positions, key=lambda i: (triples[i][2], triples[i][0], triples[i][1])))
+        self.subject_offsets = self.get_offsets(self.subjects, terms_count)
+        self.predicate_offsets = self.get_offsets(array('I', (self.predicates[i] for i in self.pos)), terms_count)
+        self.object_offsets = self.get_offsets(array('I', (self.objects[i] for i in self.osp)), terms_count)
+
+    @staticmethod
+    def get_offsets(sorted_ids: array, terms_count: int) -> array:
+        offsets = array('I', bytes(4 * (terms_count + 1)))
+        for term_id in sorted_ids:
+            offsets[term_id + 1] += 1
+        for term_id in range(terms_count):
+            offsets[term_id + 1] += offsets[term_id]
+        return offsets
+
+    def __len__(self) -> int:
+        return len(self.subjects)
+
+    def match(self, s: int, p: int, o: int):
+        '''
+        Yields the positions of the triples matching the pattern (None matches any term).
+        '''
+        if s is not None:
+            if s + 1 >= len(self.subject_offsets):
+                return
+            start, end = self.subject_offsets[s], self.subject_offsets[s + 1]
+            if p is not None:
+                start, end = bisect_left(self.predicates, p, start, end), bisect_right(self.predicates, p, start, end)
+                if o is not None:
+                    start, end = bisect_left(self.objects, o, start, end), bisect_right(self.objects, o, start, end)
+                yield from range(start, end)
+            elif o is not None:
+                # The subject is usually more selective, but the object ID is searched in the OSP range of o
+                if o + 1 >= len(self.object_offsets):
+                    return
+                start, end = self.object_offsets[o], self.object_offsets[o + 1]
+                subjects = self.subjects
+                start = bisect_left(self.osp, s, start, end, key=lambda i: subjects[i])
+                end = bisect_right(self.osp, s, start, end, key=lambda i: subjects[i])
+                yield from self.osp[start:end]
+            else:
+                yield from range(start, end)
+        elif p is not None:
+            if p + 1 >= len(self.predicate_offsets):
+                return
+            start, end = self.predicate_offsets[p], self.predicate_offsets[p + 1]
+            if o is not None:
+                objects = self.objects
+                start = bisect_left(self.pos, o, start, end, key=lambda i: objects[i])
+                end = bisect_right(self.pos, o, start, end, key=lambda i: objects[i])
+            yield from self.pos[start:end]
+        elif o is not None:
+            if o + 1 >= len(self.object_offsets):
+                return
+            yield from self.osp[self.object_offsets[o]:self.object_offsets[o + 1]]
+        else:
+            yield from range(len(self.subjects))
+
+class CompactStore(Store):
+    '''
+    Read-optimized rdflib store. Terms are interned to integer IDs and the triples are indexed
+    in typed arrays (see CompactIndex), which takes several times less memory than the default store.
+    It is meant for graphs that are loaded once and then mostly read: triples added later are kept
+    in a small pending index until they are merged into the arrays. Triples cannot be removed.
+    '''
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None):
+        super().__init__(configuration)
+        self.identifier = identifier
+        self._terms = []
+        self._ids = {}
+        # Index, pending triples and pending triples by term ID, replaced at once when the index is rebuilt
+        self._state = (CompactIndex([], 0), set(), {})
+        self._write_lock = Lock()
+        self._namespace = {}
+        self._prefix = {}
+
+    def load(self, triples) -> None:
+        '''
+        Adds the triples of an empty store at once and builds the indexes.
+        '''
+        with self._write_lock:
+            index, pending, _ = self._state
+            if len(index) or pending:
+                raise ValueError("Triples can only be loaded in an empty CompactStore")
+            encoded_triples = {tuple(self._encode(term) for term in triple) for triple in triples}
+            self._state = (CompactIndex(list(encoded_triples), len(self._terms)), set(), {})
+            logger.debug(f"Compact store loaded ({len(encoded_triples)} triples, {len(self._terms)} terms)")
+
+    def _encode(self, term) -> int:
+        term_id = self._ids.get(term)
+        if term_id is None:
+            term_id = self._ids[term] = len(self._terms)
+            self._terms.append(term)
+        return term_id
+
+    def _rebuild(self) -> None:
+        index, pending, _ = self._state
+        triples = list(pending)
+        triples.extend(zip(index.subjects, index.predicates, index.objects))
+        # Readers keep using the previous state until the new one is complete
+        self._state = (CompactIndex(triples, len(self._terms)), set(), {})
+        logger.debug(f"Compact store indexes rebuilt ({len(triples)} triples, {len(self._terms)} terms)")
+
+    def add(self, triple, context=None, quoted=False) -> None:
+        with self._write_lock:
+            index, pending, pending_by_term = self._state
+            encoded_triple = tuple(self._encode(term) for term in triple)
+            if encoded_triple in pending or next(index.match(*encoded_triple), None) is not None:
+                return
+            pending.add(encoded_triple)
+            for term_id in set(encoded_triple):
+                pending_by_term.setdefault(term_id, []).append(encoded_triple)
+            if len(pending) > max(COMPACT_STORE_PENDING_TRIPLES, len(index) // 8):
+                self._rebuild()
+
+    def copy(self, triples=()) -> "CompactStore":
+        '''
+        Returns a new store with the triples of this one and the given ones, leaving this one unchanged,
+        so the readers of this store keep a consistent view. The index is immutable and the term tables
+        only grow, so they are shared (with the write lock); only the small pending index is copied.
+        '''
+        with self._write_lock:
+            store = CompactStore(identifier=self.identifier)
+            store._terms, store._ids, store._write_lock = self._terms, self._ids, self._write_lock
+            index, pending, pending_by_term = self._state
+            store._state = (index, set(pending), {term_id: list(encoded_triples) for term_id, encoded_triples in pending_by_term.items()})
+            store._namespace, store._prefix = dict(self._namespace), dict(self._prefix)
+        for triple in triples:
+            store.add(triple)
+        return store
+
+    def remove(self, triple, context=None) -> None:
+        raise TypeError("Triples cannot be removed from a CompactStore")
+
+    def triples(self, triple_pattern, context=None):
+        ids = []
+        for term in triple_pattern:
+            if term is None:
+                ids.append(None)
+            else:
+                term_id = self._ids.get(term)
+                if term_id is None:
+                    return
+                ids.append(term_id)
+        terms = self._terms
+        index, pending, pending_by_term = self._state
+        for position in index.match(*ids):
+            yield (terms[index.subjects[position]], terms[index.predicates[position]], terms[index.objects[position]]), iter(())
+        bound_ids = [term_id for term_id in ids if term_id is not None]
+        pending = list(pending_by_term.get(bound_ids[0], ())) if bound_ids else list(pending)
+        for encoded_triple in pending:
+            if all(term_id is None or term_id == encoded_id for term_id, encoded_id in zip(ids, encoded_triple)):
+                yield tuple(terms[term_id] for term_id in encoded_triple), iter(())
+
+    def __len__(self, context=None) -> int:
+        index, pending, _ = self._state
+        return len(index) + len(pending)
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def bind(self, prefix, namespace, override=True) -> None:
+        # Same behaviour as the default rdflib store
+        bound_namespace = self._namespace.get(prefix)
+        bound_prefix = self._prefix.get(namespace)
+        if bound_prefix is None:
+            bound_prefix = self._prefix.get(bound_namespace)
+        if override:
+            if bound_prefix is not None:
+                del self._namespace[bound_prefix]
+            if bound_namespace is not None:
+                del self._prefix[bound_namespace]
+            self._prefix[namespace] = prefix
+            self._namespace[prefix] = namespace
+        else:
+            namespace_key = bound_namespace if bound_namespace is not None else namespace
+            prefix_key = bound_prefix if bound_prefix is not None else prefix
+            self._prefix[namespace_key] = prefix_key
+            self._namespace[prefix_key] = namespace_key
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace)
+
+    def namespaces(self):
+        yield from list(self._namespace.items())
+
+def get_compact_graph(graph: Graph) -> Graph:
+    '''
+    Returns a copy of the graph (triples and prefixes) backed by a CompactStore.
+    '''
+    store = CompactStore()
+    compact_graph = Graph(store=store, bind_namespaces="none")
+    for prefix, namespace in graph.namespaces():
+        compact_graph.bind(prefix, namespace)
+    store.load(graph)
+    return compact_graph
@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
+import multiprocessing
+import asyncio
+import functools
+
+import logging
+import os
+
+logger = logging.getLogger("segb.server.utils.executor")
+
+logger.info("Loading module utils.executor...")
+
+# Maximum number of blocking calls (database access, RDF parsing and serialization) running at the same time
+EXECUTOR_MAX_WORKERS = int(os.getenv("EXECUTOR_MAX_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix="segb-executor")
+
+logger.info(f"Executor for blocking calls started with {EXECUTOR_MAX_WORKERS} workers")
+
+# Processes used to parse big line-based RDF documents in chunks (0 parses them in the calling thread).
+# They only pay off with spare cores, as the parsed triples still have to be sent back and added to the graph
+PARSER_PROCESSES = int(os.getenv("PARSER_PROCESSES", str(min(4, (os.cpu_count() or 1) - 1))))
+
+parser_pool = None
+parser_pool_lock = Lock()
+
+def get_parser_pool() -> ProcessPoolExecutor | None:
+    '''
+    Returns the pool of parser processes, started the first time it is needed (None if it is disabled).
+    The processes are spawned, not forked, so they do not inherit the locks held by the threads of the server.
+    '''
+    global parser_pool
+    if PARSER_PROCESSES <= 0:
+        return None
+    with parser_pool_lock:
+        if parser_pool is None:
+            parser_pool = ProcessPoolExecutor(max_workers=PARSER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+            logger.info(f"Parser pool started with {PARSER_PROCESSES} processes")
+    return parser_pool
+
+# -------- AUX FUNCTIONS TO KEEP BLOCKING CALLS OUT OF THE EVENT LOOP ----------- #
+
+async def run_blocking(function, *args, **kwargs):
+    '''
+    Runs a blocking function in the bounded executor and waits for its result
+    without blocking the event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(function, *args, **kwargs))
+
+async def iterate_blocking(iterator):
+    '''
+    Yields the items of a blocking iterator (e.g. over a database cursor) without blocking the event loop,
+    fetching each one in the bounded executor.
+    '''
+    end = object()
+    while True:
+        item = await run_blocking(next, iterator, end)
+        if item is end:
+            return
+        yield item
+
+def make_async(function):
+    '''
+    Returns an awaitable version of a blocking function that runs in the bounded executor.
+    '''
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(function, *args, **kwargs)
+    return wrapper
@@ -1,12 +1,83 @@
-from rdflib import Namespace, Graph, URIRef
+from rdflib import Namespace, Graph, URIRef, RDF, PROV
+from datetime import datetime, timezone
 from rdflib.query import Result
-import os
+from rdflib.plugins.sparql import prepareQuery
 import logging
 
 logger = logging.getLogger("segb.server.utils.experiments")
 
 logger.info("Loading module utils.experiments...")
 
+SEGB = Namespace("http://www.gsi.upm.es/ontologies/segb/ns#")
+AMOR_EXP = Namespace("http://www.gsi.upm.es/ontologies/amor/experiments/ns#")
+ORO = Namespace("http://kb.openrobots.org#")
+
+# -------- PREPARED EXPERIMENT QUERIES ----------- #
+# Parsed and translated once at import, the experiment URI is given in initBindings on every call
+
+EXPERIMENT_QUERY_NAMESPACES = {"segb": SEGB, "amor-exp": AMOR_EXP, "oro": ORO}
+
+EXPERIMENT_QUERY = prepareQuery("""
+    SELECT ?predicate ?object
+    WHERE {
+        ?experiment_uri a amor-exp:Experiment .
+        ?experiment_uri ?predicate ?object .
+    }
+    """, initNs=EXPERIMENT_QUERY_NAMESPACES)
+
+LOGGED_ACTIVITIES_QUERY = prepareQuery("""
+    DESCRIBE ?activity
+    WHERE {
+        ?activity a segb:LoggedActivity .
+        ?activity amor-exp:isRelatedWithExperiment ?experiment_uri .
+    }
+    """, initNs=EXPERIMENT_QUERY_NAMESPACES)
+
+LOGGED_MESSAGES_QUERY = prepareQuery("""
+    DESCRIBE ?message
+    WHERE {
+        ?activity a segb:LoggedActivity ;
+            amor-exp:isRelatedWithExperiment ?experiment_uri ;
+            oro:hasMessage ?message .
+    }
+    """, initNs=EXPERIMENT_QUERY_NAMESPACES)
+
+EXPERIMENT_LIST_QUERY = prepareQuery("""
+    SELECT ?experiment_uri 
+    WHERE {
+        ?experiment_uri a amor-exp:Experiment .
+    }
+    """, initNs=EXPERIMENT_QUERY_NAMESPACES)
+
+# The three parts of the experiment graph are alternatives (UNION): as consecutive OPTIONALs
+# every activity triple was combined with every message triple before building the graph
+SINGLE_EXPERIMENT_GRAPH_QUERY = prepareQuery("""
+    CONSTRUCT { 
+        ?experiment_uri ?experiment_predicate ?experiment_object .
+        ?activity_uri ?activity_predicate ?activity_object .
+        ?msg_uri ?message_predicate ?message_object .
+    }
+    WHERE {
+        ?experiment_uri a amor-exp:Experiment .
+        {
+            ?experiment_uri ?experiment_predicate ?experiment_object .
+        }
+        UNION
+        {
+            ?activity_uri amor-exp:isRelatedWithExperiment ?experiment_uri .
+
+            ?activity_uri ?activity_predicate ?activity_object .
+        }
+        UNION
+        {
+            ?activity amor-exp:isRelatedWithExperiment ?experiment_uri ;
+                oro:hasMessage ?msg_uri .
+
+            ?msg_uri ?message_predicate ?message_object .
+        }
+    }
+    """, initNs=EXPERIMENT_QUERY_NAMESPACES)
+
 # -------- AUX FUNCTIONS FOR AMOR EXPERIMENTS QUERIES ----------- # 
 
 def get_experiment(graph: Graph, namespace: str, experiment_id: str):
@@ -22,19 +93,9 @@ def get_experiment(graph: Graph, namespace: str, experiment_id: str):
     # Define the specific experiment
     ns = Namespace(namespace)
     experiment_uri = ns[experiment_id]
-    # Define the SPARQL query
     logger.info(f"Getting experiment details for {experiment_uri}")
-    query = f"""
-    PREFIX amor-exp: <http://www.gsi.upm.es/ontologies/amor/experiments/ns#>
-
-    SELECT ?predicate ?object
-    WHERE {{
-        <{experiment_uri}> a amor-exp:Experiment .
-        <{experiment_uri}> ?predicate ?object .
-    }}
-    """
     # Execute the query
-    results = graph.query(query)
+    results = graph.query(EXPERIMENT_QUERY, initBindings={"experiment_uri": experiment_uri})
     # Return the results
     logger.info(f"Experiment details for {experiment_uri} retrieved successfully.")
     return experiment_uri, results
@@ -52,20 +113,9 @@ def get_logged_activities(graph: Graph, namespace: str, experiment_id: str) -> R
     # Define the specific experiment
     ns = Namespace(namespace)
     experiment_uri: URIRef = ns[experiment_id]
-    # Define the SPARQL query
     logger.info(f"Getting logged activities for {experiment_uri}")
-    query = f"""
-    PREFIX segb: <http://www.gsi.upm.es/ontologies/segb/ns#>
-    PREFIX amor-exp: <http://www.gsi.upm.es/ontologies/amor/experiments/ns#>
-    
-    DESCRIBE ?activity
-    WHERE {{
-        ?activity a segb:LoggedActivity .
-        ?activity amor-exp:isRelatedWithExperiment <{experiment_uri}> .
-    }}
-    """
     # Execute the query
-    results = graph.query(query)
+    results = graph.query(LOGGED_ACTIVITIES_QUERY, initBindings={"experiment_uri": experiment_uri})
     logger.info(f"Logged activities for {experiment_uri} retrieved successfully.")
     # Return the results
     return results
@@ -85,20 +135,7 @@ def get_logged_messages(graph: Graph, namespace: str, experiment_id: str) -> Res
     experiment_uri: URIRef = ns[experiment_id]
 
     logger.info(f"Getting logged messages for {experiment_uri}")
-    query = f"""
-    PREFIX segb: <http://www.gsi.upm.es/ontologies/segb/ns#>
-    PREFIX amor-exp: <http://www.gsi.upm.es/ontologies/amor/experiments/ns#>
-    PREFIX oro: <http://kb.openrobots.org#>
-    
-    DESCRIBE ?message
-    WHERE {{
-        ?activity a segb:LoggedActivity ;
-            amor-exp:isRelatedWithExperiment <{experiment_uri}> ;
-            oro:hasMessage ?message .
-    }}
-    """
-
-    results = graph.query(query)
+    results = graph.query(LOGGED_MESSAGES_QUERY, initBindings={"experiment_uri": experiment_uri})
     logger.info(f"Logged messages for {experiment_uri} retrieved successfully.")
 
     return results
@@ -158,17 +195,8 @@ def get_experiment_list(graph: Graph) -> dict:
     Returns:
         dict: A dictionary containing the experiment URIs.
     '''
-    # Define the SPARQL query
     logger.info("Getting list of experiments...")
-    query = """
-        PREFIX amor-exp: <http://www.gsi.upm.es/ontologies/amor/experiments/ns#>
-        
-        SELECT ?experiment_uri 
-        WHERE {
-            ?experiment_uri a amor-exp:Experiment .
-        }
-    """
-    result = graph.query(query)
+    result = graph.query(EXPERIMENT_LIST_QUERY)
     return result.serialize(format="json", encoding="utf-8")
 
 def get_single_experiment_graph(graph: Graph, namespace: str, experiment_id: str) -> Graph:
@@ -184,39 +212,9 @@ def get_single_experiment_graph(graph: Graph, namespace: str, experiment_id: str
     # Define the specific experiment
     ns = Namespace(namespace)
     experiment_uri = ns[experiment_id]
-    # Define the SPARQL query
     logger.info(f"Getting experiment details for {experiment_uri}")
-    query = f"""
-    PREFIX segb: <http://www.gsi.upm.es/ontologies/segb/ns#>
-    PREFIX amor-exp: <http://www.gsi.upm.es/ontologies/amor/experiments/ns#>
-    PREFIX oro: <http://kb.openrobots.org#>
-
-    CONSTRUCT {{ 
-        <{experiment_uri}> ?experiment_predicate ?experiment_object .
-        ?activity_uri ?activity_predicate ?activity_object .
-        ?msg_uri ?message_predicate ?message_object .
-    }}
-    WHERE {{
-        <{experiment_uri}> a amor-exp:Experiment .
-        
-        <{experiment_uri}> ?experiment_predicate ?experiment_object .
-        
-        OPTIONAL {{
-            ?activity_uri amor-exp:isRelatedWithExperiment <{experiment_uri}> .
-
-            ?activity_uri ?activity_predicate ?activity_object .
-        }}
-        OPTIONAL {{
-            ?activity amor-exp:isRelatedWithExperiment <{experiment_uri}> ;
-                oro:hasMessage ?msg_uri .
-
-            ?msg_uri ?message_predicate ?message_object .
-            
-        }}
-    }}
-    """
     # Execute the query
-    results = graph.query(query)
+    results = graph.query(SINGLE_EXPERIMENT_GRAPH_QUERY, initBindings={"experiment_uri": experiment_uri})
     # Return the results
     logger.info(f"Experiment details for {experiment_uri} retrieved successfully.")
     resulting_graph = Graph()
@@ -226,4 +224,71 @@ def get_single_experiment_graph(graph: Graph, namespace: str, experiment_id: str
     for triple in results:
         resulting_graph.add(triple)
     logger.debug(f"Resulting graph has {len(resulting_graph)} triples.")
-    return resulting_graph
\ No newline at end of file
+    return resulting_graph
+# -------- AUX FUNCTIONS FOR THE EXPERIMENT INDEX ----------- # 
+
+def get_experiment_index_entries(graph: Graph) -> tuple:
+    '''
+    Get the experiments declared in a graph and the links between activities, experiments and messages.
+    Used to keep the experiment index up to date on every insertion.
+    Args:
+        graph (Graph): The RDF graph with the new triples.
+    Returns:
+        tuple: The list of experiment URIs and a dictionary with the experiments, messages, agents,
+            the start and end times and whether it is typed as segb:LoggedActivity of every activity
+            (keyed by the N3 representation of the activity).
+    '''
+    experiments = [str(experiment) for experiment in graph.subjects(RDF.type, AMOR_EXP.Experiment)]
+    activities = {}
+    def get_entry(activity):
+        return activities.setdefault(activity.n3(), {"experiments": set(), "messages": set(), "agents": set(), "started_at": None, "ended_at": None, "logged": False})
+    for activity in graph.subjects(RDF.type, SEGB.LoggedActivity):
+        get_entry(activity)["logged"] = True
+    for activity, experiment in graph.subject_objects(AMOR_EXP.isRelatedWithExperiment):
+        get_entry(activity)["experiments"].add(str(experiment))
+    for activity, message in graph.subject_objects(ORO.hasMessage):
+        get_entry(activity)["messages"].add(message.n3())
+    for activity, agent in graph.subject_objects(SEGB.wasPerformedBy):
+        get_entry(activity)["agents"].add(agent.n3())
+    for activity, time in graph.subject_objects(PROV.startedAtTime):
+        started_at = get_utc_datetime(time)
+        if started_at is not None:
+            entry = get_entry(activity)
+            entry["started_at"] = min(filter(None, (entry["started_at"], started_at)))
+    for activity, time in graph.subject_objects(PROV.endedAtTime):
+        ended_at = get_utc_datetime(time)
+        if ended_at is not None:
+            entry = get_entry(activity)
+            entry["ended_at"] = max(filter(None, (entry["ended_at"], ended_at)))
+    return experiments, activities
+
+def get_utc_datetime(time) -> datetime | None:
+    '''
+    Get the value of an xsd:dateTime literal as a naive UTC datetime (as MongoDB returns them),
+    or None if it is not a valid date and time.
+    '''
+    value = time.toPython() if hasattr(time, "toPython") else None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def get_subjects_graph(graph: Graph, subjects: list) -> Graph:
+    '''
+    Get all the triples of the given subjects from the RDF graph
+    Args:
+        graph (Graph): The RDF graph to query.
+        subjects (list): The subjects (rdflib terms) to retrieve.
+    Returns:
+        Graph: A graph containing the triples of the subjects.
+    '''
+    resulting_graph = Graph()
+    resulting_graph.bind("segb", SEGB)
+    resulting_graph.bind("amor-exp", AMOR_EXP)
+    resulting_graph.bind("oro", ORO)
+    for subject in subjects:
+        for triple in graph.triples((subject, None, None)):
+            resulting_graph.add(triple)
+    logger.debug(f"Resulting graph has {len(resulting_graph)} triples.")
+    return resulting_graph
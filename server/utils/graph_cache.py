@@ -0,0 +1,135 @@
+from rdflib import Graph
+from utils.compact_store import CompactStore
+from threading import Lock
+import gzip
+
+import logging
+
+logger = logging.getLogger("segb.server.utils.graph_cache")
+
+logger.info("Loading module utils.graph_cache...")
+
+# -------- IN-PROCESS CACHE OF THE PARSED GRAPH ----------- #
+
+class GraphCache:
+    '''
+    Keeps the last parsed rdflib Graph together with the version of the stored graph it represents,
+    so repeated reads of an unchanged graph skip parsing entirely.
+    The cached Graph is shared between requests and must be treated as read-only by consumers.
+    Graphs bigger than max_triples are not cached (0 disables the cache).
+    '''
+    def __init__(self, max_triples: int):
+        self.max_triples = max_triples
+        self._lock = Lock()
+        self._version = None
+        self._graph = None
+
+    def get(self, version) -> Graph | None:
+        with self._lock:
+            if version is not None and version == self._version:
+                logger.debug(f"Graph cache hit for version {version}")
+                return self._graph
+        logger.debug(f"Graph cache miss for version {version}")
+        return None
+
+    def put(self, version, graph: Graph) -> None:
+        with self._lock:
+            if version is None or len(graph) > self.max_triples:
+                logger.debug(f"Graph with {len(graph)} triples not cached (limit: {self.max_triples})")
+                self._version, self._graph = None, None
+                return
+            self._version, self._graph = version, graph
+            logger.debug(f"Graph cached for version {version} ({len(graph)} triples)")
+
+    def update(self, previous_version, version, new_triples: Graph) -> None:
+        '''
+        Applies an insertion to the cached graph if it represents exactly the previous version,
+        otherwise the cache is invalidated and the next read will parse the stored graph again.
+        The cached graph is not modified (readers may be using it): a new one is built and replaces it.
+        '''
+        with self._lock:
+            graph = self._graph
+            if graph is None or previous_version is None or previous_version != self._version:
+                self._version, self._graph = None, None
+                return
+            if len(graph) + len(new_triples) > self.max_triples:
+                logger.debug(f"Graph cache invalidated: limit of {self.max_triples} triples reached")
+                self._version, self._graph = None, None
+                return
+        updated_graph = get_updated_graph(graph, new_triples)
+        with self._lock:
+            if self._graph is not graph:
+                # Another insertion updated or invalidated the cache meanwhile
+                self._version, self._graph = None, None
+                return
+            self._version, self._graph = version, updated_graph
+            logger.debug(f"Graph cache updated to version {version} ({len(updated_graph)} triples)")
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version, self._graph = None, None
+
+def get_updated_graph(graph: Graph, new_triples: Graph) -> Graph:
+    '''
+    Returns a new graph with the triples and prefixes of the graph and the new ones (the graph is not modified).
+    Graphs in a compact store share most of their data with the new one, others are copied.
+    '''
+    if isinstance(graph.store, CompactStore):
+        updated_graph = Graph(store=graph.store.copy(new_triples), identifier=graph.identifier, bind_namespaces="none")
+    else:
+        updated_graph = Graph(identifier=graph.identifier, bind_namespaces="none")
+        for prefix, namespace in graph.namespaces():
+            updated_graph.bind(prefix, namespace)
+        updated_graph += graph
+        updated_graph += new_triples
+    for prefix, namespace in new_triples.namespaces():
+        updated_graph.bind(prefix, namespace, override=False)
+    return updated_graph
+
+# -------- IN-PROCESS CACHE OF THE SERIALIZED GRAPH ----------- #
+
+class TurtleSnapshot:
+    '''
+    Turtle serialization of one version of the stored graph.
+    The gzip version is only built the first time it is requested.
+    '''
+    def __init__(self, version, turtle: bytes, triples: int):
+        self.version = version
+        self.turtle = turtle
+        self.triples = triples
+        self._gzip = None
+
+    @property
+    def gzipped(self) -> bytes:
+        if self._gzip is None:
+            self._gzip = gzip.compress(self.turtle)
+        return self._gzip
+
+class SnapshotCache:
+    '''
+    Keeps the Turtle snapshot of the last requested graph version.
+    Snapshots bigger than max_bytes are not cached (0 disables the cache).
+    '''
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._snapshot = None
+
+    def get(self, version) -> TurtleSnapshot | None:
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.version == version:
+                logger.debug(f"Turtle snapshot cache hit for version {version}")
+                return self._snapshot
+        return None
+
+    def put(self, snapshot: TurtleSnapshot) -> None:
+        with self._lock:
+            if len(snapshot.turtle) > self.max_bytes:
+                logger.debug(f"Turtle snapshot of {len(snapshot.turtle)} bytes not cached (limit: {self.max_bytes})")
+                self._snapshot = None
+                return
+            self._snapshot = snapshot
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshot = None
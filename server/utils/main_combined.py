@@ -1,15 +1,16 @@
 from fastapi import FastAPI, HTTPException, Request, Depends, Query, status
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Annotated
+from typing import Annotated, Literal
 from utils.credentials import User, validate_token, Role
 from utils.Neo4j.model_N import store_modification, connect_to_db, get_recent_logs, get_logs_by_date, store_bulk_deletion
-from utils.Virtuoso.model_V import insert_ttl, get_ttls, run_custom_query, delete_all_triples
+from utils.Virtuoso.model_V import insert_ttl, get_events_pages, run_custom_query, delete_all_triples
+from utils.executor import run_blocking, iterate_blocking
 import logging
 import os
 from fastapi.responses import PlainTextResponse
-from rdflib import Graph
+import utils.semantic
 from asyncio import Lock # atomic transactions 
 from typing import Optional
 from utils.RAG import rag_with_sparql
@@ -58,10 +59,35 @@ class RAGBatchRequest(BaseModel):
 
 
 
-@app.post("/ttl")
+# Besides the JSON body with the Turtle content, the data can be sent as the body in any supported RDF media type
+# (the user is then given in the 'user' query parameter)
+TTL_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": TTLContent.model_json_schema()},
+            **{media_type: {"schema": {"type": "string"}} for media_type in utils.semantic.RDF_MEDIA_TYPES}
+        }
+    }
+}
+
+async def read_ttl_content(request: Request) -> tuple:
+    '''
+    Returns the content and user of the request and the rdflib format of the content, according to its Content-Type.
+    '''
+    body = await request.body()
+    media_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if media_type == "application/json":
+        try:
+            return TTLContent.model_validate_json(body), "turtle"
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Invalid TTL content: {str(e)}")
+    data = TTLContent(ttl_content=body.decode("utf-8"), user=request.query_params.get("user", ""))
+    return data, utils.semantic.get_rdf_format(media_type)
+
+@app.post("/ttl", openapi_extra=TTL_REQUEST_BODY)
 async def insert_ttl_combined(
     request: Request,
-    data: TTLContent,
     user: Annotated[User, Depends(validate_token)]
 ):
     logger.info(f"Received post for log from IP: {request.client.host} from user {user.name} (username: {user.username} - roles: {user.roles})")
@@ -72,6 +98,8 @@ async def insert_ttl_combined(
             detail="User does not have permission to perform this action"
         )
     
+    data, rdf_format = await read_ttl_content(request)
+
     if transaction_lock.locked():
         raise HTTPException(
             status_code=429,
@@ -84,7 +112,7 @@ async def insert_ttl_combined(
             actor = data.user or user.username or "anonymous"
 
             # Insert into Virtuoso
-            log_id = insert_ttl(data.ttl_content)
+            log_id = insert_ttl(data.ttl_content, rdf_format)
 
             # Store in Neo4j as insertion
             store_modification("insertion", origin_ip, actor, data.ttl_content)
@@ -100,7 +128,10 @@ async def insert_ttl_combined(
 
 
 @app.get("/events", response_class=PlainTextResponse) 
-async def get_events(user: Annotated[User, Depends(validate_token)]):
+async def get_events(
+    user: Annotated[User, Depends(validate_token)],
+    format: Literal["turtle", "nt"] = "turtle"
+):
     logger.info(f"Received request for log from user {user.name} (username: {user.username} - roles: {user.roles})")
     if not (Role.AUDITOR.value in user.roles or Role.ADMIN.value in user.roles):
         logger.info(f"User {user.name} (username: {user.username} - roles: {user.roles}) does not have permission to perform this action")
@@ -109,8 +140,12 @@ async def get_events(user: Annotated[User, Depends(validate_token)]):
             detail="User does not have permission to perform this action"
         )
     try:
-        ttl_data = get_ttls()       
-        return PlainTextResponse(content=ttl_data, media_type="text/turtle") # so that it returns in TTL format instead of serialized JSON
+        # The graph is streamed in pages as Virtuoso returns them, it is never loaded as a whole
+        pages = await run_blocking(get_events_pages, format)
+        return StreamingResponse(
+            iterate_blocking(pages),
+            media_type="application/n-triples" if format == "nt" else "text/turtle"
+        )
     except Exception as e:
         logger.exception("Failed fetching events")
         raise HTTPException(status_code=500, detail="Error fetching events")
@@ -174,26 +209,17 @@ async def delete_all_ttls(request: Request, data: DeleteRequest, user: Annotated
         origin_ip = request.client.host
         actor = data.user or user.username or "anonymous"
 
-        # Get all TTLs from Virtuoso
-        ttl_text = get_ttls()
-        if not ttl_text:
+        # Get all TTLs from Virtuoso (as N-Triples lines)
+        pages = await run_blocking(get_events_pages, "nt")
+        ttl_lines = [line async for page in iterate_blocking(pages) for line in page.splitlines()]
+        if not ttl_lines:
             return JSONResponse(content={"message": "No TTLs to delete"}, status_code=200)
 
-        # Convert TTL to RDF graph
-        g = Graph()
-        g.parse(data=ttl_text, format="turtle")
-
-        # Convert to TTL lines
-        ttl_lines = []
-        for s, p, o in g:
-            line = f"{s.n3()} {p.n3()} {o.n3()} ."
-            ttl_lines.append(line)
-
         # Save in Neo4j as deletion
-        store_bulk_deletion(origin_ip, actor, ttl_lines)
+        await run_blocking(store_bulk_deletion, origin_ip, actor, ttl_lines)
 
         # Delete graph
-        delete_all_triples()
+        await run_blocking(delete_all_triples)
 
         return JSONResponse(content={"message": "Graph cleared and deletions logged."}, status_code=200)
 
@@ -1,5 +1,19 @@
-from rdflib import Graph
+from rdflib import Graph, Dataset, URIRef, BNode, Literal
+from rdflib.graph import DATASET_DEFAULT_GRAPH_ID
+from rdflib.namespace import RDF, XSD, NamespaceManager
+from rdflib.parser import create_input_source
+from rdflib.plugins.parsers.jsonld import JsonLDParser
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+from rdflib.util import from_n3
+from functools import lru_cache
+from itertools import repeat
+from uuid import uuid4
+import utils.executor
 import json
+import time
+import io
 
 import logging
 import os
@@ -8,33 +22,302 @@ logger = logging.getLogger("segb.server.utils.semantic")
 
 logger.info("Loading module utils.semantic...")
 
+# Number of parsed and translated SPARQL queries kept in memory
+SPARQL_QUERY_CACHE_SIZE = int(os.getenv("SPARQL_QUERY_CACHE_SIZE", "256"))
+
+# Same compaction rules as rdflib's JSON-LD serializer with a prefixes-only context
+JSON_LD_VOCAB_DELIMITERS = ("#", "/", ":")
+JSON_LD_NATIVE_TYPES = {XSD.boolean, XSD.integer, XSD.double, XSD.string}
+
+# Media types accepted by the ingest endpoints and the rdflib format used to parse them
+RDF_MEDIA_TYPES = {
+    "text/turtle": "turtle",
+    "application/n-triples": "nt",
+    "application/n-quads": "nquads",
+    "application/ld+json": "json-ld",
+}
+# Formats with one statement per line, which can be parsed in independent chunks
+LINE_BASED_FORMATS = ("nt", "nquads")
+# Line-based documents with more lines than this are parsed in chunks spread over the parser processes
+PARSER_CHUNK_LINES = int(os.getenv("PARSER_CHUNK_LINES", "20000"))
+
 # -------- AUX FUNCTIONS FOR APP.PY ----------- # 
 
-def get_graph_from_ttl(data) -> Graph:
+def get_rdf_format(content_type: str) -> str:
+    '''
+        Returns the rdflib format of a Content-Type header.
+        Turtle is used when the header is missing or is not an RDF media type, as before the negotiation existed.
+    '''
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return RDF_MEDIA_TYPES.get(media_type, "turtle")
+
+def get_graph_from_data(data: str, rdf_format: str = "turtle", bind_namespaces: str = "rdflib") -> Graph:
+    '''
+        Parses a document into a new graph that binds the bind_namespaces prefixes of rdflib
+        ("core" keeps the prefixes declared by the document from being renamed because rdflib binds them by default).
+    '''
+    if rdf_format == "json-ld" and bind_namespaces != "rdflib":
+        return get_graph_from_json_ld_data(data, bind_namespaces)
+    graph = Graph(bind_namespaces=bind_namespaces)
+    parse_into_graph(graph, data, rdf_format)
+    return graph
+
+def get_graph_from_json_ld_data(data: str, bind_namespaces: str) -> Graph:
+    '''
+        rdflib's JSON-LD parser wraps a plain graph in a ConjunctiveGraph that binds all of rdflib's default prefixes,
+        so the document is parsed into a Dataset whose namespace manager only binds the bind_namespaces ones.
+        Returns the default graph of the dataset.
+    '''
+    dataset = Dataset()
+    dataset.namespace_manager = NamespaceManager(dataset, bind_namespaces)
+    JsonLDParser().parse(create_input_source(data=data, format="json-ld"), dataset)
+    return Graph(store=dataset.store, identifier=DATASET_DEFAULT_GRAPH_ID, bind_namespaces=bind_namespaces)
+
+def get_graph_from_ttl_documents(documents: list) -> Graph:
+    return get_graph_from_documents((data, "turtle") for data in documents)
+
+def get_graph_from_documents(documents) -> Graph:
+    '''
+        Parses several documents, given as (data, rdf_format) pairs, into a single graph.
+        Raises ValueError with the position of the first invalid document.
+    '''
     graph = Graph()
-    graph.parse(data=data, format="turtle")
+    for index, (data, rdf_format) in enumerate(documents):
+        try:
+            parse_into_graph(graph, data, rdf_format)
+        except Exception as e:
+            raise ValueError(f"Document {index}: {str(e)}")
     return graph
 
+def parse_into_graph(graph: Graph, data: str, rdf_format: str) -> None:
+    if rdf_format not in LINE_BASED_FORMATS:
+        graph.parse(data=data, format=rdf_format)
+        return
+    document_id = uuid4().hex
+    pool = utils.executor.get_parser_pool()
+    if pool is None or data.count("\n") < PARSER_CHUNK_LINES:
+        chunks = (parse_rdf_lines(chunk, rdf_format, document_id) for chunk in split_lines(data, PARSER_CHUNK_LINES))
+    else:
+        chunks = pool.map(parse_rdf_lines, split_lines(data, PARSER_CHUNK_LINES), repeat(rdf_format), repeat(document_id))
+    for triples in chunks:
+        graph += triples
+
+def split_triples(graph: Graph, chunk_triples: int):
+    '''
+        Yields the triples of the graph in lists of about chunk_triples triples, keeping together the triples
+        connected through blank nodes (a blank node is only the same node inside the document it is sent in).
+        Groups of connected triples bigger than chunk_triples are yielded on their own.
+    '''
+    parents = {}
+    def find(node):
+        root = node
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while node != root:
+            parents[node], node = root, parents[node]
+        return root
+    for s, _, o in graph:
+        if isinstance(s, BNode):
+            parents.setdefault(s, s)
+            if isinstance(o, BNode):
+                parents.setdefault(o, o)
+                parents[find(o)] = find(s)
+        elif isinstance(o, BNode):
+            parents.setdefault(o, o)
+    chunk, groups = [], {}
+    for triple in graph:
+        s, _, o = triple
+        node = s if isinstance(s, BNode) else o if isinstance(o, BNode) else None
+        if node is None:
+            chunk.append(triple)
+            if len(chunk) >= chunk_triples:
+                yield chunk
+                chunk = []
+        else:
+            groups.setdefault(find(node), []).append(triple)
+    for group in groups.values():
+        if len(chunk) + len(group) > chunk_triples and chunk:
+            yield chunk
+            chunk = []
+        chunk.extend(group)
+        if len(chunk) >= chunk_triples:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def split_lines(data: str, chunk_lines: int):
+    '''
+        Yields the text of the document in chunks of chunk_lines complete lines.
+    '''
+    lines = []
+    for line in io.StringIO(data):
+        lines.append(line)
+        if len(lines) == chunk_lines:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+class DocumentBlankNodes(dict):
+    '''
+        Blank node context for the N-Triples/N-Quads parser that gives the same blank node to a label
+        in every chunk of a document, so chunks parsed separately (even in other processes) can be merged.
+    '''
+    def __init__(self, document_id: str):
+        super().__init__()
+        self.document_id = document_id
+
+    def get(self, label, default=None):
+        return f"{self.document_id}{label}"
+
+class TripleCollector:
+    '''
+        Sink of the N-Triples parser that only keeps the parsed triples, without building a graph.
+    '''
+    def __init__(self):
+        self.triples = []
+
+    def triple(self, subject, predicate, obj):
+        self.triples.append((subject, predicate, obj))
+
+def parse_rdf_lines(data: str, rdf_format: str, document_id: str) -> list:
+    '''
+        Parses a chunk of a line-based document and returns its triples.
+        The named graphs of N-Quads are merged, as the SEGB keeps a single graph.
+    '''
+    try:
+        if rdf_format == "nquads":
+            dataset = Dataset()
+            dataset.parse(data=data, format=rdf_format, bnode_context=DocumentBlankNodes(document_id))
+            return [(subject, predicate, obj) for subject, predicate, obj, _ in dataset.quads()]
+        collector = TripleCollector()
+        W3CNTriplesParser(collector).parse(io.StringIO(data), bnode_context=DocumentBlankNodes(document_id))
+        return collector.triples
+    except Exception as e:
+        # Raised again in the server process, so it must be picklable
+        raise ValueError(str(e))
+
 def get_graph_from_json(data) -> Graph:
     graph = Graph()
     if data:
         graph.parse(data=data, format="json-ld")
     return graph
 
-def convert_graph_to_json_ld(graph: Graph) -> dict:
-    graph_namespace = graph.namespaces()
-    prefixes = {prefix: str(uri) for prefix, uri in graph_namespace}
-    serialized_json_ld = graph.serialize(format="json-ld", context=prefixes, encoding="utf-8")
-    json_ld_data = json.loads(serialized_json_ld)
-    
-    context = json_ld_data.get("@context", {})
-    
-    if "@graph" not in json_ld_data:
-        json_ld_data.pop("@context")
-        data = json_ld_data if isinstance(json_ld_data, list) else [json_ld_data]
-        json_ld_data = {"@context": context, "@graph": data}
-    
-    return json_ld_data
+def get_new_triples(graph: Graph, current_graph: Graph) -> Graph:
+    new_graph = Graph()
+    for prefix, uri in graph.namespaces():
+        new_graph.bind(prefix, uri)
+    for triple in graph:
+        if triple not in current_graph:
+            new_graph.add(triple)
+    return new_graph
+
+def convert_graph_to_json_ld(graph: Graph, context: dict = None) -> dict:
+    '''
+        Builds the JSON-LD document of the graph ({"@context": prefixes, "@graph": nodes}) directly from its triples,
+        grouped by subject, instead of serializing it to JSON-LD text and parsing it back.
+        The nodes are compacted as rdflib's JSON-LD serializer does, with the given context (prefix -> IRI)
+        or by default with the prefixes of the graph, so they can be merged with the ones already stored.
+    '''
+    prefixes = context if context is not None else {prefix: str(uri) for prefix, uri in graph.namespaces()}
+    return {"@context": prefixes, "@graph": JsonLdNodeBuilder(graph, prefixes).build()}
+
+class JsonLdNodeBuilder:
+    '''
+        Groups the triples of a graph by subject into compacted JSON-LD nodes.
+        IRIs are shortened to 'prefix:name' when their namespace (split at the last '#', '/' or ':') is a known prefix.
+    '''
+    def __init__(self, graph: Graph, prefixes: dict):
+        self.graph = graph
+        self.namespaces = {uri: prefix for prefix, uri in prefixes.items()}
+        self.shortened = {}
+        self.list_cells = set()
+
+    def shorten(self, iri: str) -> str:
+        short_iri = self.shortened.get(iri)
+        if short_iri is None:
+            short_iri = iri
+            for delimiter in JSON_LD_VOCAB_DELIMITERS:
+                at = iri.rfind(delimiter)
+                if at > -1:
+                    prefix = self.namespaces.get(iri[:at + 1])
+                    if prefix:
+                        short_iri = f"{prefix}:{iri[at + 1:]}"
+                    break
+            self.shortened[iri] = short_iri
+        return short_iri
+
+    def to_symbol(self, iri: str) -> str:
+        # A namespace used as a property or type is compacted to its prefix alone
+        return self.namespaces.get(iri) or self.shorten(iri)
+
+    def to_value(self, term):
+        if isinstance(term, Literal):
+            if term.datatype in JSON_LD_NATIVE_TYPES:
+                value = term.toPython()
+                return str(value) if isinstance(value, Literal) else value
+            if term.datatype:
+                return {"@type": self.to_symbol(str(term.datatype)), "@value": str(term)}
+            if term.language:
+                return {"@language": term.language, "@value": str(term)}
+            return str(term)
+        items = self.to_list(term)
+        if items is not None:
+            return {"@list": [self.to_value(item) for item in items]}
+        if isinstance(term, BNode):
+            return {"@id": term.n3()}
+        return {"@id": self.shorten(str(term))}
+
+    def to_list(self, term) -> list:
+        '''
+            Returns the items of the RDF collection starting at the term, or None if it is not a well-formed one.
+        '''
+        if term == RDF.nil:
+            return []
+        if not isinstance(term, BNode) or (term, RDF.first, None) not in self.graph:
+            return None
+        items, cells = [], []
+        while term != RDF.nil:
+            if not isinstance(term, BNode) or term in cells:
+                return None
+            first, rest = None, None
+            for predicate, obj in self.graph.predicate_objects(term):
+                if first is None and predicate == RDF.first:
+                    first = obj
+                elif rest is None and predicate == RDF.rest:
+                    rest = obj
+                elif predicate != RDF.type or obj != RDF.List:
+                    return None
+            items.append(first)
+            cells.append(term)
+            term = rest
+        self.list_cells.update(cells)
+        return items
+
+    def build(self) -> list:
+        nodes = {}
+        rdf_type = RDF.type
+        for subject, predicate, obj in self.graph:
+            node = nodes.get(subject)
+            if node is None:
+                node_id = subject.n3() if isinstance(subject, BNode) else self.shorten(str(subject))
+                node = nodes[subject] = {"@id": node_id}
+            if predicate == rdf_type:
+                key = "@type"
+                value = self.to_symbol(str(obj)) if isinstance(obj, URIRef) else self.to_value(obj)
+            else:
+                key = self.to_symbol(str(predicate))
+                value = self.to_value(obj)
+            current_value = node.get(key)
+            if current_value is None:
+                node[key] = value
+            elif isinstance(current_value, list):
+                current_value.append(value)
+            else:
+                node[key] = [current_value, value]
+        # The cells of the collections are embedded in the nodes that use them as '@list' values
+        return [node for subject, node in nodes.items() if subject not in self.list_cells]
 
 def convert_graph_to_turtle(graph: Graph) -> str:
     graph_namespace = graph.namespaces()
@@ -42,25 +325,192 @@ def convert_graph_to_turtle(graph: Graph) -> str:
     serialized_turtle_data = graph.serialize(format="turtle", context=prefixes, encoding="utf-8").decode("utf-8")
     return serialized_turtle_data
 
+def write_graph_as_turtle(graph: Graph, destination) -> None:
+    '''
+        Serializes the graph as UTF-8 Turtle into a binary file-like object,
+        without building the whole serialization in memory.
+    '''
+    graph_namespace = graph.namespaces()
+    prefixes = {prefix: str(uri) for prefix, uri in graph_namespace}
+    graph.serialize(destination=destination, format="turtle", context=prefixes, encoding="utf-8")
+
 # -------- AUX FUNCTIONS FOR MODEL.PY ----------- # 
 
-def update_prefixes (graph_data:dict, json_ld_data:dict) -> dict:
-    new_prefixes = json_ld_data.get("@context", None)
-    current_prefixes = graph_data.get("@context", {})
-    if new_prefixes:
-        for key, value in new_prefixes.items():
-            if key not in current_prefixes:
-                current_prefixes.update({key:value})
-    json_ld_data["@context"].update(current_prefixes)
-    return json_ld_data
+def merge_json_ld_nodes (nodes: list) -> list:
+    '''
+        Merges the nodes with the same '@id' into a single node, skipping the values
+        (and therefore the triples) that are already present. Nodes without '@id' are kept as they are.
+    '''
+    merged_nodes = {}
+    anonymous_nodes = []
+    for node in nodes:
+        node_id = node.get("@id")
+        if node_id is None:
+            anonymous_nodes.append(node)
+            continue
+        merged_node = merged_nodes.setdefault(node_id, {"@id": node_id})
+        for key, values in node.items():
+            if key == "@id":
+                continue
+            current_values = merged_node.get(key, [])
+            current_values = current_values if isinstance(current_values, list) else [current_values]
+            seen = {json.dumps(value, sort_keys=True) for value in current_values}
+            for value in (values if isinstance(values, list) else [values]):
+                serialized_value = json.dumps(value, sort_keys=True)
+                if serialized_value not in seen:
+                    seen.add(serialized_value)
+                    current_values.append(value)
+            merged_node[key] = current_values[0] if len(current_values) == 1 else current_values
+    return list(merged_nodes.values()) + anonymous_nodes
+
+def compact_json_ld (json_ld_data: dict) -> dict:
+    return {
+        "@context": json_ld_data.get("@context", {}),
+        "@graph": merge_json_ld_nodes(json_ld_data.get("@graph", []))
+    }
 
+def convert_graph_to_n3_triples(graph: Graph) -> list:
+    return [(s.n3(), p.n3(), o.n3()) for s, p, o in graph]
 
-def update_graph (graph_data: dict, json_ld_data:dict) -> dict:
-    old_graph = graph_data.get("@graph", [])
-    new_graph = old_graph + [json_triple for json_triple in json_ld_data["@graph"]]
-    json_ld_data["@graph"] = new_graph
-    return json_ld_data
+def get_graph_from_n3_triples(triples, prefixes: dict = None) -> Graph:
+    '''
+        Builds a graph from N3 triples as they are read (e.g. from a database cursor).
+        Every term is decoded on its own, so the triples are never joined into a single document to parse,
+        and blank nodes keep their stored labels (separate parses would give them new ones).
+    '''
+    graph = Graph()
+    for prefix, uri in (prefixes or {}).items():
+        graph.bind(prefix, uri)
+    graph.addN((from_n3(s), from_n3(p), from_n3(o), graph) for s, p, o in triples)
+    return graph
+
+def convert_triples_to_nt(triples) -> str:
+    graph = Graph()
+    for triple in triples:
+        graph.add(triple)
+    return graph.serialize(format="nt", encoding="utf-8").decode("utf-8")
+
+def convert_n3_triples_to_nquads(triples: list, graph_name: str) -> str:
+    '''
+        Serializes N3 triples as N-Quads in the named graph graph_name.
+        It only takes and returns strings, so it can run in the parser processes.
+    '''
+    dataset = Dataset()
+    named_graph = dataset.graph(URIRef(graph_name))
+    named_graph.addN((s, p, o, named_graph) for s, p, o in get_graph_from_n3_triples(triples))
+    return dataset.serialize(format="nquads", encoding="utf-8").decode("utf-8")
 
 def convert_ttl_info_to_dict(ttl_list) -> dict:
     dict_ttl_list = [json.loads(ttl.to_json()) for ttl in ttl_list]
-    return dict_ttl_list
\ No newline at end of file
+    return dict_ttl_list
+
+# -------- SPARQL QUERIES ----------- #
+
+def normalize_sparql_query(query: str) -> str:
+    '''
+        Removes the whitespace around the query, so the same query sent with a different padding
+        reuses the prepared query. Whitespace inside it is kept: it may belong to a (multi-line) string literal.
+    '''
+    return query.strip()
+
+def check_sparql_query_sources(algebra) -> None:
+    '''
+        Rejects the queries that would make rdflib read data from other sources than the queried graph:
+        SERVICE patterns (sent as HTTP requests to any URL) and FROM / FROM NAMED dataset clauses.
+        Raises ValueError if the algebra of the query has any of them.
+    '''
+    pending = [algebra]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, CompValue):
+            if node.name == "ServiceGraphPattern":
+                raise ValueError("SERVICE patterns are not allowed")
+            if dict.get(node, "datasetClause"):
+                raise ValueError("FROM and FROM NAMED clauses are not allowed")
+            pending.extend(node.values())
+        elif isinstance(node, (list, tuple)):
+            pending.extend(node)
+
+@lru_cache(maxsize=SPARQL_QUERY_CACHE_SIZE)
+def prepare_sparql_query(query: str):
+    # Only query forms are accepted by the parser: updates (INSERT, DELETE, ...) are rejected
+    prepared_query = prepareQuery(query)
+    check_sparql_query_sources(prepared_query.algebra)
+    return prepared_query
+
+def convert_term_to_sparql_json(term) -> dict:
+    if isinstance(term, URIRef):
+        return {"type": "uri", "value": str(term)}
+    if isinstance(term, BNode):
+        return {"type": "bnode", "value": str(term)}
+    value = {"type": "literal", "value": str(term)}
+    if isinstance(term, Literal):
+        if term.language:
+            value["xml:lang"] = term.language
+        elif term.datatype:
+            value["datatype"] = str(term.datatype)
+    return value
+
+class DeadlineGraph(Graph):
+    '''
+        View of a graph (it shares its store) that raises TimeoutError when a triple is read after the deadline,
+        so a query stops during its evaluation instead of running to completion after the time limit.
+    '''
+    def __init__(self, graph: Graph, timeout: float):
+        super().__init__(store=graph.store, identifier=graph.identifier, namespace_manager=graph.namespace_manager)
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+
+    def check_deadline(self) -> None:
+        if time.monotonic() > self.deadline:
+            raise TimeoutError(f"Query exceeded the time limit of {self.timeout} seconds")
+
+    def triples(self, triple):
+        for found_triple in super().triples(triple):
+            self.check_deadline()
+            yield found_triple
+
+def execute_sparql_query(graph: Graph, query: str, max_results: int, timeout: float) -> tuple:
+    '''
+        Runs a read-only SPARQL query on the graph.
+        SELECT and ASK results are returned as SPARQL JSON results, CONSTRUCT and DESCRIBE results as Turtle.
+        Returns the media type, the serialized result and whether the result was truncated to max_results.
+        Raises ValueError if the query is not valid and TimeoutError if it takes more than timeout seconds.
+        The time limit is checked on every triple read from the graph and every result: sorting or grouping
+        the solutions already read is not interrupted, so a query can exceed it by that time.
+    '''
+    query_graph = DeadlineGraph(graph, timeout)
+    try:
+        prepared_query = prepare_sparql_query(normalize_sparql_query(query))
+    except Exception as e:
+        raise ValueError(f"Invalid SPARQL query (only read-only queries on the stored graph are allowed): {str(e)}")
+    result = query_graph.query(prepared_query)
+    truncated = False
+
+    if result.type == "ASK":
+        return "application/sparql-results+json", json.dumps({"head": {}, "boolean": result.askAnswer}), truncated
+
+    if result.type == "SELECT":
+        bindings = []
+        for row in result:
+            query_graph.check_deadline()
+            if len(bindings) == max_results:
+                truncated = True
+                break
+            bindings.append({name: convert_term_to_sparql_json(term) for name, term in row.asdict().items()})
+        content = {
+            "head": {"vars": [str(var) for var in result.vars]},
+            "results": {"bindings": bindings}
+        }
+        return "application/sparql-results+json", json.dumps(content), truncated
+
+    result_graph = Graph()
+    for prefix, uri in graph.namespaces():
+        result_graph.bind(prefix, uri)
+    for triple in result:
+        query_graph.check_deadline()
+        if len(result_graph) == max_results:
+            truncated = True
+            break
+        result_graph.add(triple)
+    return "text/turtle; charset=utf-8", convert_graph_to_turtle(result_graph), truncated